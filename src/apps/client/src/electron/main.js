@@ -16,7 +16,11 @@ const waitOnPythonEndPoint =
   serverURL.replace("http://", "http-get://") + "/api/healthcheck";
 const waitOnAstroEndPoint = clientURL.replace("http://", "http-get://");
 
-const sio = sioClient(serverURL, { transports: ["websocket"] });
+// FLICKTOK_SESSION picks the station this app controls, see SessionManager
+const sio = sioClient(serverURL, {
+  transports: ["websocket"],
+  auth: { session: process.env.FLICKTOK_SESSION },
+});
 
 let win; // main window
 let smView; // social media view (Instagram, YouTube, etc.)
@@ -123,19 +127,26 @@ ipcMain.on("toMain", (event, payload) => {
   }
 });
 
-["connect", "disconnect", "fromPython"].forEach((eventName) => {
-  sio.on(eventName, (payload) => {
-    win.webContents.send("fromMain", {
+const forwardFromPython = (eventName, payload) => {
+  win.webContents.send("fromMain", {
+    id: `py:${payload?.id ?? eventName}`,
+    data: payload?.data ?? {},
+  });
+  if (smView) {
+    smView.webContents.send("fromMain", {
       id: `py:${payload?.id ?? eventName}`,
       data: payload?.data ?? {},
     });
-    if (smView) {
-      smView.webContents.send("fromMain", {
-        id: `py:${payload?.id ?? eventName}`,
-        data: payload?.data ?? {},
-      });
-    }
-  });
+  }
+};
+
+["connect", "disconnect", "fromPython"].forEach((eventName) => {
+  sio.on(eventName, (payload) => forwardFromPython(eventName, payload));
+});
+
+// The server sends bursts of messages as one frame
+sio.on("fromPythonBatch", (payloads) => {
+  payloads.forEach((payload) => forwardFromPython("fromPython", payload));
 });
 
 const handleNav = (event, payload) => {
@@ -4,6 +4,8 @@ import { subscribeKey } from "valtio/utils";
 let globalStore = proxy({
   connectedToServer: false,
   eegStreamIsAvailable: false,
+  // { score, bad, channels: [{ label, std, lineNoise, peakToPeak, saturated, flags }] }
+  signalQuality: null,
   page: "index",
   settings: {
     selected: {
@@ -42,6 +44,7 @@ let globalStore = proxy({
     trainingState: {
       state: "stop",
       trialCount: 0,
+      rejectedTrials: 0,
       bgColors: {
         start: "bg-slate-500",
         stop: "bg-slate-500",
@@ -218,6 +221,15 @@ if (window.api) {
       case "py:set-training-status":
         globalStore.ui.trainingState.state = data.state;
         globalStore.ui.trainingState.trialCount = data.trialCount;
+        if (data.state === "start") {
+          globalStore.ui.trainingState.rejectedTrials = 0;
+        }
+        break;
+      case "py:trial-rejected":
+        globalStore.ui.trainingState.rejectedTrials += 1;
+        break;
+      case "py:signal-quality-updated":
+        globalStore.signalQuality = data;
         break;
       case "py:set-prediction-status":
         globalStore.ui.predictionState.state = data.state;
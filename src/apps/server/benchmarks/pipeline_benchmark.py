@@ -0,0 +1,263 @@
+"""End-to-end benchmark of the FlickTok train / predict pipeline.
+
+Runs FlickTokModel headless against the headset simulator and a stub FES device,
+for every combination of channel count, sample rate and trial count, and writes
+the results to a JSON file so runs can be compared for regressions.
+
+Each configuration runs in its own subprocess so LSL streams and memory
+measurements don't leak between runs.
+
+Usage (from src/apps/server):
+    python -m benchmarks.pipeline_benchmark --channels 14 32 --rates 128 256 \
+        --trials 10 20 --output benchmark-results.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+from pylsl import local_clock
+
+from src.utils.store import Store
+from src.utils.headset_sim_fn import generate_simulated_eeg
+from src.FesDevice import FesLatency
+from src.FlickTokModel import FlickTokModel
+
+
+class NullSio:
+    """Stands in for the Socket.IO server, counts emitted messages"""
+
+    def __init__(self):
+        self.emitted = 0
+
+    async def emit(self, *args, **kwargs):
+        self.emitted += 1
+
+
+class StubFesDevice:
+    """Stands in for FesDeviceManager, records the latency of every trigger"""
+
+    def __init__(self):
+        self.latencies: list[FesLatency] = []
+
+    def start(self):
+        pass
+
+    def trigger(self, eeg_time=None, prediction_time=None, serial_number=None):
+        now = local_clock()
+        self.latencies.append(FesLatency(eeg_time, prediction_time, now, now))
+
+    async def swipe(self, serial_number=None):
+        self.trigger()
+
+
+def summarize(values) -> dict:
+    """Milliseconds summary of a list of durations in seconds"""
+    values = np.asarray([v for v in values if v is not None], dtype=float) * 1000
+    if len(values) == 0:
+        return {"count": 0}
+    return {
+        "count": int(len(values)),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def timed(records: list, fn):
+    """Wrap fn so the duration of every call is appended to records"""
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            records.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+async def run_configuration(args) -> dict:
+    store = Store(eeg_stream_is_available=False)
+    generate_simulated_eeg(store, fsample=args.rate, n_channels=args.channels)
+    await asyncio.sleep(1.0)
+
+    fes_device = StubFesDevice()
+    model = FlickTokModel(store, NullSio(), fes_device=fes_device)
+    model.number_of_trials = args.trials
+    model.training_mode = args.training_mode
+    model.rest_seconds = model.action_seconds = args.trial_seconds
+    model.prediction_seconds = args.trial_seconds
+    model.preroll_seconds = 0.2
+    model.prediction_rest_seconds = 1
+    bessy = model.bessy
+
+    rss_start = max_rss_mb()
+
+    # Training: time every classifier update, whichever training mode is used.
+    # Only this session's classifier instance is wrapped, it's dropped with Bessy.
+    train_times, fit_times = [], []
+    training_started = time.perf_counter()
+    await model.start_training()
+    classifier = bessy.classifier
+    classifier.add_to_train = timed(train_times, classifier.add_to_train)
+    classifier.fit = timed(fit_times, classifier.fit)
+    while not fit_times:
+        await asyncio.sleep(0.1)
+    training_seconds = time.perf_counter() - training_started
+
+    # Marker-driven predictions: queue a prediction marker and wait for the reply.
+    # Sliding windows aren't running yet, so every prediction heard is a reply.
+    marker_latencies = []
+    reply = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def on_probabilities(timestamps, probabilities):
+        loop.call_soon_threadsafe(reply.set)
+
+    bessy.output.probability_listeners.append(on_probabilities)
+    for _ in range(args.predictions):
+        reply.clear()
+        queued = local_clock()
+        bessy.make_prediction(model.prediction_seconds)
+        try:
+            await asyncio.wait_for(reply.wait(), model.prediction_seconds + 5)
+            marker_latencies.append(local_clock() - queued - model.prediction_seconds)
+        except asyncio.TimeoutError:
+            marker_latencies.append(None)
+    bessy.output.probability_listeners.remove(on_probabilities)
+
+    # Sliding-window predictions with simulated motor imagery
+    prediction_task = asyncio.create_task(model.start_predicting())
+    for _ in range(args.predictions):
+        await asyncio.sleep(model.prediction_rest_seconds + 0.5)
+        store.publish("simulate-action", model.prediction_seconds)
+        await asyncio.sleep(model.prediction_seconds + 1)
+    await model.stop_predicting()
+    await asyncio.wait_for(prediction_task, 10)
+
+    # Step statistics are dropped with the step worker, read them before it stops
+    step_stats = bessy.step_stats
+    step_history = bessy.step_history
+    await model.stop_training()
+    store.publish("stop-headset-simulator")
+
+    return {
+        "channels": args.channels,
+        "sample_rate": args.rate,
+        "trials": args.trials,
+        "training_mode": args.training_mode,
+        "trial_seconds": args.trial_seconds,
+        "step": {
+            "count": step_stats.get("step_count"),
+            "missed_deadlines": step_stats.get("missed_deadlines"),
+            "jitter": summarize([jitter for jitter, _ in step_history]),
+            "duration": summarize([duration for _, duration in step_history]),
+        },
+        "training": {
+            "session_seconds": round(training_seconds, 3),
+            "add_to_train": summarize(train_times),
+            "fit": summarize(fit_times),
+        },
+        "prediction": {
+            "marker_to_prediction": summarize(marker_latencies),
+            "eeg_to_prediction": summarize(
+                [l.prediction_time - l.eeg_time for l in fes_device.latencies]
+            ),
+            "detections": len(fes_device.latencies),
+        },
+        "memory": {
+            "rss_start_mb": round(rss_start, 1),
+            "rss_peak_mb": round(max_rss_mb(), 1),
+        },
+    }
+
+
+def run_sweep(args):
+    results = []
+    for channels in args.channels:
+        for rate in args.rates:
+            for trials in args.trials:
+                print(f"benchmark: {channels} channels, {rate} Hz, {trials} trials")
+                command = [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.pipeline_benchmark",
+                    "--run-one",
+                    "--channels", str(channels),
+                    "--rates", str(rate),
+                    "--trials", str(trials),
+                    "--training-mode", args.training_mode,
+                    "--trial-seconds", str(args.trial_seconds),
+                    "--predictions", str(args.predictions),
+                ]
+                completed = subprocess.run(command, capture_output=True, text=True)
+                lines = completed.stdout.strip().splitlines()
+                try:
+                    results.append(json.loads(lines[-1]))
+                except (IndexError, json.JSONDecodeError):
+                    print(completed.stderr[-2000:])
+                    results.append(
+                        {"channels": channels, "sample_rate": rate, "trials": trials,
+                         "error": f"exit code {completed.returncode}"}
+                    )
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"benchmark: results written to {args.output}")
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, nargs="+", default=[14, 32])
+    parser.add_argument("--rates", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--trials", type=int, nargs="+", default=[10, 20])
+    parser.add_argument("--training-mode", choices=["online", "batch"], default="online")
+    parser.add_argument("--trial-seconds", type=float, default=1.0)
+    parser.add_argument("--predictions", type=int, default=3)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.run_one:
+        args.channels, args.rate, args.trials = args.channels[0], args.rates[0], args.trials[0]
+        result = asyncio.run(run_configuration(args))
+        print(json.dumps(result))
+        sys.stdout.flush()
+        os._exit(0)  # don't wait on the EEG scan timer
+    run_sweep(args)
@@ -1,15 +1,22 @@
 import time
 import threading
 import asyncio
+from collections import deque
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from bci_essentials.eeg_data import EegData
-from bci_essentials.classification.mi_classifier import MiClassifier
 from bci_essentials.io.lsl_sources import EegSource
 
 from .BessyInput import BessyInput
 from .BessyOutput import BessyOutput
+from .OnlineMiClassifier import OnlineMiClassifier
+from .CachedMiClassifier import CachedMiClassifier
+from .SessionRecorder import SessionRecorder
 
 from .utils.store import Store
-from .utils.helpers import CustomTimer, console
+from .utils.epoch_cache import EpochCache
+from .utils.signal_quality import TRANSIENT, flag_names
+from .utils.helpers import CustomTimer, FixedRateWorker, console
 
 
 class Bessy:
@@ -30,6 +37,10 @@ class Bessy:
         store: Store,
         perform_training_step: callable,
         process_prediction: callable,
+        process_prediction_series: callable = None,
+        fast_process_prediction_series: callable = None,
+        step_mode: str = "thread",
+        training_mode: str = "online",
     ):
         super().__init__()
 
@@ -38,6 +49,43 @@ class Bessy:
         self.__num_classes = num_classes
         self.__bessy_step_msec = 200
 
+        # "thread" runs EegData.step() on a dedicated worker at a fixed rate so the
+        # event loop stays free, "loop" runs it inline on the asyncio loop
+        self.__step_mode = step_mode
+        self.__step_worker = None
+        self.__missed_deadlines = 0
+
+        # "online" updates the classifier as each trial is marked, "batch" refits
+        # the bci_essentials MiClassifier (with cross-validation) on Update Classifier
+        self.training_mode = training_mode
+
+        # Per-epoch covariances / tangent vectors shared by retrains and CV folds
+        self.epoch_cache = EpochCache()
+        # EegData preprocessing, saved with trained models so a warm start matches.
+        # Filtering is done by the EEG source as it ingests (see StreamingFilter),
+        # so EegData doesn't refilter every epoch
+        self.preprocessing = {"pp_type": None}
+        self.recorder = None
+
+        # Training trials that overlap a transient artifact (see SignalQualityMonitor)
+        # are left out of the classifier and reported as "trial-rejected" events
+        self.reject_artifact_trials = True
+        self.__marked_trials = deque()  # (start, duration, label) of marked trials
+        self.__kept_trials = []  # whether each trial so far went to the classifier
+        # How often the EEG source's signal quality is set on the store
+        self.signal_quality_seconds = 1.0
+        self.__next_quality_update = 0.0
+
+        # Sliding window prediction, (window samples, hop samples) while enabled
+        self.__sliding_window = None
+        self.__next_window_end = None
+        # Seconds the classifier takes per sliding window (moving average)
+        self.prediction_latency = None
+
+        # EegData appends every sample it receives, keep only this much history
+        # (plus whatever a pending trial marker still needs) so memory stays flat
+        self.__eeg_history_seconds = 30
+
         # TODO - find a way to have the output signals in this classs to avoid having to make
         # the BessyOutput public.  That way we can do: bessy.some_signal.connect(my_slot) instead
         # of bessy.output.some_signal.connect(my_slot)
@@ -45,11 +93,14 @@ class Bessy:
             store=store,
             perform_training_step=perform_training_step,
             process_prediction=process_prediction,
+            process_prediction_series=process_prediction_series,
+            fast_process_prediction_series=fast_process_prediction_series,
         )
         self.__input = BessyInput()
 
         self.__bessy = None
         self.__eeg_source = None
+        self.__eeg_cursor = None  # buffer.total_samples already handed to output.eeg()
 
         self.__stop_event = asyncio.Event()
         self.__task = None
@@ -59,53 +110,272 @@ class Bessy:
     def connect_eeg_source(self, eeg: EegSource):
         self.__eeg_source = eeg
 
-    def start_eeg_processing(self):
+    def start_eeg_processing(self, classifier=None):
+        """Start stepping EegData.  With an already trained classifier (e.g. from the
+        ModelRegistry) Bessy skips training and is ready to predict right away."""
         if self.__bessy is None and self.__eeg_source is not None:
-            self.__setup_bessy()
+            self.__missed_deadlines = 0
+            self.store.set("bessy_missed_deadlines", 0)
+            self.__setup_bessy(classifier)
 
-    def stop_eeg_processing(self):
+    async def stop_eeg_processing(self):
+        """Stop stepping EegData, returns once the last step has finished"""
         if self.__bessy is not None:
-            self.__kill_bessy()
+            await self.__kill_bessy()
 
     def save_data(self, file_path: str):
+        """Save trials to file_path.npz and the epoch cache to file_path.cache.npz"""
+        if file_path[-4:] == ".npz":
+            file_path = file_path[:-4]
         if self.__bessy is not None:
             self.__bessy.save_trials_as_npz(file_path)
+            self.epoch_cache.save(file_path + ".cache")
+
+    @property
+    def is_processing(self) -> bool:
+        return self.__bessy is not None
+
+    @property
+    def is_trained(self) -> bool:
+        """True once the classifier has been fitted on the training set"""
+        eeg_data = self.__bessy
+        return eeg_data is not None and bool(eeg_data.live_update or eeg_data.train_complete)
+
+    @property
+    def rejected_trials(self) -> int:
+        """Training trials left out of the classifier due to artifacts"""
+        return self.__kept_trials.count(False)
+
+    @property
+    def pending_trials(self) -> int:
+        """Marked training trials that haven't reached the classifier yet"""
+        return len(self.__marked_trials)
+
+    @property
+    def eeg_source(self) -> EegSource | None:
+        return self.__eeg_source
+
+    @property
+    def fsample(self) -> float | None:
+        return None if self.__eeg_source is None else self.__eeg_source.fsample
+
+    def trials(self) -> tuple[np.ndarray, np.ndarray] | None:
+        """Copy of the training trials so far as (trials x channels x samples, labels),
+        cut to the shortest trial, or None before any trial has been collected"""
+        eeg_data = self.__bessy
+        if eeg_data is None or eeg_data.n_trials == 0:
+            return None
+        X = eeg_data.raw_eeg_trials[: eeg_data.n_trials, : eeg_data.n_channels]
+        y = eeg_data.labels[: eeg_data.n_trials]
+        # Leave out the trials the classifier didn't get either
+        keep = np.ones(len(X), dtype=bool)
+        screened = self.__kept_trials[: len(X)]
+        keep[: len(screened)] = screened
+        X, y = X[keep], y[keep]
+        if len(X) == 0:
+            return None
+        # Trials are zero padded up to EegData's max_samples
+        lengths = [np.flatnonzero(np.any(trial, axis=0))[-1] + 1 for trial in X]
+        return X[..., : min(lengths)].copy(), y.copy()
+
+    def promote_classifier(self, classifier):
+        """Predict with classifier from now on, e.g. the winner of a model selection
+        run.  The step thread picks it up on its next prediction."""
+        if self.__bessy is not None:
+            self.__bessy._classifier = classifier
+
+    def start_recording(self, path: str):
+        """Stream EEG, markers and predictions to a SessionRecorder in path"""
+        self.stop_recording()
+        if self.__eeg_source is None:
+            return
+        self.recorder = SessionRecorder(
+            path,
+            self.__eeg_source.channel_labels,
+            self.__eeg_source.fsample,
+            self.__num_classes,
+            preprocessing=getattr(self.__eeg_source, "preprocessing", None),
+        )
+        self.recorder.start()
+        self.output.eeg_listeners.append(self.recorder.write_eeg)
+        self.output.probability_listeners.append(self.recorder.write_predictions)
+        self.__input.marker_listeners.append(self.recorder.write_markers)
+
+    def stop_recording(self):
+        """Detach and close the recorder, blocks until its queue is on disk so
+        call it off the event loop"""
+        if self.recorder is None:
+            return
+        self.output.eeg_listeners.remove(self.recorder.write_eeg)
+        self.output.probability_listeners.remove(self.recorder.write_predictions)
+        self.__input.marker_listeners.remove(self.recorder.write_markers)
+        self.recorder.stop()
+        self.recorder = None
 
     def start_training_session(self):
         """Mark the start of a training data set"""
-        self.__input.queue_marker("Trial Started")
+        self.__input.queue_command("Trial Started")
 
     def end_training_session(self):
         """Mark the end of the training data set"""
         # TODO - bessy will crash if we end trial without marking anything
-        self.__input.queue_marker("Trial Ends")
+        self.__input.queue_command("Trial Ends")
 
     def mark_trial(self, label: int, duration: int):
         """Mark a trial in the data set"""
         # paradigm (mi = motor imagery), num options, label, length
-        message = "mi,{0},{1},{2}".format(self.__num_classes, label, duration)
-        self.__input.queue_marker(message)
+        start = self.__input.queue_mi(self.__num_classes, label, duration)
+        self.__marked_trials.append((start, duration, label))
+
+        # Closing the trial hands the epoch to the classifier as soon as EegData
+        # has cut it, so the online classifier is updated trial by trial
+        if self.training_mode == "online":
+            self.__input.queue_command("Trial Ends")
+            self.__input.queue_command("Trial Started")
 
     def train_classifier(self):
         """Tell Bessy to train the classifier using available data set"""
-        self.__input.queue_marker("Update Classifier")
+        self.__input.queue_command("Update Classifier")
 
-    def make_prediction(self, duration: int = 2):
-        """Tell Bessy to make a prediction from current data using currently trained classifier"""
+    def make_prediction(self, duration: int = 2) -> float:
+        """Tell Bessy to make a prediction from current data using currently trained
+        classifier.  Returns the timestamp the predicted window starts at."""
         label = -1
         # paradigm (mi = motor imagery), num options, label, length
         # where a label of -1 triggers a prediction
-        message = "mi,{0},{1},{2}".format(self.__num_classes, label, duration)
-        self.__input.queue_marker(message)
-
-    def __setup_bessy(self):
+        return self.__input.queue_mi(self.__num_classes, label, duration)
+
+    def start_sliding_prediction(self, window_seconds: float = 2, step_seconds: float = 0.1):
+        """Classify overlapping windows of the buffered EEG on every step, one batch per
+        step.  Results are sent to BessyOutput.prediction() with the timestamp of the
+        last sample in each window."""
+        fsample = self.__eeg_source.fsample
+        window = int(window_seconds * fsample)
+        hop = max(1, int(step_seconds * fsample))
+        self.__next_window_end = None
+        self.__sliding_window = (window, hop)
+
+    def set_sliding_step(self, step_seconds: float):
+        """Change the hop between sliding windows without restarting them"""
+        if self.__sliding_window is not None:
+            window, _ = self.__sliding_window
+            hop = max(1, int(step_seconds * self.__eeg_source.fsample))
+            self.__sliding_window = (window, hop)
+
+    def stop_sliding_prediction(self):
+        self.__sliding_window = None
+
+    @property
+    def step_seconds(self) -> float:
+        return self.__bessy_step_msec / 1000
+
+    def __predict_sliding_windows(self):
+        """Batch classify every window that has completed since the last step"""
+        eeg_data = self.__bessy
+        buffer = getattr(self.__eeg_source, "buffer", None)
+        ready = eeg_data.live_update or eeg_data.train_complete
+        if self.__sliding_window is None or buffer is None or not ready:
+            return
+
+        window, hop = self.__sliding_window
+        total = buffer.total_samples
+        samples, timestamps = buffer.latest(len(buffer))
+        first_sample = total - len(samples)
+
+        # Window ends are absolute sample counts, skip any that fell out of the buffer
+        if self.__next_window_end is None:
+            self.__next_window_end = total
+        first_end = max(self.__next_window_end, first_sample + window)
+        if first_end > total:
+            return
+        n_windows = (total - first_end) // hop + 1
+        self.__next_window_end = first_end + n_windows * hop
+
+        # (n_windows, n_channels, window) views into the ring buffer, no copies
+        start = first_end - window - first_sample
+        windows = sliding_window_view(samples, window, axis=0)[start::hop][:n_windows]
+        ends = start + window - 1 + hop * np.arange(n_windows)
+
+        started = time.perf_counter()
+        prediction = eeg_data._classifier.predict(windows)
+        latency = (time.perf_counter() - started) / n_windows
+        if self.prediction_latency is None:
+            self.prediction_latency = latency
+        else:
+            self.prediction_latency += 0.2 * (latency - self.prediction_latency)
+        self.output.prediction(prediction, timestamps=timestamps[ends])
+
+    def __screen_trials(self, labels: np.ndarray) -> np.ndarray:
+        """trial_screen of the classifier: which trials of a training block to keep.
+        Called on the step thread, once the monitor has seen all of their samples."""
+        quality = getattr(self.__eeg_source, "quality", None)
+        keep = np.ones(len(labels), dtype=bool)
+        for i in range(len(labels)):
+            if not self.__marked_trials:
+                break
+            start, duration, label = self.__marked_trials.popleft()
+            if quality is None or not self.reject_artifact_trials:
+                continue
+            flags = quality.artifacts(start, start + duration) & TRANSIENT
+            if not flags.any():
+                continue
+            keep[i] = False
+            channels = {
+                quality.labels[c]: flag_names(int(flags[c])) for c in np.flatnonzero(flags)
+            }
+            console.log(f"[yellow]Rejected trial {label} at {start:.3f}: {channels}[/yellow]")
+            self.store.publish(
+                "trial-rejected", {"label": int(label), "start": start, "channels": channels}
+            )
+        self.__kept_trials.extend(keep)
+        return keep
+
+    def __publish_signal_quality(self):
+        """Set the EEG source's signal quality on the store every signal_quality_seconds"""
+        quality = getattr(self.__eeg_source, "quality", None)
+        now = time.monotonic()
+        if quality is None or now < self.__next_quality_update:
+            return
+        self.__next_quality_update = now + self.signal_quality_seconds
+        summary = quality.summary()
+        if summary is not None:
+            self.store.set("signal_quality", summary)
+
+    @property
+    def classifier(self):
+        return None if self.__bessy is None else self.__bessy._classifier
+
+    def __setup_bessy(self, trained_classifier=None):
         # Set up Bessy with motor imagery classifier, not really sure about options
-        classifier = MiClassifier()
-        classifier.set_mi_classifier_settings(n_splits=3, type="TS", random_seed=35)
+        # Trial ids restart with every EegData, so cached epochs can't carry over
+        self.epoch_cache.clear()
+        self.__eeg_cursor = None
+        self.__marked_trials.clear()
+        self.__kept_trials = []
+        preprocessing = self.preprocessing
+        if trained_classifier is not None:
+            classifier = trained_classifier
+        elif self.training_mode == "online":
+            classifier = OnlineMiClassifier(self.epoch_cache, preprocessing)
+            classifier.set_mi_classifier_settings(n_classes=self.__num_classes)
+        else:
+            classifier = CachedMiClassifier(self.epoch_cache, preprocessing)
+            classifier.set_mi_classifier_settings(
+                n_splits=3, type="TS", random_seed=35
+            )
+        if trained_classifier is None:
+            classifier.trial_screen = self.__screen_trials
 
         # Create an EegData and initialize for online training
         self.__bessy = EegData(classifier, self.__eeg_source, self.__input, self.output)
-        self.__bessy.setup(online=True, training=True, pp_type=None)
+        self.__bessy.setup(
+            online=True,
+            training=trained_classifier is None,
+            train_complete=trained_classifier is not None,
+            # Prediction markers are only classified as they arrive with live_update
+            live_update=trained_classifier is not None,
+            **preprocessing,
+        )
 
         # # Start a periodic timer to process messages from bessy.
         # self.__loop_timer.timeout.connect(self.__bessy_step)
@@ -116,7 +386,50 @@ class Bessy:
         # )
         # self.__loop_timer.start()
 
-        self.__task = asyncio.create_task(self.__bessy_step_loop())
+        if self.__step_mode == "thread":
+            loop = asyncio.get_running_loop()
+            self.output.set_event_loop(loop)
+            self.__step_worker = FixedRateWorker(
+                self.__bessy_step_msec / 1000,
+                self.__bessy_step_sync,
+                loop=loop,
+                on_missed_deadline=self.__on_missed_deadline,
+                name="BessyStepWorker",
+            )
+            self.__step_worker.start()
+        else:
+            self.__stop_event.clear()
+            self.__task = asyncio.create_task(self.__bessy_step_loop())
+
+    @property
+    def step_stats(self) -> dict:
+        """Timing of the step worker, only missed_deadlines when stepping on the
+        event loop"""
+        if self.__step_worker is None:
+            return {"missed_deadlines": self.__missed_deadlines}
+        return {
+            "step_count": self.__step_worker.step_count,
+            "missed_deadlines": self.__missed_deadlines,
+            "last_step_seconds": self.__step_worker.last_step_seconds,
+            "max_step_seconds": self.__step_worker.max_step_seconds,
+            "max_jitter_seconds": self.__step_worker.max_jitter_seconds,
+        }
+
+    @property
+    def step_history(self) -> list[tuple[float, float]]:
+        """Recent (jitter, step duration) pairs in seconds from the step worker"""
+        if self.__step_worker is None:
+            return []
+        return list(self.__step_worker.step_history)
+
+    def __on_missed_deadline(self, missed: int, step_seconds: float):
+        console.log(
+            f"[yellow]Bessy step took {step_seconds * 1000:.0f} ms, "
+            f"missed {missed} deadline(s)[/yellow]"
+        )
+        # The worker hands this to the loop, it may arrive after the worker is gone
+        self.__missed_deadlines += missed
+        self.store.set("bessy_missed_deadlines", self.__missed_deadlines)
 
     async def __bessy_step_loop(self):
         while not self.__stop_event.is_set():
@@ -125,17 +438,78 @@ class Bessy:
             # console.log(f"[green]Bessy step: {time.time()}[/green]")
             await asyncio.sleep(self.__bessy_step_msec / 1000)
 
-    def __kill_bessy(self):
+    async def __kill_bessy(self):
         # Stop the loop timer and free bessy
         # self.__loop_timer.stop()
         # self.__loop_timer.timeout.disconnect()
 
         # self.__loop_timer.stop()
         # self.__bessy = None
-        if self.__task:
+        worker, self.__step_worker = self.__step_worker, None
+        if worker is not None:
+            # Joining waits for the step in progress, keep the loop free meanwhile
+            await asyncio.to_thread(worker.stop)
+        task, self.__task = self.__task, None
+        if task is not None:
             self.__stop_event.set()
-            self.__bessy = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Only now that no step can be running
+        self.__bessy = None
 
-    # This runs one loop of bessy, aka EegData
+    # This runs one loop of bessy on the event loop
     async def __bessy_step(self):
-        self.__bessy.step()
+        self.__bessy_step_sync()
+
+    # This runs one loop of bessy, aka EegData, also from the step worker thread
+    def __bessy_step_sync(self):
+        if self.__bessy is not None:
+            self.__bessy.step()
+            self.__publish_eeg()
+            self.__trim_eeg_history()
+            self.__predict_sliding_windows()
+            self.__publish_signal_quality()
+
+    def __publish_eeg(self):
+        """Hand the samples that arrived this step to the output's EEG listeners"""
+        buffer = getattr(self.__eeg_source, "buffer", None)
+        if buffer is None:
+            return
+        total = buffer.total_samples
+        new = 0 if self.__eeg_cursor is None else total - self.__eeg_cursor
+        self.__eeg_cursor = total
+        if new > 0 and self.output.eeg_listeners:
+            self.output.eeg(*buffer.latest(new))
+
+    def __trim_eeg_history(self):
+        """Drop samples from EegData that no pending marker can reach anymore"""
+        eeg_data = self.__bessy
+        timestamps = eeg_data.eeg_timestamps
+        if len(timestamps) == 0:
+            return
+
+        # Trim in blocks so the copy is amortized over many steps
+        cutoff = timestamps[-1] - self.__eeg_history_seconds
+        if timestamps[0] > cutoff - self.__eeg_history_seconds / 2:
+            return
+
+        # Keep a second before the oldest unprocessed marker for the epoch search
+        if eeg_data.marker_count < len(eeg_data.marker_timestamps):
+            cutoff = min(cutoff, eeg_data.marker_timestamps[eeg_data.marker_count] - 1)
+
+        drop = int(np.searchsorted(timestamps, cutoff))
+        if drop > 0:
+            eeg_data.eeg_data = eeg_data.eeg_data[drop:]
+            eeg_data.eeg_timestamps = timestamps[drop:]
+            eeg_data.search_index = max(0, eeg_data.search_index - drop)
+
+    def get_window(self, duration: float):
+        """Newest duration seconds of EEG as a (samples, timestamps) view, or None if
+        the EEG source is not buffered"""
+        if not hasattr(self.__eeg_source, "latest_window"):
+            return None
+        return self.__eeg_source.latest_window(duration)
+
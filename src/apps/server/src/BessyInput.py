@@ -1,41 +1,71 @@
 from pylsl import local_clock
 
 from bci_essentials.io.sources import MarkerSource
-from .BessyLSLMessenger import BessyLSLMessenger
+from .MarkerPublisher import MarkerPublisher
+from .utils.helpers import console
+from .utils.markers import MarkerQueue, Paradigm, marker_string, parse_marker
+
+# get_markers() result when nothing is queued, shared so idle steps don't allocate
+NO_MARKERS = ([], [])
 
 
 class BessyInput(MarkerSource):
     """BessyInput is a MarkerSource object that feeds markers to Bessy.  Marker
     messages are queued up for Bessy to pop off and process.
 
+    Markers are kept as typed records in a MarkerQueue, they are only turned into
+    strings when handed to bci_essentials and LSL.
     """
 
     def __init__(self):
         super().__init__()
-        self.__reset_queue()
-        self.__lsl_messenger = BessyLSLMessenger()
+        # Markers are queued from the event loop and popped by Bessy's step worker
+        self.__queue = MarkerQueue()
+        self.__lsl_messenger = MarkerPublisher.shared().stream("Python_LSL_Messenger")
+        # Called on the stepping thread with the MARKER_DTYPE records of each step
+        self.marker_listeners = []
+
+    def queue_mi(self, n_classes: int, label: int, duration: float) -> float:
+        """Queue a motor imagery trial, a label of -1 asks for a prediction.
+        Returns the marker's timestamp, which is where the trial's epoch starts."""
+        timestamp = local_clock()
+        self.__queue.put(timestamp, Paradigm.MI, n_classes, label, duration)
+        return timestamp
+
+    def queue_command(self, command: str):
+        """Queue one of utils.markers.COMMANDS, e.g. "Trial Ends" """
+        self.__queue.put_command(local_clock(), command)
 
     def queue_marker(self, message):
         """Adds a message and timestamp to a queue for Bessy to read"""
-        timestamp = local_clock()
-        self.__timestamps.append(timestamp)
-        self.__messages.append([message])
+        marker = parse_marker(message)
+        if marker is None:
+            console.log(f"[yellow]BessyInput: unknown marker {message!r}, dropped[/yellow]")
+            return
+        self.__queue.put(
+            local_clock(), marker.paradigm, marker.n_classes, marker.label, marker.duration
+        )
 
     """Implements MarkerSource.name property"""
     name = "BessyInput"
 
     def get_markers(self) -> tuple[list[list], list]:
         """Implements MarkerSource.get_markers()"""
-        self.__lsl_messenger.send_markers(self.__messages, self.__timestamps)
-        markers = [self.__messages, self.__timestamps]
-        self.__reset_queue()
-        return markers
+        records = self.__queue.drain()
+        if len(records) == 0:
+            return NO_MARKERS
+        messages = [
+            [marker_string(int(p), int(n), int(l), float(d))]
+            for p, n, l, d in zip(
+                records["paradigm"], records["n_classes"], records["label"], records["duration"]
+            )
+        ]
+        timestamps = records["timestamp"].tolist()
+        for listener in self.marker_listeners:
+            listener(records)
+        self.__lsl_messenger.send_markers(messages, timestamps)
+        return messages, timestamps
 
     def time_correction(self) -> float:
         """Implements MarkerSource.time_correction()"""
         return 0.0
-
-    def __reset_queue(self):
-        """Reset the queue"""
-        self.__messages = []
-        self.__timestamps = []
@@ -3,7 +3,8 @@ from bci_essentials.io.messenger import Messenger
 from bci_essentials.classification.generic_classifier import Prediction
 
 from .utils.helpers import console
-from .BessyLSLResponseMessenger import BessyLSLResponseMessenger
+from .utils.markers import Paradigm, parse_marker
+from .MarkerPublisher import MarkerPublisher
 from pylsl import local_clock
 
 
@@ -13,13 +14,53 @@ class BessyOutput(Messenger):
 
     """
 
-    def __init__(self, store, perform_training_step, process_prediction):
+    def __init__(
+        self,
+        store,
+        perform_training_step,
+        process_prediction,
+        process_prediction_series=None,
+        fast_process_prediction_series=None,
+    ):
         super().__init__()
         self.__ping_count = 0
         self.store = store
         self.perform_training_step = perform_training_step
         self.process_prediction = process_prediction
-        self.lsl_messenger = BessyLSLResponseMessenger()
+        self.process_prediction_series = process_prediction_series
+        # Called directly on the stepping thread, ahead of anything on the event loop
+        self.fast_process_prediction_series = fast_process_prediction_series
+        # Live data listeners, also called on the stepping thread so keep them cheap:
+        # eeg_listeners(samples, timestamps), probability_listeners(timestamps, probabilities)
+        self.eeg_listeners = []
+        self.probability_listeners = []
+        self.lsl_messenger = MarkerPublisher.shared().stream(
+            "Python_LSL_Response_Messenger"
+        )
+        self.__loop = None
+
+    def set_event_loop(self, loop: asyncio.AbstractEventLoop):
+        """Loop that callbacks are handed to when Bessy steps on a worker thread"""
+        self.__loop = loop
+
+    def __dispatch(self, callback: callable, *args):
+        """Run a callback on the event loop, regardless of which thread Bessy is
+        stepping on.  Coroutines are scheduled as tasks, plain functions are called."""
+        try:
+            asyncio.get_running_loop()
+            in_loop = True
+        except RuntimeError:
+            in_loop = False
+
+        if asyncio.iscoroutinefunction(callback):
+            if in_loop:
+                asyncio.create_task(callback(*args))
+            else:
+                asyncio.run_coroutine_threadsafe(callback(*args), self.__loop)
+        elif in_loop or self.__loop is None:
+            callback(*args)
+        else:
+            self.__loop.call_soon_threadsafe(callback, *args)
 
     # TODO - find a way to have Bessy class emit these instead of bessy.output.signal
     # bessy_ping_received = Signal(int)
@@ -32,45 +73,58 @@ class BessyOutput(Messenger):
         # self.bessy_ping_received.emit(self.__ping_count)
         self.store.set("ping_count", self.__ping_count)
 
+    def eeg(self, samples, timestamps):
+        """New EEG samples from this step, views that are only valid during the call"""
+        for listener in self.eeg_listeners:
+            listener(samples, timestamps)
+
     def marker_received(self, marker):
         """Implements Messenger.marker_received()"""
         # received format is the same as what's sent on input side:
         # "command_string" or "mi,label_count,label,window_length"
-        info = marker.split(",")
+        marker = parse_marker(marker)
 
         # handle mi marker reply, send when trial complete.  if the label
         # is -1, then this is a reply to a predcition request, which we ignore
-        if len(info) == 4:
-            label = int(info[2])
+        if marker is not None and marker.paradigm == Paradigm.MI:
+            label = marker.label
             if label >= 0:
                 console.log(f"[green]trial-complete: {label}[/green]")
-                asyncio.create_task(self.perform_training_step())
+                self.__dispatch(self.perform_training_step)
                 # asyncio.run(self.perform_training_step())
                 # self.store.set("trial_complete", label)
                 # self.trial_complete.emit(label)
 
-    def prediction(self, prediction: Prediction):
-        """Implements Messenger.prediction()"""
+    def prediction(self, prediction: Prediction, timestamps=None):
+        """Implements Messenger.prediction()
+
+        When timestamps are given, the prediction is a batch of sliding windows and
+        is handed to process_prediction_series(timestamps, labels, probabilities)
+        as a whole, instead of calling process_prediction() once per label.
+        """
+        if timestamps is not None:
+            self.__prediction_series(prediction, timestamps)
+            return
+
         # Prediction supports multiple predictions, organized as follows:
         # labels: list[int]               <--- predicted class labels
         # predictions: list[list[float]]  <--- probabilities of labels (one list per predicion)
 
-        # Send labels, predictions to BessyLSLMessenger
+        # Send labels, predictions to the response marker stream
         prediction_string = f"Labels: {prediction.labels}, Probabilities: {prediction.probabilities}"
         print(f"Prediction: {prediction_string}")
 
         # Make a string of labels and probabilities
         # labels = ",".join([str(label) for label in prediction.labels])
         self.lsl_messenger.send_markers([[prediction_string]], [local_clock()])
+        for listener in self.probability_listeners:
+            listener([local_clock()] * len(prediction.labels), prediction.probabilities)
 
         for label, probabilities in zip(prediction.labels, prediction.probabilities):
             # self.prediction_complete.emit(int(label), probabilities)
             # self.store.set("prediction_complete", (int(label), probabilities))
             try:
-                if asyncio.iscoroutinefunction(self.process_prediction):
-                    asyncio.create_task(self.process_prediction(label, probabilities))
-                else:
-                    self.process_prediction(label, probabilities)
+                self.__dispatch(self.process_prediction, label, probabilities)
                 # asyncio.run(self.process_prediction(label, probabilities))
             except ValueError:
                 # TODO - double check this; process_prediction(label, probabilities) doesn't always return a coroutine?
@@ -78,3 +132,24 @@ class BessyOutput(Messenger):
                 # print the error red
                 console.log(f"[red]{error_message}[/red]")
                 pass
+
+    def __prediction_series(self, prediction: Prediction, timestamps):
+        if self.fast_process_prediction_series is not None:
+            self.fast_process_prediction_series(
+                timestamps, prediction.labels, prediction.probabilities, local_clock()
+            )
+
+        for listener in self.probability_listeners:
+            listener(timestamps, prediction.probabilities)
+
+        # One LSL marker for the whole batch, stamped with the newest window
+        labels = ",".join(str(label) for label in prediction.labels)
+        self.lsl_messenger.send_markers([[f"Labels: [{labels}]"]], [timestamps[-1]])
+
+        if self.process_prediction_series is not None:
+            self.__dispatch(
+                self.process_prediction_series,
+                timestamps,
+                prediction.labels,
+                prediction.probabilities,
+            )
@@ -0,0 +1,96 @@
+import numpy as np
+from pyriemann.estimation import Covariances
+from sklearn.metrics import confusion_matrix, precision_score, recall_score
+
+from bci_essentials.classification.mi_classifier import MiClassifier
+
+from .utils.epoch_cache import EpochCache
+from .utils.helpers import console
+
+
+class CachedMiClassifier(MiClassifier):
+    """MiClassifier that computes each trial's covariance once and reuses it
+    across cross-validation folds and later retrains via an EpochCache.
+
+    MiClassifier.fit() recomputes the covariances of every trial in every fold,
+    here only trials that are new to the cache pay for it.  Channel selection is
+    left to MiClassifier, since it changes the channel set on every iteration.
+
+    trial_screen(labels), if set, returns which trials of each add_to_train()
+    block to keep, e.g. to leave out trials with artifacts.
+    """
+
+    def __init__(self, cache: EpochCache | None = None, settings: dict = {}, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache if cache is not None else EpochCache()
+        self.settings = settings  # preprocessing settings that produced the epochs
+        self.trial_screen = None
+
+    def __getstate__(self) -> dict:
+        # The epoch cache and trial screen belong to the Bessy session, they aren't
+        # saved with the model
+        return dict(self.__dict__, cache=None, trial_screen=None)
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.cache = EpochCache()
+
+    def add_to_train(self, decision_block, labels, num_options=0, meta=[]):
+        if getattr(self, "trial_screen", None) is not None:
+            keep = self.trial_screen(labels)
+            decision_block, labels = decision_block[keep], labels[keep]
+        super().add_to_train(decision_block, labels, num_options, meta)
+
+    def predict(self, X: np.ndarray):
+        n_predictions = len(self.predictions)
+        prediction = super().predict(X)
+        # Keep the history of trial predictions only, sliding windows would grow it
+        # by a batch every step for as long as prediction runs
+        if len(prediction.labels) > 1:
+            del self.predictions[n_predictions:]
+            del self.pred_probas[n_predictions:]
+        return prediction
+
+    def trial_covariances(self, X: np.ndarray) -> np.ndarray:
+        """Covariances of the trials in X, indexed by trial id (position in X)"""
+        settings = dict(self.settings, covariance_estimator=self.covariance_estimator)
+        estimator = Covariances(estimator=self.covariance_estimator)
+
+        covariances = []
+        for trial_id, epoch in enumerate(X):
+            key = EpochCache.key(trial_id, settings, self.channel_labels)
+            covariances.append(
+                self.cache.get_or_compute(
+                    key,
+                    "covariance",
+                    lambda: estimator.transform(epoch[np.newaxis])[0],
+                )
+            )
+        return np.array(covariances)
+
+    def fit(self):
+        if self.channel_selection_setup or self.subset:
+            return super().fit()
+
+        self.X = np.array(self.X)
+        n_trials = len(self.X)
+        self.next_fit_trial = n_trials
+        covariances = self.trial_covariances(self.X)
+
+        preds = np.zeros(n_trials)
+        for train_idx, test_idx in self.cv.split(covariances, self.y):
+            self.clf = self.clf_model
+            self.clf.fit(covariances[train_idx], self.y[train_idx])
+            preds[test_idx] = self.clf.predict(covariances[test_idx])
+
+        self.offline_trial_count = n_trials
+        self.offline_trial_counts.append(self.offline_trial_count)
+        self.offline_accuracy.append(sum(preds == self.y) / len(preds))
+        self.offline_precision.append(precision_score(self.y, preds, average="micro"))
+        self.offline_recall.append(recall_score(self.y, preds, average="micro"))
+        self.offline_cm = confusion_matrix(self.y, preds)
+
+        console.log(
+            f"[green]CachedMiClassifier: accuracy = {self.offline_accuracy[-1]}, "
+            f"cache hits/misses = {self.cache.hits}/{self.cache.misses}[/green]"
+        )
@@ -0,0 +1,139 @@
+import asyncio
+
+from pylsl import ContinuousResolver, StreamInfo
+
+from .EmotivEegSource import EmotivEegSource
+from .utils.helpers import console
+
+
+def stream_key(info: StreamInfo) -> str:
+    """Stable id of a stream, survives the headset reconnecting if it has a source_id"""
+    return info.source_id() or info.uid()
+
+
+def stream_metadata(info: StreamInfo) -> dict:
+    return {
+        "key": stream_key(info),
+        "name": info.name(),
+        "type": info.type(),
+        "fsample": info.nominal_srate(),
+        "n_channels": info.channel_count(),
+        "source_id": info.source_id(),
+        "hostname": info.hostname(),
+    }
+
+
+class EegStreamDiscovery:
+    """Keeps track of the LSL EEG streams on the network.
+
+    A single task polls a ContinuousResolver every interval seconds.  Streams
+    that appear or disappear are published on the store as "eeg-stream-added" /
+    "eeg-stream-removed" with their metadata, and "eeg_streams" and
+    "eeg_stream_is_available" are kept up to date.  LSL forgets a stream
+    forget_after seconds after it stops announcing itself, so a headset dropout
+    is noticed within a few seconds.
+
+    The client picks a stream with select(), otherwise the first one found is
+    used.  A discovery pinned to a stream_key (e.g. the headset of one station)
+    only ever uses that stream.  open_source() creates the EegSource for it on a worker thread with a
+    bounded timeout, so the event loop never waits on LSL.
+    """
+
+    def __init__(
+        self,
+        store,
+        stream_type: str = "EEG",
+        interval: float = 1.0,
+        forget_after: float = 3.0,
+        stream_key: str | None = None,
+    ):
+        self.store = store
+        self.interval = interval
+        self.streams: dict[str, StreamInfo] = {}
+        self.selected_key: str | None = stream_key
+        self.pinned = stream_key is not None
+
+        self.__resolver = ContinuousResolver("type", stream_type, forget_after=forget_after)
+        self.__task = None
+
+    @property
+    def selected(self) -> StreamInfo | None:
+        if self.selected_key in self.streams or self.pinned:
+            return self.streams.get(self.selected_key)
+        return next(iter(self.streams.values()), None)
+
+    def start(self):
+        """Start polling, must be called from the event loop"""
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    def select(self, key: str | None):
+        """Use the stream with this key for the next session, None for the first one"""
+        if self.pinned:
+            console.log(f"[yellow]EegStreamDiscovery: pinned to {self.selected_key}[/yellow]")
+            return
+        if key is not None and key not in self.streams:
+            console.log(f"[yellow]EegStreamDiscovery: unknown stream {key}[/yellow]")
+            return
+        self.selected_key = key
+        self.store.set("selected_eeg_stream", key)
+
+    async def refresh(self):
+        """Poll the resolver once and publish any changes"""
+        results = await asyncio.to_thread(self.__resolver.results)
+        found = {stream_key(info): info for info in results}
+
+        for key in self.streams.keys() - found.keys():
+            info = self.streams.pop(key)
+            console.log(f"[red]EEG stream lost: {info.name()} ({key})[/red]")
+            self.store.publish("eeg-stream-removed", stream_metadata(info))
+        for key in found.keys() - self.streams.keys():
+            self.streams[key] = found[key]
+            console.log(f"[green]EEG stream found: {found[key].name()} ({key})[/green]")
+            self.store.publish("eeg-stream-added", stream_metadata(found[key]))
+
+        self.store.set(
+            "eeg_streams", [stream_metadata(info) for info in self.streams.values()]
+        )
+        self.store.set("eeg_stream_is_available", len(self.streams) > 0)
+
+    async def open_source(self, timeout: float = 5.0, **kwargs) -> EmotivEegSource | None:
+        """EegSource for the selected stream, None if there is none within timeout
+        seconds.  kwargs are passed on to EmotivEegSource."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.selected is None and loop.time() < deadline:
+            await self.refresh()
+            if self.selected is None:
+                await asyncio.sleep(min(self.interval, max(0.0, deadline - loop.time())))
+
+        info = self.selected
+        if info is None:
+            console.log("[red]EegStreamDiscovery: no EEG stream available[/red]")
+            return None
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.to_thread(EmotivEegSource, info, timeout=timeout, **kwargs),
+                timeout,
+            )
+        except Exception as e:
+            console.log(f"[red]EegStreamDiscovery: could not open {info.name()}: {e}[/red]")
+            return None
+
+    async def __run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                console.log(f"[red]EegStreamDiscovery: refresh failed due to {e}[/red]")
+            await asyncio.sleep(self.interval)
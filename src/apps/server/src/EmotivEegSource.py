@@ -1,12 +1,169 @@
-from pylsl import StreamInfo, FOREVER
+import numpy as np
+from pylsl import StreamInfo, StreamInlet, FOREVER, proc_clocksync, proc_dejitter
 
-from bci_essentials.io.lsl_sources import LslEegSource
+from bci_essentials.io.sources import EegSource
+from bci_essentials.io.lsl_sources import discover_first_stream
 
+from .utils.ring_buffer import RingBuffer
+from .utils.channel_map import ChannelMap
+from .utils.stream_filter import StreamingFilter
+from .utils.signal_quality import SignalQualityMonitor
 
-class EmotivEegSource(LslEegSource):
-    def __init__(self, stream: StreamInfo = None, timeout: float = FOREVER):
-        super().__init__(stream, timeout)
+# numpy equivalents of the LSL channel formats, indexed by pylsl's cf_* constants
+LSL_CHANNEL_DTYPES = {
+    1: np.float32,
+    2: np.float64,
+    4: np.int32,
+    5: np.int16,
+    6: np.int8,
+    7: np.int64,
+}
+
+
+class EmotivEegSource(EegSource):
+    """EegSource that pulls EEG from an LSL inlet in bulk into a preallocated chunk
+    and keeps the most recent buffer_seconds of it in a RingBuffer.  Prediction
+    windows can be cut from the ring buffer as views with latest_window().
+
+    Timestamps are clock-synced and dejittered by LSL, so time_correction() is 0.
+
+    Only the EEG channels are kept (see ChannelMap, channels picks a subset by
+    label), sliced out of each chunk as it is pulled, so the non-EEG columns
+    never reach the buffer or the classifier.  With preprocessing
+    (StreamingFilter settings), every chunk is also filtered as it is pulled, so
+    the ring buffer, EegData's epochs and the prediction windows all hold
+    filtered EEG.
+
+    With quality (SignalQualityMonitor settings), the EEG channels of every
+    chunk also go through a SignalQualityMonitor before filtering, so flatlines,
+    line noise and saturation are measured on the signal as recorded.
+    """
+
+    def __init__(
+        self,
+        stream: StreamInfo = None,
+        timeout: float = FOREVER,
+        buffer_seconds: float = 60.0,
+        max_chunk_seconds: float = 1.0,
+        preprocessing: dict | None = None,
+        channels: list[str] | None = None,
+        quality: dict | None = None,
+    ):
+        try:
+            if stream is None:
+                stream = discover_first_stream("EEG", timeout=timeout)
+            self.__inlet = StreamInlet(
+                stream, processing_flags=proc_clocksync | proc_dejitter
+            )
+            self.__info = self.__inlet.info(timeout)
+        except Exception:
+            raise Exception("EmotivEegSource: could not create inlet")
+
+        fsample = self.fsample or 256
+        self.channel_map = ChannelMap(
+            self.__channel_properties("label"),
+            self.__channel_properties("type"),
+            self.__channel_properties("unit"),
+            include=channels,
+        )
+        self.preprocessing = preprocessing
+        self.filter = None
+        if preprocessing is not None:
+            self.filter = StreamingFilter(
+                fsample, self.channel_map.n_channels, **preprocessing
+            )
+
+        self.quality = None
+        if quality is not None:
+            self.quality = SignalQualityMonitor(fsample, self.channel_map.labels, **quality)
+
+        dtype = LSL_CHANNEL_DTYPES.get(self.__info.channel_format(), np.float32)
+        self.__max_chunk = max(1, int(fsample * max_chunk_seconds))
+        self.__chunk = np.zeros((self.__max_chunk, self.__info.channel_count()), dtype=dtype)
+        self.__eeg_chunk = np.zeros(
+            (self.__max_chunk, self.channel_map.n_channels), dtype=np.float32
+        )
+        self.buffer = RingBuffer(int(fsample * buffer_seconds), self.n_channels)
+
+    @property
+    def name(self) -> str:
+        return self.__info.name()
+
+    @property
+    def fsample(self) -> float:
+        return self.__info.nominal_srate()
+
+    @property
+    def n_channels(self) -> int:
+        if self.filter is not None:
+            return self.filter.n_outputs
+        return self.channel_map.n_channels
+
+    @property
+    def channel_types(self) -> list[str]:
+        return self.get_channel_properties("type")
+
+    @property
+    def channel_units(self) -> list[str]:
+        return self.get_channel_properties("unit")
 
     @property
     def channel_labels(self) -> list[str]:
         return self.get_channel_properties("label")
+
+    def get_samples(self) -> tuple[np.ndarray, np.ndarray]:
+        """Pull everything available into the ring buffer and return the new samples.
+        The returned arrays are views into the ring buffer."""
+        n_new = 0
+        while True:
+            _, timestamps = self.__inlet.pull_chunk(
+                timeout=0.0, max_samples=self.__max_chunk, dest_obj=self.__chunk
+            )
+            n = len(timestamps)
+            if n == 0:
+                break
+            chunk = self.channel_map.apply(self.__chunk[:n], self.__eeg_chunk[:n])
+            timestamps = np.asarray(timestamps)
+            if self.quality is not None:
+                self.quality.update(chunk, timestamps)
+            if self.filter is not None:
+                chunk = self.filter.process(chunk)
+            self.buffer.write(chunk, timestamps)
+            n_new += n
+            if n < self.__max_chunk:
+                break
+
+        return self.buffer.latest(min(n_new, self.buffer.capacity))
+
+    def latest_window(self, duration: float) -> tuple[np.ndarray, np.ndarray]:
+        """View of the newest duration seconds of EEG as (samples, timestamps)"""
+        return self.buffer.latest(int(duration * self.fsample))
+
+    def time_correction(self) -> float:
+        return 0.0
+
+    def get_channel_properties(self, property: str) -> list[str]:
+        properties = {
+            "label": self.channel_map.labels,
+            "type": self.channel_map.types,
+            "unit": self.channel_map.units,
+        }.get(property)
+        if properties is None:
+            properties = [
+                self.__channel_properties(property)[i] for i in self.channel_map.indices
+            ]
+        if self.filter is None:
+            return properties
+        if property == "label":
+            return self.filter.output_labels(properties)
+        return self.filter.output_properties(properties)
+
+    def __channel_properties(self, property: str) -> list[str]:
+        """property of every channel of the stream, before preprocessing"""
+        properties = []
+        descriptions = self.__info.desc().child("channels").child("channel")
+        for i in range(self.__info.channel_count()):
+            value = descriptions.child_value(property)
+            properties.append(value)
+            descriptions = descriptions.next_sibling()
+        return properties
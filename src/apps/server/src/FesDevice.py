@@ -1,50 +1,441 @@
 from serial.tools import list_ports
 from serial import Serial
+from pylsl import local_clock
 
+import time
+import queue
 import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+FES_BOX_PID = 29987
+
+
+@dataclass
+class FesLatency:
+    """Timestamps (LSL local_clock seconds) of one brain-to-muscle actuation"""
+
+    eeg_time: float | None
+    prediction_time: float | None
+    trigger_time: float
+    write_time: float
+
+    @property
+    def total(self) -> float | None:
+        """EEG sample to serial write"""
+        return None if self.eeg_time is None else self.write_time - self.eeg_time
+
+    def as_dict(self) -> dict:
+        def ms(start, end):
+            if start is None or end is None:
+                return None
+            return round((end - start) * 1000, 2)
+
+        return {
+            "eeg_to_prediction_ms": ms(self.eeg_time, self.prediction_time),
+            "prediction_to_write_ms": ms(self.prediction_time, self.write_time),
+            "trigger_to_write_ms": ms(self.trigger_time, self.write_time),
+            "total_ms": ms(self.eeg_time, self.write_time),
+        }
+
+
+@dataclass
+class FesCommand:
+    """One command for the FES box.
+
+    The future resolves with the reply line if expect_reply is set, otherwise with
+    the local_clock() time the command was written.  If no reply arrives within
+    timeout seconds of the write, the future fails with TimeoutError.  delay is the
+    spacing from the previous command when the command is part of a burst.
+    """
+
+    payload: bytes
+    expect_reply: bool = False
+    timeout: float = 1.0
+    delay: float = 0.0
+    future: Future = field(default_factory=Future)
+    latency: FesLatency | None = None
 
 
 class FesDevice:
-    def __init__(self):
+    """Serial connection to one FES box, owned by a dedicated I/O thread.
+
+    Commands are queued with send() / send_burst() from any thread (or awaited with
+    send_async() / send_burst_async() from the event loop) and written by the I/O
+    thread, so a swipe never blocks other requests.  The commands of a burst are
+    written back to back on their own schedule, replies are only collected after
+    the whole burst is out, so repeated stimulations don't wait on round trips.
+
+    The box is addressed by its USB serial number (or by port name if it has
+    none), so it is found again if it comes back on a different port.  While idle
+    the thread sends "?" health probes, and if the box stops answering it is
+    reopened with exponential backoff.
+
+    Each swipe is timestamped so the EEG -> prediction -> serial write latency can
+    be measured.
+    """
+
+    def __init__(
+        self,
+        serial_number: str | None = None,
+        port: str | None = None,
+        on_latency: callable = None,
+        health_interval: float = 5.0,
+        max_backoff: float = 30.0,
+    ):
+        self.serial_number = serial_number
+        self.port = port
+        self.on_latency = on_latency
+        self.health_interval = health_interval
+        self.max_backoff = max_backoff
+        self.latencies = deque(maxlen=100)
+
         self.__device: Serial | None = None
+        self.__requests = queue.Queue()
+        self.__thread = None
 
     def is_available(self) -> bool:
         return self.__device is not None
 
+    def start(self):
+        """Start the I/O thread, which opens the device in the background"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__thread = threading.Thread(
+            target=self.__run, name=f"FesDevice-{self.serial_number}", daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__requests.put(None)
+            self.__thread = None
+
+    def send(
+        self, payload: bytes, expect_reply: bool = False, timeout: float = 1.0
+    ) -> Future:
+        """Queue a single command, returns a Future for its acknowledgement"""
+        return self.send_burst([FesCommand(payload, expect_reply, timeout)])[0]
+
+    def send_burst(self, commands: list[FesCommand]) -> list[Future]:
+        """Queue commands to be written back to back, each delay seconds after the
+        previous one.  Returns a Future per command."""
+        self.start()
+        self.__requests.put(commands)
+        return [command.future for command in commands]
+
+    async def send_async(
+        self, payload: bytes, expect_reply: bool = False, timeout: float = 1.0
+    ):
+        return await asyncio.wrap_future(self.send(payload, expect_reply, timeout))
+
+    async def send_burst_async(self, commands: list[FesCommand]) -> list:
+        futures = [asyncio.wrap_future(f) for f in self.send_burst(commands)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    def trigger(self, eeg_time: float = None, prediction_time: float = None) -> Future:
+        """Queue a swipe, returns immediately.  Safe to call from any thread."""
+        latency = FesLatency(eeg_time, prediction_time, local_clock(), 0.0)
+        return self.send_burst([FesCommand(b"1", latency=latency)])[0]
+
     async def swipe(self):
-        # TODO - this will cause a delay on the first swipe, consider putting into
-        # a "connect" function.  Can't put into init unless we want that to be async.
-        if self.__device is None:
-            self.__device = await self.__find_fes_serial_device()
+        """Swipe and wait until the command has been written"""
+        try:
+            await asyncio.wrap_future(self.trigger())
+        except Exception as e:
+            print("FesDevice: swipe failed due to ", e)
 
-        # write to serial port to trigger swipe
-        if self.__device:
+    def __run(self):
+        backoff = 1.0
+        self.__device = self.__connect()
+        while True:
+            timeout = self.health_interval if self.__device else backoff
             try:
-                self.__device.write(b"1")
+                commands = self.__requests.get(timeout=timeout)
+            except queue.Empty:
+                if self.__device and not self.__probe(self.__device):
+                    print(f"FesDevice: {self.serial_number} stopped responding")
+                    self.__disconnect()
+                if self.__device is None:
+                    self.__device = self.__connect()
+                    backoff = 1.0 if self.__device else min(backoff * 2, self.max_backoff)
+                continue
+
+            if commands is None:
+                break
+            if self.__device is None:
+                self.__device = self.__connect()
+            self.__write_burst(commands)
 
+        self.__disconnect()
+        # Fail whatever was queued behind the stop request
+        while True:
+            try:
+                commands = self.__requests.get_nowait()
+            except queue.Empty:
+                break
+            for command in commands or []:
+                if not command.future.done():
+                    command.future.set_exception(ConnectionError("FesDevice stopped"))
+
+    def __write_burst(self, commands: list[FesCommand]):
+        if self.__device is None:
+            for command in commands:
+                command.future.set_exception(ConnectionError("FES Box not connected"))
+            return
+
+        # Write every command on schedule without waiting for replies in between
+        awaiting_reply = []
+        next_write = time.monotonic()
+        for i, command in enumerate(commands):
+            next_write += command.delay
+            pause = next_write - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+
+            try:
+                self.__device.write(command.payload)
             except Exception as e:
                 print("FesDevice: write failed due to ", e)
-                self.__device = None
+                self.__disconnect()
+                for failed in commands[i:]:
+                    failed.future.set_exception(e)
+                break
+
+            write_time = local_clock()
+            if command.latency is not None:
+                self.__record_latency(command.latency, write_time)
+            if command.expect_reply:
+                awaiting_reply.append(command)
+            else:
+                command.future.set_result(write_time)
+
+        # Replies come back in the order the commands were written.  Each timeout
+        # runs from when its reply is read, since replies may have queued up while
+        # the rest of the burst was written
+        for i, command in enumerate(awaiting_reply):
+            reply = self.__read_reply(time.monotonic() + command.timeout)
+            if reply is not None:
+                command.future.set_result(reply)
+                continue
+            # A late reply would be taken for the next command's, so drop whatever
+            # is buffered and fail the rest of the burst, their replies can't be
+            # told apart anymore
+            self.__reset_input()
+            for lost in awaiting_reply[i:]:
+                lost.future.set_exception(
+                    TimeoutError(f"FesDevice: no reply to {lost.payload!r}")
+                )
+            break
 
-    async def __find_fes_serial_device(self) -> Serial | None:
-        print("FesDevice: searching com ports")
+    def __read_reply(self, deadline: float) -> bytes | None:
+        while self.__device is not None and time.monotonic() < deadline:
+            try:
+                line = self.__device.readline()
+            except Exception as e:
+                print("FesDevice: read failed due to ", e)
+                self.__disconnect()
+                return None
+            if line:
+                return line.rstrip(b"\r\n")
+        return None
+
+    def __reset_input(self):
+        if self.__device is None:
+            return
+        try:
+            self.__device.reset_input_buffer()
+        except Exception as e:
+            print("FesDevice: reset failed due to ", e)
+            self.__disconnect()
+
+    def __record_latency(self, latency: FesLatency, write_time: float):
+        latency.write_time = write_time
+        self.latencies.append(latency)
+        if self.on_latency is not None:
+            self.on_latency(latency)
+
+    def __connect(self) -> Serial | None:
+        port = self.__find_port()
+        if port is None:
+            return None
+        device = FesDevice.open(port)
+        if device is not None:
+            device.timeout = 0.1
+            self.port = port
+            print(f"FesDevice: {self.serial_number} connected on {port}")
+        return device
+
+    @staticmethod
+    def open(port: str) -> Serial | None:
+        """Open port, None unless an FES box answers on it"""
+        try:
+            device = Serial(port, timeout=1.0, baudrate=115200)
+
+            # Need a bit of a delay for the device to connect
+            time.sleep(1.0)
+
+            if FesDevice.__probe(device):
+                return device
+            device.close()
+
+        except Exception as e:
+            print(f"FesDevice: {port} failed due to {e}")
+        return None
+
+    def __disconnect(self):
+        if self.__device:
+            try:
+                self.__device.close()
+            except Exception:
+                pass
+        self.__device = None
+
+    def __find_port(self) -> str | None:
+        if self.serial_number is None:
+            return self.port
+        for port in list_ports.comports():
+            if port.serial_number == self.serial_number:
+                return port.device
+        return None
+
+    @staticmethod
+    def __probe(device: Serial) -> bool:
+        """Ask the box to identify itself"""
+        try:
+            timeout = device.timeout
+            device.timeout = 1.0
+            device.reset_input_buffer()
+            device.write(b"?\r\n")
+            response = device.readline()
+            device.timeout = timeout
+            return response.startswith(b"FES_Box")
+        except Exception:
+            return False
+
+
+class FesDeviceManager:
+    """Discovers FES boxes in the background and keeps one FesDevice per box.
+
+    Boxes are addressed by USB serial number, trigger() without a serial number
+    goes to the first connected box.  A port is only taken for a box once it
+    answers the "?" probe, ports that don't are left alone until they are
+    unplugged and plugged back in.  Discovery is repeated every
+    discovery_interval seconds so boxes plugged in later are picked up.  With
+    serial_numbers, only those boxes are opened, so several managers (e.g. one
+    per session) can share a machine without fighting over the serial ports.
+    """
+
+    def __init__(
+        self,
+        on_latency: callable = None,
+        discovery_interval: float = 10.0,
+        serial_numbers: list[str] | None = None,
+    ):
+        self.on_latency = on_latency
+        self.discovery_interval = discovery_interval
+        self.serial_numbers = None if serial_numbers is None else set(serial_numbers)
+        self.devices: dict[str, FesDevice] = {}
+        self.__rejected: set[str] = set()  # ports that didn't answer the probe
+
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def is_available(self, serial_number: str | None = None) -> bool:
+        device = self.get(serial_number)
+        return device is not None and device.is_available()
+
+    def get(self, serial_number: str | None = None) -> FesDevice | None:
+        with self.__lock:
+            if serial_number is not None:
+                return self.devices.get(serial_number)
+            devices = list(self.devices.values())
+        return next((device for device in devices if device.is_available()), None)
+
+    def start(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(
+            target=self.__run, name="FesDeviceDiscovery", daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        with self.__lock:
+            for device in self.devices.values():
+                device.stop()
+
+    def trigger(
+        self,
+        eeg_time: float = None,
+        prediction_time: float = None,
+        serial_number: str | None = None,
+    ) -> Future | None:
+        device = self.get(serial_number)
+        if device is None:
+            print("FesDevice: FES Box not found")
+            return None
+        return device.trigger(eeg_time=eeg_time, prediction_time=prediction_time)
+
+    async def swipe(self, serial_number: str | None = None):
+        device = self.get(serial_number)
+        if device is None:
+            print("FesDevice: FES Box not found")
+            return
+        await device.swipe()
+
+    async def send_burst_async(
+        self, commands: list[FesCommand], serial_number: str | None = None
+    ) -> list:
+        """Pipeline a burst of commands to one box, see FesDevice.send_burst()"""
+        device = self.get(serial_number)
+        if device is None:
+            raise ConnectionError("FesDevice: FES Box not found")
+        return await device.send_burst_async(commands)
+
+    def discover(self):
+        """Start a FesDevice for every FES box that isn't managed yet"""
+        present = set()
         for port in list_ports.comports():
-            if port.pid == 29987:
-                try:
-                    print("FesDevice: trying candidate: ", port.name)
-                    device = Serial(port.name, timeout=1.0, baudrate=115200)
-
-                    # Need a bit of a delay for the device to connect
-                    await asyncio.sleep(1.0)
-
-                    device.write(b"?\r\n")
-                    response = device.readline()
-                    if response.startswith(b"FES_Box"):
-                        device.timeout = 0.1
-                        print("FesDevice: found!")
-                        return device
-                    device.close()
-
-                except Exception as e:
-                    print(f"FesDevice: {port.name} failed due to {e}")
-        print("FesDevice: FES Box not found")
+            if port.pid != FES_BOX_PID:
+                continue
+            if self.serial_numbers is not None and port.serial_number not in self.serial_numbers:
+                continue
+            key = port.serial_number or port.device
+            present.add(key)
+            with self.__lock:
+                if key in self.devices or key in self.__rejected:
+                    continue
+
+            # Other CH340 adapters share the FES box's USB ids, ask before taking it
+            print("FesDevice: found candidate: ", port.device)
+            serial = FesDevice.open(port.device)
+            if serial is None:
+                print(f"FesDevice: {port.device} is not an FES box")
+                self.__rejected.add(key)
+                continue
+            serial.close()
+
+            device = FesDevice(
+                serial_number=port.serial_number,
+                port=port.device,
+                on_latency=self.on_latency,
+            )
+            with self.__lock:
+                self.devices[key] = device
+            device.start()
+        # A rejected port is probed again once it has been unplugged
+        self.__rejected &= present
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            try:
+                self.discover()
+            except Exception as e:
+                print("FesDevice: discovery failed due to ", e)
+            self.__stop_event.wait(self.discovery_interval)
@@ -1,15 +1,19 @@
-import threading
+import os
+import json
+import time
 import asyncio
+import numpy as np
+from pylsl import local_clock
 
 from enum import Enum
 from dataclasses import dataclass
 
-# from pylsl import resolve_byprop
-from pylsl import ContinuousResolver
-
 from .Bessy import Bessy
-from .EmotivEegSource import EmotivEegSource
-from .FesDevice import FesDevice
+from .EegStreamDiscovery import EegStreamDiscovery, stream_key
+from .ModelRegistry import ModelRegistry
+from .ModelSelection import select_model
+from .FesDevice import FesDeviceManager, FesLatency
+from .PredictionScheduler import PredictionScheduler, ActionDetector
 
 from .utils.helpers import console
 
@@ -43,52 +47,183 @@ class FlickTokModel:
 
     eeg_stream_is_available = False
 
-    def __init__(self, store, sio):
+    def __init__(self, store, sio, fes_device=None, **settings):
+        """settings override the defaults below, e.g. eeg_stream_key="..." """
         super().__init__()
 
         self.store = store
         self.sio = sio
 
         # settings
-        self.eeg_scan_seconds = 20
+        # how often EegStreamDiscovery reads the ContinuousResolver's stream list,
+        # with its 3 s forget_after a headset dropout is noticed within ~4 s
+        self.eeg_scan_seconds = 1
+        # only use the EEG stream with this key (see EegStreamDiscovery), None for any
+        self.eeg_stream_key = None
+        # how long start_training waits for an EEG stream before giving up
+        self.eeg_open_timeout_seconds = 5
+        # causal band-pass / notch / common average applied to the EEG as it is
+        # ingested (see StreamingFilter), None to use the raw EEG
+        self.stream_filter = {"bands": [[8, 30]], "notch": 60, "order": 4}
+        # EEG channels to use by label, e.g. a deployment's electrode subset, None
+        # for every EEG channel of the stream
+        self.eeg_channels = None
+        # per-channel variance, line noise, flatline and saturation of the ingested
+        # EEG (see SignalQualityMonitor settings), None to turn the monitor off
+        self.signal_quality = {}
+        # training trials with artifacts are left out and repeated, up to this many
+        self.max_rejected_trials = 5
         self.preroll_seconds = 1
         self.rest_seconds = 2
         self.action_seconds = 2
         self.number_of_trials = 20
+        # "online" updates the classifier every trial, "batch" refits at the end
+        self.training_mode = "online"
         self.prediction_seconds = 2
         self.prediction_rest_seconds = 7
-
+        # the action is detected once its probability has reached the on threshold
+        # and stayed above the off threshold for the dwell time (of EEG)
+        self.prediction_on_threshold = 0.6
+        self.prediction_off_threshold = 0.5
+        self.prediction_dwell_seconds = 0.1
+        # how much longer than prediction_seconds to wait for a requested prediction
+        self.prediction_timeout_seconds = 2
+        # classify a prediction_seconds window every sliding_step_seconds while in
+        # the action state, instead of one marker-triggered prediction at a time
+        self.use_sliding_prediction = True
+        self.sliding_step_seconds = 0.1
+        # the step is widened up to this when the classifier can't keep up
+        self.max_sliding_step_seconds = 0.5
+        # trigger FES straight from Bessy's step thread when a sliding window
+        # detects the action, instead of going through the event loop first
+        self.use_fast_fes_trigger = True
+        # serial number of the FES box to stimulate, None uses the first one found
+        self.fes_serial_number = None
+        # False opens no FES box at all, e.g. for a session that isn't tied to one
+        self.use_fes = True
+        # stream each session's EEG, markers and predictions to recordings_path
+        self.record_sessions = True
+        self.recordings_path = "recordings"
+        # after training, cross-validate a grid of classifiers, bands and windows
+        # on the trials on a process pool and predict with the best one
+        self.use_model_selection = False
+        self.model_selection_timeout_seconds = 30
+        # save trained classifiers per user and headset, and start predicting with
+        # the latest one when there was no training since the server started
+        self.user_id = "default"
+        self.models_path = "models"
+        self.save_models = True
+        self.warm_start = True
+
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError(f"FlickTokModel: unknown setting {name}")
+            setattr(self, name, value)
+
+        self.__initialize_models()
         self.__initialize_eeg_scanning()
-        self.__initialize_fes_device()
+        self.__initialize_fes_device(fes_device)
         self.__initialize_bessy()
 
+    @property
+    def bessy(self) -> Bessy:
+        return self.__bessy
+
+    @property
+    def eeg_streams(self) -> EegStreamDiscovery:
+        return self.__eeg_streams
+
+    @property
+    def models(self) -> ModelRegistry:
+        return self.__models
+
+    def __initialize_models(self):
+        # Only the index is read here, models are loaded when their headset shows up
+        self.__models = ModelRegistry(self.models_path)
+        self.__headset = None
+        self.store.subscribe("eeg-stream-added", self.__on_eeg_stream_added)
+
+    def __on_eeg_stream_added(self, stream: dict):
+        if self.warm_start:
+            self.__models.prefetch(self.user_id, stream["key"])
+
     def __initialize_eeg_scanning(self):
-        self.__eeg_stream_resolver = ContinuousResolver("type", "EEG")
-        self.eeg_scan_timer = threading.Timer(
-            self.eeg_scan_seconds, self.__check_for_eeg_streams
+        # Polling starts with start_eeg_scanning() once the event loop is running
+        self.__eeg_streams = EegStreamDiscovery(
+            self.store, interval=self.eeg_scan_seconds, stream_key=self.eeg_stream_key
         )
-        self.eeg_scan_timer.start()
+        self.store.on_change("eeg_stream_is_available", self.__on_eeg_availability)
+
+    def start_eeg_scanning(self):
+        self.__eeg_streams.start()
 
-    def __check_for_eeg_streams(self):
-        # streams = resolve_byprop("type", "EEG", 0, 0.1)
-        streams = self.__eeg_stream_resolver.results()
-        self.eeg_stream_is_available = len(streams) > 0
-        self.store.set("eeg_stream_is_available", self.eeg_stream_is_available)
-        # Restart the timer for continuous checking. Removing this for now, to stop the recursion error.
-        # self.__initialize_eeg_scanning()
+    async def close(self):
+        """Stop everything this model runs: Bessy, EEG scanning and the FES boxes"""
+        if self.__scheduler is not None:
+            await self.__scheduler.stop()
+        self.__prediction_state = PredictionState.Stop
+        self.__training_state = TrainingState.Stop
+        await self.__bessy.stop_eeg_processing()
+        # Closing the recorder joins its writer thread, keep the loop free meanwhile
+        await asyncio.to_thread(self.__bessy.stop_recording)
+        await self.__eeg_streams.stop()
+        self.__fes_device.stop()
+
+    def __on_eeg_availability(self, payload):
+        self.eeg_stream_is_available = payload.get("value")
+
+    def __initialize_fes_device(self, fes_device=None):
+        # Discover and open devices in the background now so the first swipe
+        # doesn't wait on it
+        if fes_device is None:
+            if not self.use_fes:
+                serial_numbers = []
+            elif self.fes_serial_number is None:
+                serial_numbers = None
+            else:
+                serial_numbers = [self.fes_serial_number]
+            fes_device = FesDeviceManager(
+                on_latency=self.__on_fes_latency, serial_numbers=serial_numbers
+            )
+        self.__fes_device = fes_device
+        self.__fes_device.start()
 
-    def __initialize_fes_device(self):
-        self.__fes_device = FesDevice()
+    def __on_fes_latency(self, latency: FesLatency):
+        # Called from the FES actuation thread
+        timings = latency.as_dict()
+        console.log(f"[cyan]fes-latency: {timings}[/cyan]")
+        self.store.set("fes_latency", timings)
 
     async def perform_fes_swipe(self):
-        await self.__fes_device.swipe()
+        await self.__fes_device.swipe(self.fes_serial_number)
 
     async def start_training(self):
-        # Initialize Bessy and connect an Eeg source (note - init freezes if stream not available).
-        # TODO - place a guard here to cancel training if EEG stream not available.
+        # Initialize Bessy and connect an Eeg source for the selected stream
         # TODO - replace EmotivEegSource with whatever we're using for FlickTok
-        self.__bessy.connect_eeg_source(EmotivEegSource())
+        eeg_source = await self.__eeg_streams.open_source(
+            self.eeg_open_timeout_seconds,
+            preprocessing=self.stream_filter,
+            channels=self.eeg_channels,
+            quality=self.signal_quality,
+        )
+        if eeg_source is None:
+            console.log("[red]start-training: no EEG stream, training cancelled[/red]")
+            self.__training_state = TrainingState.Stop
+            await self.__send_training_status()
+            return
+        # Drop a warm started classifier, this session trains a new one
+        if self.__scheduler is not None:
+            await self.__scheduler.stop()
+        await self.__bessy.stop_eeg_processing()
+        await asyncio.to_thread(self.__bessy.stop_recording)
+        self.__headset = stream_key(self.__eeg_streams.selected)
+        self.__bessy.connect_eeg_source(eeg_source)
+        self.__bessy.training_mode = self.training_mode
+        self.__bessy.reject_artifact_trials = self.signal_quality is not None
         self.__bessy.start_eeg_processing()
+        if self.record_sessions:
+            session = time.strftime("%Y%m%d-%H%M%S")
+            self.__bessy.start_recording(os.path.join(self.recordings_path, session))
         self.__bessy.start_training_session()
 
         # Kick off state machine that runs training sequence
@@ -97,8 +232,11 @@ class FlickTokModel:
         await self.__perform_training_step()
 
     async def stop_training(self):
+        if self.__scheduler is not None:
+            await self.__scheduler.stop()
         self.__training_state = TrainingState.Stop
-        self.__bessy.stop_eeg_processing()
+        await self.__bessy.stop_eeg_processing()
+        await asyncio.to_thread(self.__bessy.stop_recording)
         await self.__send_training_status()
 
     async def start_async_fn_with_delay(self, fn, delay_seconds):
@@ -124,7 +262,8 @@ class FlickTokModel:
                 )
 
             case TrainingState.Rest:
-                if self.__trial_count < self.number_of_trials:
+                n_trials = self.number_of_trials + await self.__requeued_trials()
+                if self.__trial_count < n_trials:
                     self.__trial_count += 1
                     await self.__send_training_status()
                     self.__bessy.mark_trial(
@@ -136,6 +275,9 @@ class FlickTokModel:
                     await self.__send_training_status()
                     self.__bessy.end_training_session()
                     self.__bessy.train_classifier()
+                    self.__after_training = asyncio.create_task(
+                        self.__process_trained_classifier()
+                    )
 
             case TrainingState.Action:
                 await self.__send_training_status()
@@ -144,6 +286,103 @@ class FlickTokModel:
                 )
                 self.__training_state = TrainingState.Rest
 
+    async def __requeued_trials(self) -> int:
+        """Rest / action pairs added to the session to make up for rejected trials.
+        In batch mode trials are only screened when training ends, so they are
+        left out but not repeated."""
+        if self.training_mode != "online":
+            return 0
+        # The trial that just completed is screened right after it is reported
+        while self.__bessy.pending_trials and self.__training_state == TrainingState.Rest:
+            await asyncio.sleep(0.01)
+        rejected = self.__bessy.rejected_trials
+        if rejected >= self.max_rejected_trials and self.__bessy.reject_artifact_trials:
+            console.log(
+                f"[yellow]{rejected} trials rejected, keeping the remaining trials "
+                f"regardless of artifacts[/yellow]"
+            )
+            self.__bessy.reject_artifact_trials = False
+        return min(rejected, self.max_rejected_trials)
+
+    async def __on_trial_rejected(self, trial: dict):
+        await self.sio.emit("fromPython", {"id": "trial-rejected", "data": trial})
+
+    async def __process_trained_classifier(self):
+        # The trials are complete once Bessy has trained on them
+        while not self.__bessy.is_trained:
+            if self.__training_state != TrainingState.Complete:
+                return
+            await asyncio.sleep(0.1)
+        await self.__save_classifier()
+        if not self.use_model_selection:
+            return
+
+        trials = self.__bessy.trials()
+        if trials is None:
+            return
+        classifier = await asyncio.to_thread(
+            select_model,
+            *trials,
+            self.__bessy.fsample,
+            timeout=self.model_selection_timeout_seconds,
+        )
+        if classifier is not None and self.__bessy.is_trained:
+            self.__bessy.promote_classifier(classifier)
+            self.store.set(
+                "model_selection",
+                {"candidate": str(classifier.candidate), "accuracy": classifier.accuracy},
+            )
+            await self.__save_classifier(accuracy=classifier.accuracy)
+
+    async def __save_classifier(self, **metadata):
+        source = self.__bessy.eeg_source
+        if not self.save_models or source is None or self.__headset is None:
+            return
+        try:
+            await asyncio.to_thread(
+                self.__models.save,
+                self.user_id,
+                self.__headset,
+                self.__bessy.classifier,
+                source.channel_labels,
+                source.fsample,
+                self.__preprocessing_settings(),
+                n_trials=self.__trial_count,
+                **metadata,
+            )
+        except Exception as e:
+            console.log(f"[red]ModelRegistry: could not save the classifier: {e}[/red]")
+
+    def __preprocessing_settings(self) -> dict:
+        # As the registry's JSON index will give them back, to compare on warm start
+        settings = dict(self.__bessy.preprocessing, stream_filter=self.stream_filter)
+        return json.loads(json.dumps(settings))
+
+    async def __warm_start(self) -> bool:
+        """Start Bessy with the latest saved classifier for the selected headset"""
+        eeg_source = await self.__eeg_streams.open_source(
+            self.eeg_open_timeout_seconds,
+            preprocessing=self.stream_filter,
+            channels=self.eeg_channels,
+            quality=self.signal_quality,
+        )
+        if eeg_source is None:
+            return False
+        self.__headset = stream_key(self.__eeg_streams.selected)
+        record = self.__models.latest(self.user_id, self.__headset)
+        if record is None or record.settings != self.__preprocessing_settings():
+            console.log(f"[yellow]No saved classifier for {self.__headset}[/yellow]")
+            return False
+        classifier = await asyncio.to_thread(
+            self.__models.load, record, eeg_source.channel_labels
+        )
+        if classifier is None:
+            return False
+        self.__bessy.connect_eeg_source(eeg_source)
+        self.__bessy.start_eeg_processing(classifier)
+        console.log(f"[green]Warm started with {record.file}[/green]")
+        return True
+
     async def __send_training_status(self):
         status = TrainingStatus(self.__training_state, self.__trial_count)
         console.log("[purple]set-training-status[/purple]")
@@ -164,60 +403,80 @@ class FlickTokModel:
     # action_detected = Signal(bool)
 
     async def start_predicting(self):
-        # Kick off state machine that starts prediction sequence
-        self.__prediction_state = PredictionState.Rest
-        await self.__perform_prediction_step()
+        # Without a session since the server started, predict with a saved classifier
+        if not self.__bessy.is_processing:
+            if not (self.warm_start and await self.__warm_start()):
+                console.log("[red]start-predicting: no trained classifier[/red]")
+                self.__prediction_state = PredictionState.Stop
+                await self.__send_prediction_status()
+                return
+        if self.__scheduler is not None and self.__scheduler.is_running:
+            return
+        # The rest / action cycle runs as a task of its own, stop_predicting() cancels it
+        self.__scheduler = PredictionScheduler(
+            self.__bessy,
+            TrainingLabels.Action.value,
+            on_state=self.__on_prediction_state,
+            on_detection=self.__on_action_detected,
+            trigger=self.__trigger_fes if self.use_fast_fes_trigger else None,
+            detector=ActionDetector(
+                self.prediction_on_threshold,
+                self.prediction_off_threshold,
+                self.prediction_dwell_seconds,
+            ),
+            rest_seconds=self.prediction_rest_seconds,
+            window_seconds=self.prediction_seconds,
+            use_sliding_windows=self.use_sliding_prediction,
+            step_seconds=self.sliding_step_seconds,
+            max_step_seconds=self.max_sliding_step_seconds,
+            timeout_seconds=self.prediction_timeout_seconds,
+        )
+        self.__scheduler.start()
 
     async def stop_predicting(self):
+        if self.__scheduler is not None:
+            await self.__scheduler.stop()
         self.__prediction_state = PredictionState.Stop
         await self.__send_prediction_status()
 
-    async def __perform_prediction_step(self):
-        # This state machine transitions from rest to action state where it will periodically
-        # ask Bessy for predicitons.  It will stay in the action state until Bessy predicts the
-        # action label.  Bessy provides predictions via the prediction_complete signal which
-        # is processed by by __process_prediction() below
-        while True:
-            match self.__prediction_state:
-                case PredictionState.Rest:
-                    await self.__send_prediction_status()
-                    self.__prediction_state = PredictionState.Action
-                    await asyncio.sleep(self.prediction_rest_seconds)
-                    # await self.start_async_fn_with_delay(
-                    #     self.__perform_prediction_step, self.rest_seconds
-                    # )
-                    # self.start_fn_with_delay(
-                    #     self.__perform_prediction_step, self.rest_seconds
-                    # )
-                    # QTimer.singleShot(self.rest_seconds * 1000, self.__perform_prediction_step)
-
-                case PredictionState.Action:
-                    await self.__send_prediction_status()
-                    self.__bessy.make_prediction(self.prediction_seconds)
-                    await asyncio.sleep(self.action_seconds+2)
-                    # Let's make sure that the prediction is done before we go back to rest
-                    if self.__prediction_state == PredictionState.Rest:
-                        continue
-                    # await self.start_async_fn_with_delay(
-                    #     self.__perform_prediction_step, self.action_seconds
-                    # )
-                    # self.start_fn_with_delay(
-                    #     self.__perform_prediction_step, self.action_seconds
-                    # )
-                    # QTimer.singleShot(self.action_seconds * 1000, self.__perform_prediction_step)
-
-                case PredictionState.Stop:
-                    break
+    async def __on_prediction_state(self, name: str):
+        self.__prediction_state = getattr(PredictionState, name.capitalize())
+        await self.__send_prediction_status()
 
-    async def __process_prediction(self, label: int, probabilities: list):
-        if label == TrainingLabels.Action.value:
-            # self.action_detected.emit(True)
-            # self.store.emit("action_detected", True)
+    async def __on_action_detected(self, eeg_time: float):
+        console.log(f"[green]action detected at {eeg_time:.3f}[/green]")
+        if not self.use_fast_fes_trigger:
             await self.perform_fes_swipe()
-            await self.sio.emit(
-                "fromPython", {"id": "action-detected", "data": {"value": True}}
-            )
-            self.__prediction_state = PredictionState.Rest
+        await self.__send_action_detected()
+
+    def __trigger_fes(self, eeg_time: float, prediction_time: float):
+        # Called where the prediction arrives, e.g. on Bessy's step thread, so the
+        # FES fires before the event loop even hears about the detection
+        self.__fes_device.trigger(
+            eeg_time=eeg_time,
+            prediction_time=prediction_time,
+            serial_number=self.fes_serial_number,
+        )
+
+    async def __process_prediction(self, label: int, probabilities: list):
+        if self.__scheduler is not None:
+            self.__scheduler.on_prediction(probabilities)
+
+    async def __send_action_detected(self):
+        await self.sio.emit(
+            "fromPython", {"id": "action-detected", "data": {"value": True}}
+        )
+
+    def __fast_process_prediction_series(
+        self, timestamps, labels, probabilities, prediction_time
+    ):
+        # Runs on Bessy's step thread
+        if self.use_fast_fes_trigger and self.__scheduler is not None:
+            self.__scheduler.on_prediction_series(timestamps, probabilities, prediction_time)
+
+    async def __process_prediction_series(self, timestamps, labels, probabilities):
+        if not self.use_fast_fes_trigger and self.__scheduler is not None:
+            self.__scheduler.on_prediction_series(timestamps, probabilities, local_clock())
 
     async def __send_prediction_status(self):
         # self.prediction_status_changed.emit(self.__prediction_state)
@@ -240,6 +499,8 @@ class FlickTokModel:
         )
 
     def __initialize_bessy(self):
+        self.__scheduler = None
+        self.__after_training = None
         self.__trial_count = 0
         self.__training_state = TrainingState.Stop
         self.__prediction_state = PredictionState.Stop
@@ -248,7 +509,10 @@ class FlickTokModel:
             store=self.store,
             perform_training_step=self.__perform_training_step,
             process_prediction=self.__process_prediction,
+            process_prediction_series=self.__process_prediction_series,
+            fast_process_prediction_series=self.__fast_process_prediction_series,
         )
+        self.store.subscribe("trial-rejected", self.__on_trial_rejected)
         # self.store.subscribe(
         #     "trial_complete",
         #     lambda payload: self.__perform_training_step(),
@@ -0,0 +1,134 @@
+import queue
+import threading
+
+from pylsl import StreamInfo, StreamOutlet
+
+from .utils.helpers import console
+
+
+class MarkerStream:
+    """Handle to one LSL marker stream of the MarkerPublisher.
+
+    send_markers() only queues the markers, they are pushed by the publisher's
+    thread.  If the outlet couldn't be created the stream is a no-op sink.
+    """
+
+    def __init__(self, publisher, name: str, outlet: StreamOutlet | None):
+        self.name = name
+        self.outlet = outlet
+        self.__publisher = publisher
+
+    @property
+    def is_available(self) -> bool:
+        return self.outlet is not None
+
+    def send_markers(self, markers: list[list], timestamps: list):
+        """Publish the array of markers (each marker is an array) along with the corresponding timestamps"""
+        if self.outlet is not None and len(markers) > 0:
+            self.__publisher.queue(self, markers, timestamps)
+
+
+class MarkerPublisher:
+    """Owns one LSL outlet per marker stream for the whole process and pushes
+    markers from a background thread, so LSL I/O never runs on the caller's
+    thread (e.g. inside EegData.step()).  Markers queued for a stream between two
+    wake-ups of the thread go out in one push_chunk().
+    """
+
+    __shared = None
+    __shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> "MarkerPublisher":
+        with cls.__shared_lock:
+            if cls.__shared is None:
+                cls.__shared = cls()
+            return cls.__shared
+
+    def __init__(self):
+        self.streams: dict[str, MarkerStream] = {}
+        self.__lock = threading.Lock()
+        self.__requests = queue.SimpleQueue()
+        self.__thread = None
+
+    def stream(
+        self,
+        name: str,
+        type: str = "LSL_Marker_Strings",
+        channel_format: str = "string",
+    ) -> MarkerStream:
+        """The stream called name, its outlet is created on first use"""
+        with self.__lock:
+            if name not in self.streams:
+                self.streams[name] = MarkerStream(
+                    self, name, self.__create_outlet(name, type, channel_format)
+                )
+            return self.streams[name]
+
+    def queue(self, stream: MarkerStream, markers: list[list], timestamps: list):
+        self.__start()
+        self.__requests.put((stream, markers, timestamps))
+
+    def flush(self, timeout: float = 1.0) -> bool:
+        """Wait until everything queued so far has been pushed"""
+        done = threading.Event()
+        self.__start()
+        self.__requests.put(done)
+        return done.wait(timeout)
+
+    def __start(self):
+        if self.__thread is not None:
+            return
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="MarkerPublisher", daemon=True
+                )
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            requests = [self.__requests.get()]
+            while not self.__requests.empty():
+                requests.append(self.__requests.get())
+
+            # One chunk per stream, in the order the markers were queued
+            chunks: dict[MarkerStream, tuple[list, list]] = {}
+            for request in requests:
+                if isinstance(request, threading.Event):
+                    self.__push(chunks)
+                    chunks = {}
+                    request.set()
+                    continue
+                stream, markers, timestamps = request
+                chunk = chunks.setdefault(stream, ([], []))
+                chunk[0].extend(markers)
+                chunk[1].extend(timestamps)
+            self.__push(chunks)
+
+    @staticmethod
+    def __push(chunks: dict):
+        for stream, (markers, timestamps) in chunks.items():
+            try:
+                stream.outlet.push_chunk(markers, timestamps)
+            except Exception as e:
+                console.log(f"[red]MarkerPublisher: {stream.name} push failed due to {e}[/red]")
+
+    @staticmethod
+    def __create_outlet(name: str, type: str, channel_format: str) -> StreamOutlet | None:
+        try:
+            info = StreamInfo(
+                name=name,
+                type=type,
+                channel_count=1,
+                nominal_srate=0,
+                channel_format=channel_format,
+                source_id=f"FlickTok_{name}",
+            )
+            outlet = StreamOutlet(info)
+            if channel_format == "string":
+                outlet.push_sample([f"{name} is now sending markers to LSL"])
+            return outlet
+        except Exception as e:
+            console.log(f"[red]MarkerPublisher: failed to create {name} stream: {e}[/red]")
+            return None
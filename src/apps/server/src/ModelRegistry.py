@@ -0,0 +1,206 @@
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import threading
+from dataclasses import dataclass, asdict, field
+
+from .utils.helpers import console
+
+INDEX_FILE = "index.json"
+
+
+@dataclass
+class ModelRecord:
+    """Index entry of a saved classifier"""
+
+    user: str
+    headset: str
+    version: int
+    file: str  # relative to the registry path
+    sha256: str
+    size: int
+    created: float
+    classifier: str  # class name, for listing without unpickling
+    channel_labels: list[str]
+    fsample: float
+    settings: dict = field(default_factory=dict)  # preprocessing settings
+    metadata: dict = field(default_factory=dict)  # accuracy, n_trials, ...
+
+    @property
+    def key(self) -> tuple[str, str, int]:
+        return (self.user, self.headset, self.version)
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name) or "_"
+
+
+class ModelRegistry:
+    """Versioned store of trained classifiers, keyed by user and headset.
+
+    Each save() pickles the classifier to path/<user>/<headset>/v<version>-<hash>.pkl
+    and records its sha256, channel labels, sample rate and preprocessing settings
+    in path/index.json.  Both are written to a temporary file, fsynced and renamed,
+    so a crash never leaves a half-written model in the index.
+
+    Creating a registry only reads the index.  A model is unpickled the first
+    time it is loaded (after checking its size and hash) and kept in memory, and
+    prefetch() does that on a background thread, e.g. as soon as a headset
+    shows up, so the model is ready by the time prediction starts.
+    """
+
+    def __init__(self, path: str = "models", keep_versions: int = 5):
+        self.path = path
+        self.keep_versions = keep_versions
+        self.__lock = threading.Lock()
+        self.__loaded: dict[tuple, object] = {}
+        self.__records: list[ModelRecord] = self.__read_index()
+
+    def records(self, user: str = None, headset: str = None) -> list[ModelRecord]:
+        """Index entries, oldest version first"""
+        with self.__lock:
+            return [
+                record
+                for record in self.__records
+                if (user is None or record.user == user)
+                and (headset is None or record.headset == headset)
+            ]
+
+    def latest(self, user: str, headset: str) -> ModelRecord | None:
+        records = self.records(user, headset)
+        return records[-1] if records else None
+
+    def save(
+        self,
+        user: str,
+        headset: str,
+        classifier,
+        channel_labels: list[str],
+        fsample: float,
+        settings: dict = None,
+        **metadata,
+    ) -> ModelRecord:
+        """Store classifier as the next version for user and headset"""
+        data = pickle.dumps(classifier, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha256(data).hexdigest()
+        with self.__lock:
+            previous = [r for r in self.__records if (r.user, r.headset) == (user, headset)]
+            version = previous[-1].version + 1 if previous else 1
+            record = ModelRecord(
+                user=user,
+                headset=headset,
+                version=version,
+                file=os.path.join(
+                    _safe_name(user), _safe_name(headset), f"v{version}-{digest[:12]}.pkl"
+                ),
+                sha256=digest,
+                size=len(data),
+                created=time.time(),
+                classifier=type(classifier).__name__,
+                channel_labels=list(channel_labels),
+                fsample=float(fsample),
+                settings=dict(settings or {}),
+                metadata=metadata,
+            )
+            self.__write_atomic(os.path.join(self.path, record.file), data)
+            self.__records.append(record)
+            self.__loaded[record.key] = classifier
+
+            # Drop the oldest versions beyond keep_versions
+            expired = (previous + [record])[: -self.keep_versions]
+            for old in expired:
+                self.__records.remove(old)
+                self.__loaded.pop(old.key, None)
+            self.__write_index()
+        for old in expired:
+            try:
+                os.remove(os.path.join(self.path, old.file))
+            except OSError:
+                pass
+
+        console.log(
+            f"[green]ModelRegistry: saved {record.classifier} for {user} / {headset} "
+            f"as v{version} ({record.size} bytes)[/green]"
+        )
+        return record
+
+    def load(self, record: ModelRecord, channel_labels: list[str] = None):
+        """Classifier of record, None if its file is missing or corrupt or it was
+        trained on other channels than channel_labels"""
+        if channel_labels is not None and list(channel_labels) != record.channel_labels:
+            console.log(
+                f"[yellow]ModelRegistry: {record.user} / {record.headset} v{record.version} "
+                f"was trained on other channels, not loading it[/yellow]"
+            )
+            return None
+
+        with self.__lock:
+            if record.key in self.__loaded:
+                return self.__loaded[record.key]
+
+        started = time.perf_counter()
+        try:
+            with open(os.path.join(self.path, record.file), "rb") as file:
+                data = file.read()
+        except OSError as e:
+            console.log(f"[red]ModelRegistry: could not read {record.file}: {e}[/red]")
+            return None
+        if len(data) != record.size or hashlib.sha256(data).hexdigest() != record.sha256:
+            console.log(f"[red]ModelRegistry: {record.file} failed its integrity check[/red]")
+            return None
+        try:
+            # The hash only guards against corruption, the registry directory must
+            # not be writable by anyone who shouldn't run code on this machine
+            classifier = pickle.loads(data)
+        except Exception as e:
+            console.log(f"[red]ModelRegistry: could not unpickle {record.file}: {e}[/red]")
+            return None
+
+        with self.__lock:
+            self.__loaded[record.key] = classifier
+        console.log(
+            f"[blue]ModelRegistry: loaded {record.file} in "
+            f"{(time.perf_counter() - started) * 1000:.1f} ms[/blue]"
+        )
+        return classifier
+
+    def prefetch(self, user: str, headset: str) -> threading.Thread | None:
+        """Load the latest model of user and headset on a background thread"""
+        record = self.latest(user, headset)
+        if record is None:
+            return None
+        thread = threading.Thread(
+            target=self.load, args=(record,), name="ModelRegistryPrefetch", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def __read_index(self) -> list[ModelRecord]:
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as file:
+                index = json.load(file)
+            return [ModelRecord(**entry) for entry in index["models"]]
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            console.log(f"[red]ModelRegistry: ignoring unreadable index: {e}[/red]")
+            return []
+
+    def __write_index(self):
+        index = {"version": 1, "models": [asdict(record) for record in self.__records]}
+        self.__write_atomic(
+            os.path.join(self.path, INDEX_FILE), json.dumps(index, indent=2).encode()
+        )
+
+    @staticmethod
+    def __write_atomic(file_name: str, data: bytes):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temporary = file_name + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, file_name)
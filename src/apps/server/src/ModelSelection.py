@@ -0,0 +1,241 @@
+import os
+import time
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.signal import butter, sosfiltfilt
+from pyriemann.estimation import Covariances
+from pyriemann.classification import MDM
+from pyriemann.tangentspace import TangentSpace
+from sklearn.pipeline import make_pipeline
+from sklearn.linear_model import LogisticRegression
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.model_selection import StratifiedKFold
+
+from bci_essentials.classification.generic_classifier import (
+    GenericClassifier,
+    Prediction,
+)
+
+from .utils.helpers import console
+
+
+@dataclass(frozen=True)
+class Candidate:
+    """One point of the search grid.
+
+    classifier is "TS" (tangent space + logistic regression, regularisation is
+    C), "TS-LDA" (tangent space + shrinkage LDA, regularisation is the
+    shrinkage) or "MDM" (minimum distance to mean, no regularisation).  band is
+    a (low, high) pass band in Hz or None, window_seconds the length of the end
+    of each trial that is used, None for the whole trial.
+    """
+
+    classifier: str
+    regularisation: float | None
+    band: tuple[float, float] | None
+    window_seconds: float | None
+
+
+def default_grid(
+    classifiers=("TS", "TS-LDA", "MDM"),
+    regularisation={"TS": (0.1, 1.0, 10.0), "TS-LDA": (0.1, 0.5)},
+    bands=(None, (8, 30), (8, 13), (13, 30)),
+    window_seconds=(None, 1.0),
+) -> list[Candidate]:
+    candidates = []
+    for classifier, band, window in itertools.product(classifiers, bands, window_seconds):
+        for value in regularisation.get(classifier, (None,)):
+            candidates.append(Candidate(classifier, value, band, window))
+    return candidates
+
+
+def make_classifier(candidate: Candidate):
+    """Unfitted sklearn pipeline for a candidate, taking covariance matrices"""
+    match candidate.classifier:
+        case "TS":
+            return make_pipeline(
+                TangentSpace(metric="riemann"),
+                LogisticRegression(C=candidate.regularisation, max_iter=1000),
+            )
+        case "TS-LDA":
+            return make_pipeline(
+                TangentSpace(metric="riemann"),
+                LinearDiscriminantAnalysis(solver="lsqr", shrinkage=candidate.regularisation),
+            )
+        case "MDM":
+            return MDM(metric="riemann")
+    raise ValueError(f"ModelSelection: unknown classifier {candidate.classifier}")
+
+
+def prepare_epochs(
+    X: np.ndarray, fsample: float, band: tuple | None, window_seconds: float | None
+) -> np.ndarray:
+    """Band-pass and crop (n_trials, n_channels, n_samples) epochs"""
+    if window_seconds is not None:
+        X = X[..., -int(window_seconds * fsample) :]
+    if band is not None:
+        sos = butter(4, band, btype="bandpass", fs=fsample, output="sos")
+        X = sosfiltfilt(sos, X, axis=-1)
+    return X
+
+
+class SelectedMiClassifier(GenericClassifier):
+    """Classifier promoted by a model selection run: the preprocessing of the
+    winning candidate followed by its pipeline, fitted on every trial."""
+
+    def __init__(self, candidate: Candidate, model, fsample: float, accuracy: float):
+        super().__init__()
+        self.candidate = candidate
+        self.model = model
+        self.fsample = fsample
+        self.accuracy = accuracy
+        self.__covariances = Covariances(estimator="oas")
+
+    def fit(self):
+        pass
+
+    def predict(self, X: np.ndarray) -> Prediction:
+        X = np.asarray(X)
+        if X.ndim < 3:
+            X = X[np.newaxis]
+        X = prepare_epochs(
+            X, self.fsample, self.candidate.band, self.candidate.window_seconds
+        )
+        probabilities = self.model.predict_proba(self.__covariances.transform(X))
+        labels = self.model.classes_[probabilities.argmax(axis=1)]
+        return Prediction(labels=labels, probabilities=probabilities)
+
+
+# Worker process state, the trials are attached from shared memory once per worker
+_shared = None
+_trials = None
+_labels = None
+_fsample = None
+_covariance_cache = {}
+
+
+def _init_worker(name: str, shape: tuple, dtype: str, labels: np.ndarray, fsample: float):
+    global _shared, _trials, _labels, _fsample
+    _shared = shared_memory.SharedMemory(name=name)
+    _trials = np.ndarray(shape, dtype=dtype, buffer=_shared.buf)
+    _labels = labels
+    _fsample = fsample
+
+
+def _covariances(band, window_seconds) -> np.ndarray:
+    # Candidates that share preprocessing share covariances within a worker
+    key = (band, window_seconds)
+    if key not in _covariance_cache:
+        epochs = prepare_epochs(_trials, _fsample, band, window_seconds)
+        _covariance_cache[key] = Covariances(estimator="oas").transform(epochs)
+    return _covariance_cache[key]
+
+
+def _evaluate(index: int, candidate: Candidate, train: np.ndarray, test: np.ndarray):
+    covariances = _covariances(candidate.band, candidate.window_seconds)
+    model = make_classifier(candidate)
+    model.fit(covariances[train], _labels[train])
+    accuracy = float(np.mean(model.predict(covariances[test]) == _labels[test]))
+    return index, accuracy
+
+
+def _release(pool: ProcessPoolExecutor, shared: shared_memory.SharedMemory):
+    pool.shutdown(wait=True, cancel_futures=True)
+    shared.close()
+    shared.unlink()
+
+
+def select_model(
+    X: np.ndarray,
+    y: np.ndarray,
+    fsample: float,
+    candidates: list[Candidate] | None = None,
+    n_splits: int = 5,
+    max_workers: int | None = None,
+    timeout: float | None = None,
+    random_seed: int = 35,
+) -> SelectedMiClassifier | None:
+    """Cross-validate every candidate on the trials, with every (candidate, fold)
+    pair as a separate job on a process pool, and return the best candidate
+    fitted on all trials.  The trials are put in shared memory once and mapped
+    by the workers without copying.  Jobs still running after timeout seconds
+    are abandoned, the best candidate whose folds all finished wins.
+    """
+    candidates = candidates or default_grid()
+    y = np.asarray(y).astype(int)
+    n_splits = min(n_splits, int(np.bincount(y).min()) if len(y) else 0)
+    if n_splits < 2:
+        console.log("[yellow]ModelSelection: not enough trials per class[/yellow]")
+        return None
+    folds = list(
+        StratifiedKFold(n_splits, shuffle=True, random_state=random_seed).split(X, y)
+    )
+
+    started = time.perf_counter()
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    shared = shared_memory.SharedMemory(create=True, size=X.nbytes)
+    np.ndarray(X.shape, dtype=X.dtype, buffer=shared.buf)[:] = X
+    # spawn, not fork: the server process runs LSL and step threads
+    pool = ProcessPoolExecutor(
+        max_workers=max_workers or max(1, (os.cpu_count() or 2) - 1),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(shared.name, X.shape, X.dtype.str, y, fsample),
+    )
+    scores = [[] for _ in candidates]
+    pending = set()
+    try:
+        pending = {
+            pool.submit(_evaluate, index, candidate, train, test)
+            for index, candidate in enumerate(candidates)
+            for train, test in folds
+        }
+        deadline = None if timeout is None else started + timeout
+        while pending:
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for job in done:
+                try:
+                    index, accuracy = job.result()
+                    scores[index].append(accuracy)
+                except Exception as e:
+                    console.log(f"[red]ModelSelection: job failed due to {e}[/red]")
+    finally:
+        if pending:
+            # Don't wait for the jobs past the deadline, release the pool and the
+            # shared memory once the workers that are still starting or running exit
+            threading.Thread(
+                target=_release, args=(pool, shared), name="ModelSelectionRelease"
+            ).start()
+        else:
+            _release(pool, shared)
+
+    complete = [
+        (np.mean(fold_scores), index)
+        for index, fold_scores in enumerate(scores)
+        if len(fold_scores) == n_splits
+    ]
+    if not complete:
+        console.log("[yellow]ModelSelection: no candidate finished in time[/yellow]")
+        return None
+    # Ties go to the candidate listed first
+    accuracy, best = max(complete, key=lambda score: (score[0], -score[1]))
+    candidate = candidates[best]
+
+    epochs = prepare_epochs(X, fsample, candidate.band, candidate.window_seconds)
+    model = make_classifier(candidate)
+    model.fit(Covariances(estimator="oas").transform(epochs), y)
+    console.log(
+        f"[green]ModelSelection: {candidate} accuracy = {accuracy:.3f} "
+        f"({len(complete)}/{len(candidates)} candidates, "
+        f"{time.perf_counter() - started:.1f} s)[/green]"
+    )
+    return SelectedMiClassifier(candidate, model, fsample, float(accuracy))
@@ -0,0 +1,179 @@
+import numpy as np
+from pyriemann.estimation import Covariances
+from pyriemann.utils.geodesic import geodesic_riemann
+from pyriemann.utils.tangentspace import tangent_space
+
+from bci_essentials.classification.generic_classifier import (
+    GenericClassifier,
+    Prediction,
+)
+
+from .utils.epoch_cache import EpochCache
+from .utils.helpers import console
+
+
+class OnlineMiClassifier(GenericClassifier):
+    """Motor imagery classifier that is updated one trial at a time.
+
+    Each trial added with add_to_train() updates a running Riemannian mean of the
+    trial covariances, is projected into the tangent space at that mean, and
+    updates the class means and pooled scatter of a shrinkage LDA.  There is no
+    refit or cross-validation, so fit() is O(1) and the classifier is ready to
+    predict as soon as every class has been seen.
+
+    Earlier tangent vectors are not re-projected when the reference mean moves.
+    The mean settles after a few trials, so this drift is small in practice.
+
+    If an EpochCache is provided, each trial's epoch, covariance and tangent vector
+    are stored in it, and covariances already in the cache are not recomputed.
+
+    trial_screen(labels), if set, returns which trials of each add_to_train()
+    block to keep, e.g. to leave out trials with artifacts.
+    """
+
+    def __init__(self, cache: EpochCache | None = None, settings: dict = {}, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.settings = settings  # preprocessing settings that produced the epochs
+        self.trial_screen = None
+
+    def __getstate__(self) -> dict:
+        # The epoch cache and trial screen belong to the Bessy session, they aren't
+        # saved with the model
+        return dict(self.__dict__, cache=None, trial_screen=None)
+
+    def set_mi_classifier_settings(
+        self,
+        n_classes=2,
+        covariance_estimator="oas",
+        shrinkage=0.1,
+    ):
+        self.n_classes = n_classes
+        self.covariance_estimator = covariance_estimator
+        self.shrinkage = shrinkage
+        self.__covariances = Covariances(estimator=covariance_estimator)
+        self.reset()
+
+    def reset(self):
+        """Forget all trials, the next add_to_train() starts a new model"""
+        self.X = np.ndarray([0])
+        self.y = np.ndarray([0])
+        self.reference = None
+        self.n_updates = 0
+        self.__class_counts = np.zeros(self.n_classes)
+        self.__class_means = None
+        self.__scatter = None
+        self.__weights = None
+
+    @property
+    def is_ready(self) -> bool:
+        return bool(np.all(self.__class_counts > 0))
+
+    def add_to_train(self, decision_block, labels, num_options=0, meta=[]):
+        """Update the model with a block of (n_trials, n_channels, n_samples) epochs"""
+        if getattr(self, "trial_screen", None) is not None:
+            keep = self.trial_screen(labels)
+            decision_block, labels = decision_block[keep], labels[keep]
+        # Prediction trials (label -1) and stray labels have no class to update
+        labels = np.asarray(labels)
+        known = (labels >= 0) & (labels < self.n_classes)
+        if not np.all(known):
+            console.log(
+                f"[yellow]OnlineMiClassifier: skipping {np.count_nonzero(~known)} "
+                f"trials with labels outside 0..{self.n_classes - 1}[/yellow]"
+            )
+            decision_block, labels = decision_block[known], labels[known]
+        if len(decision_block) == 0:
+            return
+        first_trial_id = len(self.X) if self.X.size else 0
+        super().add_to_train(decision_block, labels, num_options, meta)
+
+        subset_block = self.get_subset(decision_block, self.subset, self.channel_labels)
+        for i, (epoch, label) in enumerate(zip(subset_block, labels)):
+            if self.cache is None:
+                cov = self.__covariances.transform(epoch[np.newaxis])[0]
+                self.partial_fit(cov, int(label))
+                continue
+
+            key = self.__cache_key(first_trial_id + i)
+            cov = self.cache.get_or_compute(
+                key,
+                "covariance",
+                lambda: self.__covariances.transform(epoch[np.newaxis])[0],
+            )
+            tangent = self.partial_fit(cov, int(label))
+            self.cache.put(key, epoch=epoch, tangent=tangent)
+
+    def partial_fit(self, cov: np.ndarray, label: int) -> np.ndarray:
+        """Update the model with the covariance matrix of a single labelled trial,
+        returns the trial's tangent-space vector"""
+        # Running Riemannian mean, the k-th trial moves the mean 1/k along the geodesic
+        self.n_updates += 1
+        if self.reference is None:
+            self.reference = cov
+        else:
+            self.reference = geodesic_riemann(self.reference, cov, 1 / self.n_updates)
+
+        features = tangent_space(cov[np.newaxis], self.reference)[0]
+        if self.__class_means is None:
+            self.__class_means = np.zeros((self.n_classes, len(features)))
+            self.__scatter = np.zeros((len(features), len(features)))
+
+        # Welford update of the class mean and the pooled within-class scatter
+        self.__class_counts[label] += 1
+        delta = features - self.__class_means[label]
+        self.__class_means[label] += delta / self.__class_counts[label]
+        self.__scatter += np.outer(delta, features - self.__class_means[label])
+        self.__weights = None
+        return features
+
+    def __cache_key(self, trial_id: int) -> tuple:
+        settings = dict(self.settings, covariance_estimator=self.covariance_estimator)
+        return EpochCache.key(trial_id, settings, self.channel_labels)
+
+    def fit(self):
+        """Nothing to fit, the model is kept up to date by add_to_train()"""
+        console.log(
+            f"[green]OnlineMiClassifier: {self.n_updates} trials, "
+            f"ready={self.is_ready}[/green]"
+        )
+
+    def predict(self, X: np.ndarray) -> Prediction:
+        if len(X.shape) < 3:
+            X = X[np.newaxis, ...]
+        if not self.is_ready:
+            raise ValueError("OnlineMiClassifier: not every class has been trained")
+
+        subset_X = self.get_subset(X, self.subset, self.channel_labels)
+        features = tangent_space(self.__covariances.transform(subset_X), self.reference)
+
+        weights, bias = self.__discriminant()
+        scores = features @ weights.T + bias
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        labels = np.argmax(probabilities, axis=1)
+
+        # Keep the history of trial predictions only, sliding windows would grow it
+        # by a batch every step for as long as prediction runs
+        if len(X) == 1:
+            self.predictions.extend(labels)
+            self.pred_probas.extend(probabilities)
+        return Prediction(labels=labels, probabilities=probabilities)
+
+    def __discriminant(self) -> tuple[np.ndarray, np.ndarray]:
+        """LDA weights and bias, recomputed only after the model has changed"""
+        if self.__weights is None:
+            n_features = self.__scatter.shape[0]
+            dof = max(1, self.__class_counts.sum() - self.n_classes)
+            covariance = self.__scatter / dof
+            scale = max(np.trace(covariance) / n_features, 1e-12)
+            target = scale * np.eye(n_features)
+            covariance = (1 - self.shrinkage) * covariance + self.shrinkage * target
+
+            self.__weights = np.linalg.solve(covariance, self.__class_means.T).T
+            priors = self.__class_counts / self.__class_counts.sum()
+            self.__bias = np.log(priors) - 0.5 * np.sum(
+                self.__weights * self.__class_means, axis=1
+            )
+        return self.__weights, self.__bias
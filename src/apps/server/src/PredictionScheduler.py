@@ -0,0 +1,294 @@
+import asyncio
+import threading
+
+import numpy as np
+from pylsl import local_clock
+
+from .utils.helpers import console
+
+
+class ActionDetector:
+    """Turns a stream of action probabilities into detections.
+
+    A run starts when the probability reaches on_threshold and lasts while it
+    stays at or above off_threshold (hysteresis, so a probability hovering
+    around the threshold doesn't restart the run).  The action is detected once
+    a run has lasted dwell_seconds of EEG time, and the detector then stays
+    disarmed until reset(), so one action phase triggers at most once.
+    """
+
+    def __init__(
+        self,
+        on_threshold: float = 0.6,
+        off_threshold: float = 0.5,
+        dwell_seconds: float = 0.1,
+    ):
+        if off_threshold > on_threshold:
+            raise ValueError("ActionDetector: off_threshold is above on_threshold")
+        self.on_threshold = on_threshold
+        self.off_threshold = off_threshold
+        self.dwell_seconds = dwell_seconds
+        self.reset()
+
+    def reset(self):
+        """Arm the detector for a new action phase"""
+        self.armed = True
+        self.__run_start = None
+
+    def update(
+        self, timestamps, probabilities, window_seconds: float = 0.0
+    ) -> float | None:
+        """Add action probabilities of windows ending at timestamps, returns the
+        timestamp of the window the action was detected in, if it was.
+        window_seconds is how much EEG a window adds to a run when it starts
+        one, e.g. a whole window for non-overlapping predictions."""
+        if not self.armed:
+            return None
+        for timestamp, probability in zip(timestamps, probabilities):
+            if self.__run_start is None:
+                if probability >= self.on_threshold:
+                    self.__run_start = timestamp - window_seconds
+            elif probability < self.off_threshold:
+                self.__run_start = None
+            if (
+                self.__run_start is not None
+                and timestamp - self.__run_start >= self.dwell_seconds
+            ):
+                self.armed = False
+                return timestamp
+        return None
+
+
+class PredictionScheduler:
+    """Runs the rest / action cycle of prediction as one cancellable task.
+
+    Each cycle rests for rest_seconds and then classifies until the
+    ActionDetector fires.  With sliding windows, Bessy classifies the buffered
+    EEG every step and the scheduler awaits the detection.  Otherwise it asks
+    Bessy for one window_seconds prediction at a time, awaits the result (with
+    a timeout) and asks for the next one as soon as it arrives, so there is
+    never more than one request in flight.  A result that arrives before the
+    current request's window has ended belongs to a request that timed out and
+    is dropped.  Request results are dated by the end of their window.
+
+    Predictions are handed in with on_prediction_series() (from any thread) or
+    on_prediction().  When trigger is given it is called straight away with
+    (eeg_time, prediction_time) on the thread the predictions arrive on, e.g.
+    to fire the FES from Bessy's step thread.  on_state(name) is awaited when
+    the cycle enters "rest" or "action", on_detection(eeg_time) after each
+    detection.
+
+    The sliding step adapts to the classifier: Bessy reports the time it takes
+    per window, and the step is widened so classifying the windows of a Bessy
+    step takes at most latency_budget of the step.
+    """
+
+    def __init__(
+        self,
+        bessy,
+        action_label: int,
+        on_state: callable,
+        on_detection: callable,
+        trigger: callable = None,
+        detector: ActionDetector = None,
+        rest_seconds: float = 7,
+        window_seconds: float = 2,
+        use_sliding_windows: bool = True,
+        step_seconds: float = 0.1,
+        max_step_seconds: float = 0.5,
+        latency_budget: float = 0.25,
+        timeout_seconds: float = 2,
+    ):
+        self.bessy = bessy
+        self.action_label = action_label
+        self.on_state = on_state
+        self.on_detection = on_detection
+        self.trigger = trigger
+        self.detector = detector or ActionDetector()
+        self.rest_seconds = rest_seconds
+        self.window_seconds = window_seconds
+        self.use_sliding_windows = use_sliding_windows
+        self.step_seconds = step_seconds
+        self.max_step_seconds = max_step_seconds
+        self.latency_budget = latency_budget
+        self.timeout_seconds = timeout_seconds
+
+        # Statistics, for logging and tuning
+        self.n_predictions = 0
+        self.n_detections = 0
+        self.n_timeouts = 0
+        self.n_stale = 0  # results of timed out requests, dropped
+        self.request_latency = None  # seconds from window end to result, EWMA
+
+        self.__loop = None
+        self.__task = None
+        self.__lock = threading.Lock()
+        self.__detection = None  # future of the action phase's detection
+        self.__result = None  # future of the prediction request in flight
+        self.__window_end = None  # EEG time the request in flight ends at
+        self.__current_step = step_seconds
+
+    @property
+    def is_running(self) -> bool:
+        return self.__task is not None and not self.__task.done()
+
+    def start(self):
+        """Start the cycle, must be called from the event loop"""
+        if self.is_running:
+            return
+        self.__loop = asyncio.get_running_loop()
+        self.__task = asyncio.create_task(self.__run(), name="PredictionScheduler")
+
+    async def stop(self):
+        """Cancel the cycle and wait until it has wound down"""
+        task, self.__task = self.__task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def __run(self):
+        try:
+            while True:
+                await self.on_state("rest")
+                await asyncio.sleep(self.rest_seconds)
+                await self.on_state("action")
+                if self.use_sliding_windows:
+                    eeg_time = await self.__detect_sliding()
+                else:
+                    eeg_time = await self.__detect_requested()
+                self.n_detections += 1
+                await self.on_detection(eeg_time)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console.log(f"[red]PredictionScheduler: stopped due to {e}[/red]")
+        finally:
+            self.bessy.stop_sliding_prediction()
+            self.__disarm()
+
+    async def __detect_sliding(self) -> float:
+        detection = self.__arm()
+        self.__current_step = self.step_seconds
+        self.bessy.start_sliding_prediction(self.window_seconds, self.__current_step)
+        try:
+            return await detection
+        finally:
+            self.bessy.stop_sliding_prediction()
+            self.__disarm()
+
+    async def __detect_requested(self) -> float:
+        detection = self.__arm()
+        try:
+            return await self.__request_until(detection)
+        finally:
+            self.__disarm()
+
+    async def __request_until(self, detection: asyncio.Future) -> float:
+        while not detection.done():
+            result = self.__loop.create_future()
+            window_start = self.bessy.make_prediction(self.window_seconds)
+            with self.__lock:
+                self.__result = result
+                self.__window_end = window_start + self.window_seconds
+            # The window is the EEG after the request, allow for the classifier on top
+            timeout = self.window_seconds + self.timeout_seconds
+            if self.request_latency is not None:
+                timeout += 2 * self.request_latency
+            done, _ = await asyncio.wait(
+                [result, detection], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                self.n_timeouts += 1
+                console.log("[yellow]PredictionScheduler: prediction timed out[/yellow]")
+        return detection.result()
+
+    def __arm(self) -> asyncio.Future:
+        with self.__lock:
+            self.detector.reset()
+            self.__detection = self.__loop.create_future()
+            return self.__detection
+
+    def __disarm(self):
+        with self.__lock:
+            self.__detection = None
+            self.__result = None
+            self.__window_end = None
+
+    def on_prediction_series(self, timestamps, probabilities, prediction_time: float):
+        """Sliding window predictions, called on Bessy's step thread or the loop"""
+        probabilities = np.asarray(probabilities)
+        with self.__lock:
+            if self.__detection is None:
+                return
+            self.n_predictions += len(probabilities)
+            eeg_time = self.detector.update(timestamps, probabilities[:, self.action_label])
+            detection = self.__detection if eeg_time is not None else None
+        self.__adapt_step()
+        if detection is not None:
+            self.__detected(detection, eeg_time, prediction_time)
+
+    def on_prediction(self, probabilities):
+        """Result of a prediction request, called on the loop"""
+        now = local_clock()
+        with self.__lock:
+            if self.__result is None or self.__detection is None:
+                return
+            window_end = self.__window_end
+            if now < window_end:
+                # Too early for the request in flight, it's a timed out one's
+                self.n_stale += 1
+                return
+            result, self.__result = self.__result, None
+            self.n_predictions += 1
+            self.__measure_latency(now - window_end)
+            eeg_time = self.detector.update(
+                [window_end], [probabilities[self.action_label]], self.window_seconds
+            )
+            detection = self.__detection if eeg_time is not None else None
+        if not result.done():
+            result.set_result(probabilities)
+        if detection is not None:
+            self.__detected(detection, eeg_time, now)
+
+    def __detected(self, detection: asyncio.Future, eeg_time: float, prediction_time: float):
+        if self.trigger is not None:
+            self.trigger(eeg_time, prediction_time)
+
+        def resolve():
+            if not detection.done():
+                detection.set_result(eeg_time)
+
+        try:
+            on_loop = asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            resolve()
+        else:
+            self.__loop.call_soon_threadsafe(resolve)
+
+    def __measure_latency(self, latency: float):
+        latency = max(0.0, latency)
+        if self.request_latency is None:
+            self.request_latency = latency
+        else:
+            self.request_latency += 0.2 * (latency - self.request_latency)
+
+    def __adapt_step(self):
+        """Widen the sliding step when classifying a step's windows would take more
+        than latency_budget of Bessy's step period, narrow it back when it's quick"""
+        latency = self.bessy.prediction_latency
+        if latency is None:
+            return
+        windows_per_step = max(1.0, self.latency_budget * self.bessy.step_seconds / latency)
+        step = min(
+            self.max_step_seconds,
+            max(self.step_seconds, self.bessy.step_seconds / windows_per_step),
+        )
+        if abs(step - self.__current_step) > 0.1 * self.__current_step:
+            self.__current_step = step
+            self.bessy.set_sliding_step(step)
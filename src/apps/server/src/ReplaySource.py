@@ -0,0 +1,293 @@
+import time
+import numpy as np
+from pylsl import local_clock
+
+from bci_essentials.eeg_data import EegData
+from bci_essentials.io.sources import EegSource, MarkerSource
+
+from .SessionRecorder import SessionRecording
+from .utils.markers import COMMANDS, MARKER_DTYPE, Paradigm, marker_string
+from .utils.ring_buffer import RingBuffer
+from .utils.stream_filter import StreamingFilter
+from .utils.channel_map import ChannelMap
+from .utils.helpers import console
+
+
+class ReplayClock:
+    """Position of a replay in recording time.
+
+    With a speed, the position follows the wall clock speed times faster than
+    real time.  Without one (as fast as possible), every advance() moves it
+    step_seconds ahead, so a replay gives the same result however fast the
+    machine is.
+    """
+
+    def __init__(self, start_time: float, speed: float | None = None, step_seconds: float = 0.1):
+        self.speed = speed
+        self.step_seconds = step_seconds
+        self.position = start_time
+        self.__start_time = start_time
+        self.__wall_start = None
+
+    def advance(self) -> float:
+        if self.speed is None:
+            self.position += self.step_seconds
+        else:
+            if self.__wall_start is None:
+                self.__wall_start = local_clock()
+            elapsed = local_clock() - self.__wall_start
+            self.position = self.__start_time + elapsed * self.speed
+        return self.position
+
+
+class ReplaySession:
+    """EEG and markers of a past session, ready to be replayed.
+
+    Load a SessionRecorder directory with from_recording(), or the trials saved
+    by Bessy.save_data() / EegData.save_trials_as_npz() with from_trials_npz().
+    """
+
+    def __init__(
+        self,
+        samples: np.ndarray,
+        timestamps: np.ndarray,
+        markers: np.ndarray,
+        fsample: float,
+        channel_labels: list[str],
+        name: str = "Replay",
+        preprocessing: dict | None = None,
+    ):
+        self.samples = samples
+        self.timestamps = timestamps
+        self.markers = markers  # MARKER_DTYPE records
+        self.fsample = fsample
+        self.channel_labels = channel_labels
+        self.name = name
+        self.preprocessing = preprocessing  # what the samples already went through
+
+    @classmethod
+    def from_recording(cls, path: str) -> "ReplaySession":
+        recording = SessionRecording(path)
+        return cls(
+            recording.eeg,
+            recording.eeg_timestamps,
+            recording.markers,
+            recording.fsample,
+            recording.channel_labels,
+            name=f"Replay {path}",
+            preprocessing=recording.index.get("preprocessing"),
+        )
+
+    @classmethod
+    def from_trials_npz(
+        cls,
+        file_name: str,
+        fsample: float,
+        n_classes: int = 2,
+        gap_seconds: float = 0.0,
+        tail_seconds: float = 0.5,
+    ) -> "ReplaySession":
+        """Lay the saved trials (X: trials x channels x samples, y: labels) end to
+        end, gap_seconds apart, and mark each one.  At least tail_seconds of zeros
+        follow the last trial, EegData only closes a trial once it has EEG past
+        its end (buffer_time), and replay is fed a step at a time"""
+        with np.load(file_name) as data:
+            X, y = data["X"], data["y"]
+        n_trials, n_channels, n_samples = X.shape
+        gap = int(gap_seconds * fsample)
+        period = n_samples + gap
+        duration = n_samples / fsample
+        tail = max(gap, int(np.ceil(tail_seconds * fsample)) + 1)
+
+        samples = np.zeros(
+            ((n_trials - 1) * period + n_samples + tail, n_channels), dtype=np.float32
+        )
+        for i, trial in enumerate(X):
+            samples[i * period : i * period + n_samples] = trial.T
+        timestamps = np.arange(len(samples)) / fsample
+
+        markers = np.zeros(2 * n_trials + 1, dtype=MARKER_DTYPE)
+        starts = np.arange(n_trials) * period / fsample
+        markers[0] = (0.0, Paradigm.Command, 0, COMMANDS.index("Trial Started"), 0.0)
+        markers[1::2] = [
+            (start, Paradigm.MI, n_classes, label, duration) for start, label in zip(starts, y)
+        ]
+        markers[2::2] = [
+            (start + duration, Paradigm.Command, 0, COMMANDS.index("Trial Ends"), 0.0)
+            for start in starts
+        ]
+        labels = [f"EEG{i + 1}" for i in range(n_channels)]
+        return cls(samples, timestamps, markers, fsample, labels, name=f"Replay {file_name}")
+
+    def sources(
+        self,
+        speed: float | None = None,
+        step_seconds: float = 0.1,
+        durations: dict[int, float] | None = None,
+        max_trials: int | None = None,
+        preprocessing: dict | None = None,
+    ) -> tuple["ReplayEegSource", "ReplayMarkerSource"]:
+        """EegSource and MarkerSource sharing one ReplayClock, see ReplayMarkerSource
+        for durations and max_trials and ReplayEegSource for preprocessing"""
+        clock = ReplayClock(self.timestamps[0], speed, step_seconds)
+        eeg_source = ReplayEegSource(self, clock, preprocessing=preprocessing)
+        marker_source = ReplayMarkerSource(self.markers, clock, durations, max_trials)
+        return eeg_source, marker_source
+
+
+class ReplayEegSource(EegSource):
+    """EegSource that plays back a ReplaySession up to the replay clock, with the
+    recorded timestamps.  Like EmotivEegSource it keeps the newest samples in a
+    RingBuffer, so sliding window prediction works on replays too.
+
+    Non-EEG columns (e.g. of old 19 column recordings) are dropped by label, see
+    ChannelMap.  preprocessing (StreamingFilter settings) filters the samples as they are
+    played back, e.g. to try other bands on a raw recording.  Recordings made
+    with preprocessing on are already filtered, see ReplaySession.preprocessing.
+    """
+
+    def __init__(
+        self,
+        session: ReplaySession,
+        clock: ReplayClock,
+        buffer_seconds: float = 60.0,
+        preprocessing: dict | None = None,
+    ):
+        self.session = session
+        self.clock = clock
+        self.channel_map = ChannelMap(session.channel_labels)
+        self.filter = None
+        if preprocessing is not None:
+            self.filter = StreamingFilter(
+                session.fsample, self.channel_map.n_channels, **preprocessing
+            )
+        self.buffer = RingBuffer(int(session.fsample * buffer_seconds), self.n_channels)
+        self.__position = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.__position >= len(self.session.timestamps)
+
+    @property
+    def name(self) -> str:
+        return self.session.name
+
+    @property
+    def fsample(self) -> float:
+        return self.session.fsample
+
+    @property
+    def n_channels(self) -> int:
+        if self.filter is not None:
+            return self.filter.n_outputs
+        return self.channel_map.n_channels
+
+    @property
+    def channel_types(self) -> list[str]:
+        return ["EEG"] * self.n_channels
+
+    @property
+    def channel_units(self) -> list[str]:
+        return ["microvolts"] * self.n_channels
+
+    @property
+    def channel_labels(self) -> list[str]:
+        if self.filter is not None:
+            return self.filter.output_labels(self.channel_map.labels)
+        return list(self.channel_map.labels)
+
+    def get_samples(self) -> tuple[np.ndarray, np.ndarray]:
+        """Samples up to the replay clock, as views into the ring buffer"""
+        end = int(np.searchsorted(self.session.timestamps, self.clock.advance(), "right"))
+        start, self.__position = self.__position, max(self.__position, end)
+        if end <= start:
+            return self.buffer.latest(0)
+        samples = self.channel_map.apply(np.asarray(self.session.samples[start:end]))
+        if self.filter is not None:
+            samples = self.filter.process(samples)
+        self.buffer.write(samples, np.asarray(self.session.timestamps[start:end]))
+        return self.buffer.latest(min(end - start, self.buffer.capacity))
+
+    def latest_window(self, duration: float) -> tuple[np.ndarray, np.ndarray]:
+        return self.buffer.latest(int(duration * self.fsample))
+
+    def time_correction(self) -> float:
+        return 0.0
+
+
+class ReplayMarkerSource(MarkerSource):
+    """MarkerSource that plays back recorded marker records up to the replay
+    clock.  durations ({label: seconds}) overrides the length of the motor
+    imagery trials of a label, e.g. to try other rest / action windows, and
+    max_trials drops training trials after the first max_trials."""
+
+    def __init__(
+        self,
+        records: np.ndarray,
+        clock: ReplayClock,
+        durations: dict[int, float] | None = None,
+        max_trials: int | None = None,
+    ):
+        self.clock = clock
+        self.__messages = []
+        self.__timestamps = []
+        n_trials = 0
+        for record in records:
+            paradigm, label = int(record["paradigm"]), int(record["label"])
+            duration = float(record["duration"])
+            if paradigm == Paradigm.MI and label >= 0:
+                n_trials += 1
+                if max_trials is not None and n_trials > max_trials:
+                    continue
+                duration = (durations or {}).get(label, duration)
+            self.__messages.append(
+                [marker_string(paradigm, int(record["n_classes"]), label, duration)]
+            )
+            self.__timestamps.append(float(record["timestamp"]))
+        self.__position = 0
+
+    name = "ReplayMarkerSource"
+
+    @property
+    def finished(self) -> bool:
+        return self.__position >= len(self.__timestamps)
+
+    def get_markers(self) -> tuple[list[list], list]:
+        """Markers up to the replay clock, the EEG source moves the clock on"""
+        end = int(np.searchsorted(self.__timestamps, self.clock.position, "right"))
+        start, self.__position = self.__position, max(self.__position, end)
+        return self.__messages[start:end], self.__timestamps[start:end]
+
+    def time_correction(self) -> float:
+        return 0.0
+
+
+def replay(
+    session: ReplaySession,
+    classifier,
+    messenger=None,
+    speed: float | None = None,
+    step_seconds: float = 0.1,
+    durations: dict[int, float] | None = None,
+    max_trials: int | None = None,
+    preprocessing: dict | None = None,
+) -> EegData:
+    """Run a session through EegData and classifier, stepping as fast as the
+    replay clock allows, and return the EegData once every sample and marker
+    has been consumed.  The classifier's results are left on the classifier."""
+    eeg_source, marker_source = session.sources(
+        speed, step_seconds, durations, max_trials, preprocessing
+    )
+    eeg_data = EegData(classifier, eeg_source, marker_source, messenger)
+    eeg_data.setup(online=True, training=True, pp_type=None)
+
+    steps = 0
+    while not (eeg_source.finished and marker_source.finished):
+        eeg_data.step()
+        steps += 1
+        if speed is not None:
+            time.sleep(step_seconds)
+    # Let the markers at the very end see their EEG
+    eeg_data.step()
+    console.log(f"[blue]Replayed {session.name} in {steps} steps[/blue]")
+    return eeg_data
@@ -0,0 +1,436 @@
+import os
+import re
+import json
+import asyncio
+import threading
+import multiprocessing
+
+import numpy as np
+import yaml
+
+from .FlickTokModel import FlickTokModel
+from .utils.store import Store
+from .utils.live_stream import LiveStream
+from .utils.helpers import console
+
+DEFAULT_SESSION = "default"
+CONFIG_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "packages", "config", "base.yml"
+)
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# FlickTokModel settings a client may choose when it creates a session, anything
+# touching the file system stays under the server's control
+CLIENT_SETTINGS = ("user_id", "eeg_stream_key", "fes_serial_number")
+
+
+def load_session_settings(config_file: str = CONFIG_FILE) -> dict[str, dict]:
+    """Per-session FlickTokModel settings from the "sessions" section of the
+    monorepo config, overridden by the FLICKTOK_SESSIONS environment variable
+    (JSON with the same layout)"""
+    settings = {}
+    try:
+        with open(config_file) as file:
+            settings = (yaml.safe_load(file) or {}).get("sessions") or {}
+    except FileNotFoundError:
+        pass
+    if os.getenv("FLICKTOK_SESSIONS"):
+        settings.update(json.loads(os.environ["FLICKTOK_SESSIONS"]))
+    return {str(session_id): dict(values or {}) for session_id, values in settings.items()}
+
+
+def session_room(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+def live_namespace(session_id: str) -> str:
+    """Socket.IO namespace of the session's LiveStream"""
+    return "/live" if session_id == DEFAULT_SESSION else f"/live/{session_id}"
+
+
+class SessionEmitter:
+    """Stands in for the Socket.IO server inside a session: messages without a
+    recipient go to the session's room instead of to every client."""
+
+    def __init__(self, send: callable, room: str):
+        self.send = send
+        self.room = room
+
+    async def emit(self, event: str, data: dict = None, to: str = None, room: str = None):
+        self.send(event, data, to or room or self.room)
+
+
+class SessionController:
+    """One station: a Store and a FlickTokModel (with its own Bessy worker, EEG
+    stream discovery and FES boxes), and the client requests that drive them.
+
+    send(event, data, sid_or_room) delivers Socket.IO messages, on_eeg and
+    on_probabilities receive the live EEG and classifier output.  The same
+    controller runs on the server's event loop or in a session worker process.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        send: callable,
+        on_eeg: callable = None,
+        on_probabilities: callable = None,
+        settings: dict = None,
+    ):
+        self.session_id = session_id
+        self.room = session_room(session_id)
+
+        # Sessions write to their own directories, so worker processes never
+        # share a recording or the model registry index
+        settings = dict(settings or {})
+        settings.setdefault("recordings_path", os.path.join("recordings", session_id))
+        settings.setdefault("models_path", os.path.join("models", session_id))
+
+        self.store = Store(eeg_stream_is_available=False)
+        self.emitter = SessionEmitter(send, self.room)
+        self.model = FlickTokModel(self.store, self.emitter, **settings)
+        if on_eeg is not None:
+            self.model.bessy.output.eeg_listeners.append(on_eeg)
+        if on_probabilities is not None:
+            self.model.bessy.output.probability_listeners.append(on_probabilities)
+
+        self.store.on_change(
+            "eeg_stream_is_available", self.__notify_eeg_stream_availability
+        )
+        self.store.on_change("eeg_streams", self.__notify_eeg_streams)
+        self.store.on_change("selected_eeg_stream", self.__notify_eeg_streams)
+        self.store.on_change("signal_quality", self.__notify_signal_quality)
+
+        self.__handlers = {
+            "init": self.__init_client,
+            "run-fes-test": self.__run_fes_test,
+            "req:eeg-stream-availability": self.__req_eeg_stream_availability,
+            "req:eeg-streams": self.__req_eeg_streams,
+            "select-eeg-stream": self.__select_eeg_stream,
+            "set-training-btn-state": self.__set_training_btn_state,
+            "set-prediction-btn-state": self.__set_prediction_btn_state,
+        }
+
+    def start(self):
+        """Start the session, must be called from its event loop"""
+        self.store.set_event_loop(asyncio.get_running_loop())
+        self.model.start_eeg_scanning()
+
+    async def stop(self):
+        await self.model.close()
+
+    async def handle(self, event: str, sid: str, data=None):
+        handler = self.__handlers.get(event)
+        if handler is None:
+            console.log(f"[yellow]Session {self.session_id}: unknown request {event}[/yellow]")
+            return
+        try:
+            await handler(sid, data)
+        except Exception as e:
+            console.log(f"[red]Session {self.session_id}: {event} failed due to {e}[/red]")
+
+    async def __init_client(self, sid, data):
+        console.log(f"[yellow]Ping...[/yellow]")
+        await self.emitter.emit("fromPython", {"id": "init", "data": {}})
+
+    async def __run_fes_test(self, sid, data):
+        console.log(f"[cyan]Running FES test...[/cyan]")
+        await self.model.perform_fes_swipe()
+
+    async def __req_eeg_stream_availability(self, sid, data):
+        await self.__send_eeg_stream_availability(
+            self.store.get("eeg_stream_is_available"), to=sid
+        )
+
+    async def __notify_eeg_stream_availability(self, payload):
+        console.log(f"[green]eeg_stream_is_available: {payload}[/green]")
+        await self.__send_eeg_stream_availability(payload.get("value"))
+
+    async def __send_eeg_stream_availability(self, value: bool, to: str = None):
+        await self.emitter.emit(
+            "fromPython",
+            {"id": "eeg-stream-availability-updated", "data": {"value": value}},
+            to=to,
+        )
+
+    async def __req_eeg_streams(self, sid, data):
+        await self.__send_eeg_streams(to=sid)
+
+    async def __select_eeg_stream(self, sid, key):
+        self.model.eeg_streams.select(key)
+
+    async def __notify_eeg_streams(self, payload):
+        await self.__send_eeg_streams()
+
+    async def __send_eeg_streams(self, to: str = None):
+        await self.emitter.emit(
+            "fromPython",
+            {
+                "id": "eeg-streams-updated",
+                "data": {
+                    "streams": self.store.get("eeg_streams") or [],
+                    "selected": self.store.get("selected_eeg_stream"),
+                },
+            },
+            to=to,
+        )
+
+    async def __notify_signal_quality(self, payload):
+        await self.emitter.emit(
+            "fromPython", {"id": "signal-quality-updated", "data": payload.get("value")}
+        )
+
+    async def __set_training_btn_state(self, sid, value):
+        if value == "start":
+            await self.model.start_training()
+        elif value == "stop":
+            await self.model.stop_training()
+
+    async def __set_prediction_btn_state(self, sid, value):
+        if value == "start":
+            await self.model.start_predicting()
+        elif value == "stop":
+            await self.model.stop_predicting()
+
+
+class LocalSession:
+    """Session that runs on the server's event loop"""
+
+    def __init__(self, session_id: str, broadcaster, live_stream: LiveStream, settings: dict):
+        self.session_id = session_id
+        self.room = session_room(session_id)
+        self.controller = SessionController(
+            session_id,
+            broadcaster.send,
+            live_stream.push_eeg,
+            live_stream.push_probabilities,
+            settings,
+        )
+
+    def start(self):
+        self.controller.start()
+
+    async def handle(self, event: str, sid: str, data=None):
+        await self.controller.handle(event, sid, data)
+
+    async def stop(self):
+        await self.controller.stop()
+
+
+class ProcessSession:
+    """Session that runs in its own worker process, so its Bessy steps and
+    classifier training don't compete with other sessions for the GIL.
+
+    Client requests are forwarded to the process on a queue.  The process sends
+    back Socket.IO messages, EEG and probabilities, which a reader thread hands
+    to the (thread-safe) Broadcaster and LiveStream.
+    """
+
+    def __init__(self, session_id: str, broadcaster, live_stream: LiveStream, settings: dict):
+        self.session_id = session_id
+        self.room = session_room(session_id)
+        self.broadcaster = broadcaster
+        self.live_stream = live_stream
+
+        # Not a daemon, model selection starts a process pool of its own
+        context = multiprocessing.get_context("spawn")
+        self.__commands = context.Queue()
+        self.__events = context.Queue()
+        self.__process = context.Process(
+            target=run_session_process,
+            args=(session_id, settings, self.__commands, self.__events),
+            name=f"FlickTokSession-{session_id}",
+        )
+        self.__reader = threading.Thread(
+            target=self.__read_events, name=f"FlickTokSession-{session_id}", daemon=True
+        )
+
+    def start(self):
+        self.__process.start()
+        self.__reader.start()
+        console.log(
+            f"[blue]Session {self.session_id} running in process {self.__process.pid}[/blue]"
+        )
+
+    async def handle(self, event: str, sid: str, data=None):
+        self.__commands.put((event, sid, data))
+
+    async def stop(self, timeout: float = 10.0):
+        self.__commands.put(None)
+        await asyncio.to_thread(self.__process.join, timeout)
+        if self.__process.is_alive():
+            console.log(f"[red]Session {self.session_id} did not stop, terminating[/red]")
+            self.__process.terminate()
+            self.__events.put(None)
+        await asyncio.to_thread(self.__reader.join, timeout)
+
+    def __read_events(self):
+        while (event := self.__events.get()) is not None:
+            kind, *args = event
+            try:
+                match kind:
+                    case "emit":
+                        self.broadcaster.send(*args)
+                    case "eeg":
+                        self.live_stream.push_eeg(*args)
+                    case "probabilities":
+                        self.live_stream.push_probabilities(*args)
+            except Exception as e:
+                console.log(f"[red]Session {self.session_id}: {kind} failed due to {e}[/red]")
+
+
+def run_session_process(session_id: str, settings: dict, commands, events):
+    """Entry point of a ProcessSession's worker process"""
+    asyncio.run(_serve_session(session_id, settings, commands, events))
+
+
+async def _serve_session(session_id: str, settings: dict, commands, events):
+    # The queue pickles on a feeder thread, so copy the ring buffer views now
+    def send(event, data=None, to=None):
+        events.put(("emit", event, data, to))
+
+    def on_eeg(samples, timestamps):
+        events.put(("eeg", np.array(samples), np.array(timestamps)))
+
+    def on_probabilities(timestamps, probabilities):
+        events.put(("probabilities", np.array(timestamps), np.array(probabilities)))
+
+    controller = SessionController(session_id, send, on_eeg, on_probabilities, settings)
+    controller.start()
+
+    tasks = set()
+    while (command := await asyncio.to_thread(commands.get)) is not None:
+        task = asyncio.create_task(controller.handle(*command))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await controller.stop()
+    events.put(None)
+
+
+class SessionManager:
+    """Runs one session per station and routes every client to its session.
+
+    A client joins a session by id, with the "session" field of its Socket.IO
+    auth or a "join-session" request, and the first client to join creates it.
+    Each session has its own FlickTokModel, Bessy worker, EEG stream, FES boxes
+    and LiveStream namespace, and its messages go to the clients in its room
+    only.  With use_processes each session runs in a worker process of its own,
+    otherwise on the server's event loop.
+
+    session_settings maps session ids to FlickTokModel settings, e.g. the
+    eeg_stream_key and fes_serial_number of each station (see
+    load_session_settings).  Clients creating a session may only choose the
+    CLIENT_SETTINGS.  A session without a fes_serial_number only gets the FES
+    boxes if no other session is running, and no two sessions get the same box,
+    so one station can never stimulate another station's user.
+    """
+
+    def __init__(
+        self,
+        sio,
+        broadcaster,
+        use_processes: bool = True,
+        session_settings: dict[str, dict] = None,
+    ):
+        self.sio = sio
+        self.broadcaster = broadcaster
+        self.use_processes = use_processes
+        self.session_settings = session_settings or {}
+        self.sessions: dict[str, LocalSession | ProcessSession] = {}
+        self.members: dict[str, str] = {}  # sid -> session id
+
+        self.__live_streams: dict[str, LiveStream] = {}
+        self.__settings: dict[str, dict] = {}  # settings each session was created with
+        self.__lock = asyncio.Lock()
+
+    async def join(self, sid: str, session_id: str = None, settings: dict = None):
+        session_id = session_id or DEFAULT_SESSION
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            console.log(f"[red]SessionManager: invalid session id {session_id!r}[/red]")
+            return
+
+        self.leave(sid)
+        async with self.__lock:
+            if session_id not in self.sessions:
+                self.__create(session_id, settings or {})
+        self.members[sid] = session_id
+        self.broadcaster.enter_room(sid, session_room(session_id))
+        console.log(f"[green]Client {sid} joined session {session_id}[/green]")
+        await self.broadcaster.emit(
+            "fromPython",
+            {
+                "id": "session-joined",
+                "data": {"session": session_id, "liveNamespace": live_namespace(session_id)},
+            },
+            to=sid,
+        )
+
+    def leave(self, sid: str):
+        session_id = self.members.pop(sid, None)
+        if session_id is not None:
+            self.broadcaster.leave_room(sid, session_room(session_id))
+
+    async def handle(self, sid: str, event: str, data=None):
+        """Pass a client request on to the client's session"""
+        if sid not in self.members:
+            await self.join(sid)
+        session = self.sessions.get(self.members.get(sid))
+        if session is not None:
+            await session.handle(event, sid, data)
+
+    async def stop(self):
+        for session in self.sessions.values():
+            await session.stop()
+        for live_stream in self.__live_streams.values():
+            await live_stream.stop()
+        self.sessions.clear()
+        self.__settings.clear()
+
+    def __isolate(self, session_id: str, settings: dict):
+        """Keep a new session off the FES boxes and EEG streams of running sessions"""
+        if not self.sessions:
+            return
+        others = [self.__settings[other] for other in self.sessions]
+        serial_number = settings.get("fes_serial_number")
+        if serial_number is None:
+            console.log(
+                f"[red]Session {session_id}: no fes_serial_number while other sessions "
+                f"are running, starting it without FES[/red]"
+            )
+            settings["use_fes"] = False
+        elif any(other.get("fes_serial_number") == serial_number for other in others):
+            console.log(
+                f"[red]Session {session_id}: FES box {serial_number} is in use by "
+                f"another session, starting it without FES[/red]"
+            )
+            settings["use_fes"] = False
+
+        stream_key = settings.get("eeg_stream_key")
+        if stream_key is None or any(
+            other.get("eeg_stream_key") in (None, stream_key) for other in others
+        ):
+            console.log(
+                f"[yellow]Session {session_id}: its EEG stream may be shared with "
+                f"another session, set eeg_stream_key for every station[/yellow]"
+            )
+
+    def __create(self, session_id: str, client_settings: dict):
+        settings = dict(self.session_settings.get(session_id, {}))
+        for name, value in client_settings.items():
+            if name in CLIENT_SETTINGS:
+                settings.setdefault(name, value)
+            else:
+                console.log(f"[yellow]SessionManager: ignoring setting {name}[/yellow]")
+        self.__isolate(session_id, settings)
+
+        live_stream = LiveStream(live_namespace(session_id))
+        self.sio.register_namespace(live_stream)
+        live_stream.start()
+        self.__live_streams[session_id] = live_stream
+
+        session_type = ProcessSession if self.use_processes else LocalSession
+        self.__settings[session_id] = settings
+        session = session_type(session_id, self.broadcaster, live_stream, settings)
+        session.start()
+        self.sessions[session_id] = session
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+from .utils.helpers import console
+from .utils.markers import MARKER_DTYPE
+
+# A recording is a directory of append-only files plus an index:
+#   eeg.bin          float32 samples, (n_samples, n_channels) row major
+#   eeg_times.bin    float64 sample timestamps
+#   markers.bin      MARKER_DTYPE records
+#   predictions.bin  prediction_dtype(n_classes) records
+#   index.json       metadata and the number of rows of each file known to be
+#                    on disk, replaced atomically after every flush
+EEG_FILE = "eeg.bin"
+EEG_TIMES_FILE = "eeg_times.bin"
+MARKERS_FILE = "markers.bin"
+PREDICTIONS_FILE = "predictions.bin"
+INDEX_FILE = "index.json"
+
+
+def prediction_dtype(n_classes: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("timestamp", np.float64),
+            ("label", np.int16),
+            ("probabilities", np.float32, (n_classes,)),
+        ]
+    )
+
+
+class SessionRecorder:
+    """Streams raw EEG, markers and predictions of a session to disk.
+
+    The write_*() methods are called from Bessy's step thread and only copy the
+    data onto a queue.  A writer thread appends whatever is queued to the files
+    every flush_seconds, fsyncs them and then updates the index, so after a crash
+    the index still describes complete rows.  Open a recording with
+    SessionRecording, which memory-maps it instead of loading it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        channel_labels: list[str],
+        fsample: float,
+        n_classes: int,
+        flush_seconds: float = 1.0,
+        preprocessing: dict | None = None,
+    ):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.n_channels = len(channel_labels)
+        self.__prediction_dtype = prediction_dtype(n_classes)
+        self.__index = {
+            "version": 1,
+            "created": time.time(),
+            "fsample": fsample,
+            "channel_labels": list(channel_labels),
+            "n_classes": n_classes,
+            # StreamingFilter settings the EEG went through before it was recorded
+            "preprocessing": preprocessing,
+            "rows": {EEG_FILE: 0, EEG_TIMES_FILE: 0, MARKERS_FILE: 0, PREDICTIONS_FILE: 0},
+        }
+
+        self.__pending = deque()  # (file name, array), appended from the step thread
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.__files = {}
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name in self.__index["rows"]:
+            self.__files[name] = open(os.path.join(self.path, name), "ab")
+        self.__write_index()
+        self.__thread = threading.Thread(
+            target=self.__run, name="SessionRecorder", daemon=True
+        )
+        self.__thread.start()
+        console.log(f"[blue]Recording session to {self.path}[/blue]")
+
+    def stop(self):
+        """Flush everything queued and close the files"""
+        if self.__thread is None:
+            return
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+        for file in self.__files.values():
+            file.close()
+        self.__files = {}
+        console.log(f"[blue]Recording saved: {self.__index['rows']}[/blue]")
+
+    def write_eeg(self, samples: np.ndarray, timestamps: np.ndarray):
+        self.__pending.append((EEG_FILE, np.asarray(samples, dtype=np.float32).copy()))
+        self.__pending.append((EEG_TIMES_FILE, np.asarray(timestamps, dtype=np.float64).copy()))
+
+    def write_markers(self, records: np.ndarray):
+        self.__pending.append((MARKERS_FILE, records.astype(MARKER_DTYPE, copy=True)))
+
+    def write_predictions(self, timestamps, probabilities):
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        records = np.zeros(len(probabilities), dtype=self.__prediction_dtype)
+        records["timestamp"] = timestamps
+        records["label"] = probabilities.argmax(axis=1)
+        records["probabilities"] = probabilities
+        self.__pending.append((PREDICTIONS_FILE, records))
+
+    def __run(self):
+        while not self.__stop_event.wait(self.flush_seconds):
+            self.__flush()
+        self.__flush()
+
+    def __flush(self):
+        if not self.__pending:
+            return
+        written = set()
+        try:
+            while self.__pending:
+                name, array = self.__pending.popleft()
+                self.__files[name].write(array.tobytes())
+                self.__index["rows"][name] += len(array)
+                written.add(name)
+            for name in written:
+                self.__files[name].flush()
+                os.fsync(self.__files[name].fileno())
+            self.__write_index()
+        except OSError as e:
+            console.log(f"[red]SessionRecorder: flush failed due to {e}[/red]")
+
+    def __write_index(self):
+        temporary = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(temporary, "w") as file:
+            json.dump(self.__index, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, os.path.join(self.path, INDEX_FILE))
+
+
+class SessionRecording:
+    """Read-only view of a SessionRecorder directory.  The arrays are
+    np.memmaps, so only the parts that are used are read from disk.  Rows
+    written after the last index update (e.g. before a crash) are ignored."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as file:
+            self.index = json.load(file)
+        self.fsample = self.index["fsample"]
+        self.channel_labels = self.index["channel_labels"]
+
+        rows = self.index["rows"]
+        n_channels = len(self.channel_labels)
+        self.eeg = self.__map(EEG_FILE, np.float32, rows[EEG_FILE], (n_channels,))
+        self.eeg_timestamps = self.__map(EEG_TIMES_FILE, np.float64, rows[EEG_TIMES_FILE])
+        self.markers = self.__map(MARKERS_FILE, MARKER_DTYPE, rows[MARKERS_FILE])
+        self.predictions = self.__map(
+            PREDICTIONS_FILE, prediction_dtype(self.index["n_classes"]), rows[PREDICTIONS_FILE]
+        )
+
+    def __map(self, name: str, dtype, n_rows: int, row_shape: tuple = ()) -> np.ndarray:
+        if n_rows == 0:
+            return np.zeros((0, *row_shape), dtype=dtype)
+        return np.memmap(
+            os.path.join(self.path, name), dtype=dtype, mode="r", shape=(n_rows, *row_shape)
+        )
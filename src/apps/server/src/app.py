@@ -10,25 +10,30 @@ from contextlib import asynccontextmanager
 
 from .utils.helpers import fifo_worker, delayed_exec, console, StoppableTask
 from .utils.store import Store
+from .utils.broadcaster import Broadcaster
 from .utils.headset_sim_fn import generate_simulated_eeg
-from .FlickTokModel import FlickTokModel
+from .SessionManager import SessionManager, load_session_settings
 
 connected_clients = set()  # if we want to keep track of connected clients
 
-# In-memory pub/sub store
+# In-memory pub/sub store for server-wide state, every session has its own
 store = Store(
-    eeg_stream_is_available=False,
+    headset_simulator_is_running=False,
 )
 
 
 async def on_startup(app: FastAPI):
     # Startup logic
     console.log(f"[cyan]Application is starting up...[/cyan]")
+    store.set_event_loop(asyncio.get_running_loop())
+    broadcaster.start()
 
 
 async def on_shutdown(app: FastAPI):
     # Shutdown logic
     console.log(f"[cyan]Application is shutting down...[/cyan]")
+    await sessions.stop()
+    await broadcaster.stop()
 
 
 @asynccontextmanager
@@ -44,33 +49,48 @@ fastapp.add_middleware(CORSMiddleware, allow_origins=["*"])
 sio = socketio.AsyncServer(cors_allowed_origins="*", async_mode="asgi")
 app = socketio.ASGIApp(sio, other_asgi_app=fastapp)
 
-# Models
-flicktok_model = FlickTokModel(store, sio)
+# Outgoing messages are queued per client and sent in rate-limited frames
+broadcaster = Broadcaster(sio)
+
+# One FlickTokModel per station, each in its own worker process.  Clients pick
+# their session when connecting, see SessionManager.  Each station's EEG stream and
+# FES box come from the "sessions" section of the config
+sessions = SessionManager(
+    sio, broadcaster, use_processes=True, session_settings=load_session_settings()
+)
 
 
 @sio.event  # called when a client connects
-async def connect(sid, environ):
+async def connect(sid, environ, auth=None):
     console.log(f"[green]Client connected: {sid}[/green]")
     connected_clients.add(sid)
+    broadcaster.add_client(sid)
     await sio.emit("connected", {}, room=sid)
+    auth = auth if isinstance(auth, dict) else {}
+    await sessions.join(sid, auth.get("session"), auth.get("settings"))
 
 
 @sio.event  # called when a client disconnects
 async def disconnect(sid):
     console.log(f"[red]Client disconnected: {sid}[/red]")
     connected_clients.remove(sid)
+    sessions.leave(sid)
+    broadcaster.remove_client(sid)
+
+
+@sio.on("join-session")
+async def join_session(sid, data={}):
+    await sessions.join(sid, data.get("session"), data.get("settings"))
 
 
 @sio.on("init")
 async def init(sid, data={}):
-    console.log(f"[yellow]Ping...[/yellow]")
-    await sio.emit("fromPython", {"id": "init", "data": {}})
+    await sessions.handle(sid, "init", data)
 
 
 @sio.on("run-fes-test")  # called when the client emits the 'run-fes-test' event
 async def run_fes_test(sid, data):
-    console.log(f"[cyan]Running FES test...[/cyan]")
-    await flicktok_model.perform_fes_swipe()
+    await sessions.handle(sid, "run-fes-test", data)
 
 
 # Healthcheck endpoint to verify the http server is running
@@ -80,13 +100,31 @@ async def healthcheck():
 
 
 # region Simulated headset controls
+def run_headset_simulator(fsample: float, n_channels: int):
+    store.set("headset_simulator_is_running", True)
+    try:
+        generate_simulated_eeg(store, fsample=fsample, n_channels=n_channels)
+    finally:
+        store.set("headset_simulator_is_running", False)
+
+
 @fastapp.get("/api/start-headset-simulator")
-async def start_headset_simulator(background_tasks: BackgroundTasks):
-    if not store.get("eeg_stream_is_available"):
-        background_tasks.add_task(generate_simulated_eeg, store)
+async def start_headset_simulator(
+    background_tasks: BackgroundTasks, fsample: float = 128, n_channels: int = 14
+):
+    if not store.get("headset_simulator_is_running"):
+        background_tasks.add_task(
+            run_headset_simulator, fsample=fsample, n_channels=n_channels
+        )
     return {"msg": "Simulating headset data..."}
 
 
+@fastapp.get("/api/simulate-action")
+async def simulate_action(duration: float = 2.0):
+    store.publish("simulate-action", duration)
+    return {"msg": f"Simulating {duration}s of motor imagery..."}
+
+
 @fastapp.get("/api/stop-headset-simulator")
 async def stop_headset_simulator():
     store.publish("stop-headset-simulator")
@@ -96,51 +134,35 @@ async def stop_headset_simulator():
 # endregion
 
 
-# region Listen for & notify clients of eeg stream availability changes
+# region Eeg stream availability and selection, per session
 @sio.on("req:eeg-stream-availability")
 async def req_eeg_stream_availability(sid, data):
-    await sio.emit(
-        "fromPython",
-        {
-            "id": "eeg-stream-availability-updated",
-            "data": {"value": store.get("eeg_stream_is_available")},
-        },
-    )
-
-
-def notify_client_of_eeg_stream_availability(payload):
-    console.log(f"[green]eeg_stream_is_available: {payload}[/green]")
-    asyncio.run(
-        sio.emit(
-            "fromPython",
-            {
-                "id": "eeg-stream-availability-updated",
-                "data": {"value": payload.get("value")},
-            },
-        )
-    )
+    await sessions.handle(sid, "req:eeg-stream-availability", data)
+
+
+@sio.on("req:eeg-streams")
+async def req_eeg_streams(sid, data={}):
+    await sessions.handle(sid, "req:eeg-streams", data)
+
+
+@sio.on("select-eeg-stream")
+async def select_eeg_stream(sid, key):
+    await sessions.handle(sid, "select-eeg-stream", key)
 
 
-store.on_change("eeg_stream_is_available", notify_client_of_eeg_stream_availability)
 # endregion
 
 
 # region Training & prediction controls
 @sio.on("set-training-btn-state")
 async def set_training_btn_state(sid, value):
-    if value == "start":
-        await flicktok_model.start_training()
-    elif value == "stop":
-        await flicktok_model.stop_training()
+    await sessions.handle(sid, "set-training-btn-state", value)
 
 
 @sio.on("set-prediction-btn-state")
 async def set_prediction_btn_state(sid, value):
     # store.set("prediction_btn_state", value)  # "start" or "stop"
-    if value == "start":
-        await flicktok_model.start_predicting()
-    elif value == "stop":
-        await flicktok_model.stop_predicting()
+    await sessions.handle(sid, "set-prediction-btn-state", value)
 
 
 # endregion
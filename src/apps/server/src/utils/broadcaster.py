@@ -0,0 +1,177 @@
+import asyncio
+from collections import OrderedDict
+from itertools import count
+
+from .helpers import console
+
+
+class ClientQueue:
+    """Messages waiting to be sent to one client.
+
+    Messages with a replaceable id overwrite the pending message with the same
+    id, so only the latest status is sent.  Beyond max_pending messages the
+    oldest are dropped.
+    """
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.sending: asyncio.Task | None = None
+        self.__pending: OrderedDict[object, tuple[str, dict]] = OrderedDict()
+        self.__sequence = count()
+
+    def __len__(self) -> int:
+        return len(self.__pending)
+
+    def put(self, event: str, data: dict, key=None):
+        if key is None:
+            key = next(self.__sequence)
+        elif key in self.__pending:
+            del self.__pending[key]
+            self.dropped += 1
+        self.__pending[key] = (event, data)
+        while len(self.__pending) > self.max_pending:
+            self.__pending.popitem(last=False)
+            self.dropped += 1
+
+    def take_all(self) -> list[tuple[str, dict]]:
+        messages = list(self.__pending.values())
+        self.__pending.clear()
+        return messages
+
+
+class Broadcaster:
+    """Rate-limited Socket.IO broadcast channel.
+
+    emit() has the same signature as AsyncServer.emit() but only queues the
+    message for each client and returns immediately, so the model's state
+    machines never wait on the network.  At rate Hz the pending "fromPython"
+    messages of each client are sent as one frame: a single message as is, a
+    burst as a "fromPythonBatch" list.  A slow client only holds up its own
+    frames, which keep coalescing until its previous send completes.
+    """
+
+    def __init__(
+        self,
+        sio,
+        rate: float = 30,
+        max_pending: int = 256,
+        replaceable_ids: tuple[str] = (
+            "set-training-status",
+            "set-prediction-status",
+            "eeg-stream-availability-updated",
+            "eeg-streams-updated",
+        ),
+    ):
+        self.sio = sio
+        self.rate = rate
+        self.max_pending = max_pending
+        self.replaceable_ids = set(replaceable_ids)
+        self.clients: dict[str, ClientQueue] = {}
+        self.rooms: dict[str, set[str]] = {}
+
+        self.__loop = None
+        self.__task = None
+
+    def add_client(self, sid: str):
+        self.clients[sid] = ClientQueue(self.max_pending)
+
+    def remove_client(self, sid: str):
+        client = self.clients.pop(sid, None)
+        if client is not None and client.sending is not None:
+            client.sending.cancel()
+        for room in list(self.rooms):
+            self.leave_room(sid, room)
+
+    def enter_room(self, sid: str, room: str):
+        self.rooms.setdefault(room, set()).add(sid)
+
+    def leave_room(self, sid: str, room: str):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(sid)
+            if not members:
+                del self.rooms[room]
+
+    def start(self):
+        """Start flushing frames, must be called from the event loop"""
+        self.__loop = asyncio.get_running_loop()
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+        await self.flush()
+
+    async def emit(self, event: str, data: dict = None, to: str = None, room: str = None):
+        """Queue a message for one client (to), the members of a room or every client"""
+        self.send(event, data, to or room)
+
+    def send(self, event: str, data: dict = None, sid: str = None):
+        """Queue a message, safe to call from any thread"""
+        try:
+            in_loop = asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop or self.__loop is None:
+            self.__queue(event, data, sid)
+        else:
+            self.__loop.call_soon_threadsafe(self.__queue, event, data, sid)
+
+    async def flush(self):
+        """Send everything pending now and wait for it"""
+        self.__flush()
+        sending = [c.sending for c in self.clients.values() if c.sending is not None]
+        await asyncio.gather(*sending, return_exceptions=True)
+
+    def __queue(self, event: str, data: dict, sid: str = None):
+        key = None
+        if event == "fromPython" and isinstance(data, dict):
+            if data.get("id") in self.replaceable_ids:
+                key = data["id"]
+
+        if sid is None:
+            clients = self.clients.values()
+        elif sid in self.rooms:
+            clients = [self.clients.get(member) for member in self.rooms[sid]]
+        else:
+            clients = [self.clients.get(sid)]
+        for client in clients:
+            if client is not None:
+                client.put(event, data, key)
+
+    async def __run(self):
+        interval = 1 / self.rate
+        next_flush = self.__loop.time()
+        while True:
+            self.__flush()
+            next_flush += interval
+            await asyncio.sleep(max(0.0, next_flush - self.__loop.time()))
+
+    def __flush(self):
+        for sid, client in self.clients.items():
+            if len(client) == 0:
+                continue
+            if client.sending is not None and not client.sending.done():
+                continue  # Still sending the last frame, let this one coalesce
+            client.sending = asyncio.create_task(self.__send(sid, client.take_all()))
+
+    async def __send(self, sid: str, messages: list[tuple[str, dict]]):
+        batch = [data for event, data in messages if event == "fromPython"]
+        try:
+            for event, data in messages:
+                if event != "fromPython":
+                    await self.sio.emit(event, data, to=sid)
+            if len(batch) == 1:
+                await self.sio.emit("fromPython", batch[0], to=sid)
+            elif batch:
+                await self.sio.emit("fromPythonBatch", batch, to=sid)
+        except Exception as e:
+            console.log(f"[red]Broadcaster: send to {sid} failed due to {e}[/red]")
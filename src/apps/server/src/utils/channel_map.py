@@ -0,0 +1,68 @@
+import numpy as np
+
+# Bookkeeping columns EmotivPro streams alongside the 14 EEG channels
+EMOTIV_NON_EEG_CHANNELS = ["Timestamp", "Counter", "Interpolate", "HardwareMarker", "Markers"]
+
+
+class ChannelMap:
+    """The columns of an EEG stream that are worth keeping, worked out once from
+    its channel metadata.
+
+    A column is kept if its type is EEG.  Streams that don't describe their
+    channel types fall back to the label, dropping the known non-EEG columns.
+    include (labels, e.g. a deployment's electrode subset) narrows it further,
+    in the given order.  apply() slices the kept columns of a chunk into a
+    contiguous float32 array, so everything downstream (buffering, filtering,
+    covariances) only ever sees EEG.
+    """
+
+    def __init__(
+        self,
+        labels: list[str],
+        types: list[str] | None = None,
+        units: list[str] | None = None,
+        include: list[str] | None = None,
+    ):
+        n = len(labels)
+        types = list(types) if types is not None else [""] * n
+        units = list(units) if units is not None else [""] * n
+        described = any(t for t in types)
+
+        eeg = [
+            i
+            for i, (label, type) in enumerate(zip(labels, types))
+            if (type.upper() == "EEG" if described else label not in EMOTIV_NON_EEG_CHANNELS)
+        ]
+        if include is not None:
+            by_label = {labels[i]: i for i in eeg}
+            missing = [label for label in include if label not in by_label]
+            if missing:
+                raise ValueError(f"ChannelMap: no EEG channels named {missing}")
+            eeg = [by_label[label] for label in include]
+
+        self.n_inputs = n
+        self.indices = np.asarray(eeg, dtype=np.intp)
+        self.labels = [labels[i] for i in eeg]
+        self.types = [types[i] or "EEG" for i in eeg]
+        self.units = [units[i] for i in eeg]
+
+    @property
+    def n_channels(self) -> int:
+        return len(self.indices)
+
+    @property
+    def is_identity(self) -> bool:
+        return self.n_channels == self.n_inputs and bool(
+            np.all(self.indices == np.arange(self.n_inputs))
+        )
+
+    def apply(self, samples: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+        """(n_samples, n_channels) float32 with the kept columns of samples, written
+        into out if given"""
+        if out is None:
+            return np.ascontiguousarray(samples[:, self.indices], dtype=np.float32)
+        if samples.dtype == out.dtype:
+            np.take(samples, self.indices, axis=1, out=out, mode="clip")
+        else:
+            out[:] = samples[:, self.indices]
+        return out
@@ -0,0 +1,86 @@
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EpochCache:
+    """Bounded LRU cache of per-epoch results (preprocessed epoch, covariance,
+    tangent-space vector, ...).
+
+    Entries are keyed by trial id, preprocessing settings and channel set, so a
+    change to any of them is a cache miss rather than a stale hit.  The cache can
+    be saved to / loaded from an .npz file next to EegData.save_trials_as_npz().
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict[tuple, dict] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    @staticmethod
+    def key(trial_id: int, settings: dict, channels: list[str]) -> tuple:
+        return (
+            int(trial_id),
+            tuple(sorted((str(k), v) for k, v in settings.items())),
+            tuple(channels),
+        )
+
+    def get(self, key: tuple, field: str) -> np.ndarray | None:
+        entry = self.__entries.get(key)
+        if entry is None or field not in entry:
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return entry[field]
+
+    def put(self, key: tuple, **fields: np.ndarray):
+        self.__entries.setdefault(key, {}).update(fields)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def get_or_compute(self, key: tuple, field: str, compute: callable) -> np.ndarray:
+        value = self.get(key, field)
+        if value is None:
+            value = compute()
+            self.put(key, **{field: value})
+        return value
+
+    def clear(self):
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, file_name: str):
+        if file_name[-4:] != ".npz":
+            file_name += ".npz"
+        arrays = {}
+        keys = []
+        for i, (key, fields) in enumerate(self.__entries.items()):
+            keys.append(key)
+            for field, value in fields.items():
+                arrays[f"{i}/{field}"] = value
+        arrays["keys"] = np.array(json.dumps(keys))
+        np.savez(file_name, **arrays)
+
+    def load(self, file_name: str):
+        """Merge entries from a file written by save() into the cache"""
+        if file_name[-4:] != ".npz":
+            file_name += ".npz"
+        with np.load(file_name, allow_pickle=False) as data:
+            keys = json.loads(str(data["keys"]))
+            fields = {}
+            for name in data.files:
+                if name != "keys":
+                    index, field = name.split("/", 1)
+                    fields.setdefault(int(index), {})[field] = data[name]
+
+        for i, (trial_id, settings, channels) in enumerate(keys):
+            key = (trial_id, tuple(tuple(s) for s in settings), tuple(channels))
+            self.put(key, **fields.get(i, {}))
@@ -1,13 +1,125 @@
 import time
 import threading
 import numpy as np
+from scipy.signal import lfilter
 
-from pylsl import StreamInfo, StreamOutlet
+from pylsl import StreamInfo, StreamOutlet, StreamInlet, ContinuousResolver, local_clock
 
 from .helpers import console
-
-
-def simulate_eeg(store):
+from .markers import Paradigm, parse_marker
+from .channel_map import EMOTIV_NON_EEG_CHANNELS
+
+# This is what comes from an Emotiv EPOC+ headset LSL streamed via EmotivPro
+EMOTIV_CHANNELS = [
+    "Timestamp",
+    "Counter",
+    "Interpolate",
+    "AF3",
+    "F7",
+    "F3",
+    "FC5",
+    "T7",
+    "P7",
+    "O1",
+    "O2",
+    "P8",
+    "T8",
+    "FC6",
+    "F4",
+    "F8",
+    "AF4",
+    "HardwareMarker",
+    "Markers",
+]
+
+# Channels over (or nearest to) motor cortex, where mu/beta desynchronise
+MOTOR_CHANNELS = ["C3", "C4", "Cz", "FC5", "FC6", "FC3", "FC4", "CP3", "CP4"]
+
+# Marker stream published by BessyInput (see MarkerPublisher)
+MARKER_STREAM_NAME = "Python_LSL_Messenger"
+
+
+class SimulatedEeg:
+    """Generates EEG-like chunks: 1/f background noise plus mu (10 Hz) and beta
+    (20 Hz) rhythms.  Calling desynchronise() suppresses mu/beta power over the
+    motor channels for a while, like the event-related desynchronisation of
+    motor imagery.  All channels of a chunk are generated in one vectorised pass.
+    """
+
+    def __init__(
+        self,
+        fsample: float,
+        channel_names: list[str],
+        eeg_channels: list[str],
+        erd_depth: float = 0.6,
+        seed: int | None = None,
+    ):
+        self.fsample = fsample
+        self.n_channels = len(channel_names)
+        self.__rng = np.random.default_rng(seed)
+
+        self.__eeg = np.isin(channel_names, eeg_channels)
+        self.__motor = np.isin(channel_names, MOTOR_CHANNELS)
+        if not self.__motor.any():
+            self.__motor[np.flatnonzero(self.__eeg)[:2]] = True
+
+        self.__phases = self.__rng.uniform(0, 2 * np.pi, (2, self.n_channels))
+        self.__mu_amplitude = 10.0  # microvolts
+        self.__beta_amplitude = 4.0
+        self.__noise_state = np.zeros((1, self.n_channels))  # lfilter zi, per channel
+        self.__erd_depth = erd_depth
+        self.__erd_windows = []  # (start, end) in local_clock seconds
+        self.__counter = 0
+
+    def desynchronise(self, start: float, duration: float):
+        self.__erd_windows.append((start, start + duration))
+
+    def chunk(self, timestamps: np.ndarray) -> np.ndarray:
+        """(len(timestamps), n_channels) float32 samples for the given times"""
+        n = len(timestamps)
+        t = timestamps[:, np.newaxis]
+
+        # 1/f-like background from a leaky integrator, filter state carries over chunks
+        white = self.__rng.normal(0.0, 2.0, (n, self.n_channels))
+        noise, self.__noise_state = lfilter(
+            [1.0], [1.0, -0.95], white, axis=0, zi=self.__noise_state
+        )
+
+        # Mu/beta amplitude, reduced over motor channels inside ERD windows
+        gain = np.ones((n, 1))
+        self.__erd_windows = [w for w in self.__erd_windows if w[1] >= timestamps[0]]
+        for start, end in self.__erd_windows:
+            gain[(timestamps >= start) & (timestamps < end)] = 1 - self.__erd_depth
+        gain = np.where(self.__motor, gain, 1.0)
+
+        rhythms = self.__mu_amplitude * np.sin(2 * np.pi * 10 * t + self.__phases[0])
+        rhythms += self.__beta_amplitude * np.sin(2 * np.pi * 20 * t + self.__phases[1])
+
+        samples = np.where(self.__eeg, noise + gain * rhythms, 0.0)
+        if not self.__eeg.all():
+            # Fill the Emotiv bookkeeping columns with something plausible
+            samples[:, 0] = timestamps
+            samples[:, 1] = (self.__counter + np.arange(n)) % 128
+        self.__counter += n
+        return samples.astype(np.float32)
+
+
+def simulate_eeg(
+    store,
+    fsample: float = 128,
+    n_channels: int = 14,
+    chunk_seconds: float = 1 / 32,
+    inject_markers: bool = True,
+):
+    """Stream simulated EEG to LSL in chunks at fsample Hz until the
+    "stop-headset-simulator" event is published.
+
+    n_channels=14 reproduces the 19 column Emotiv EPOC+ layout, any other count
+    streams that many EEG channels.  Sample times are derived from the start time
+    and the sample count, so the rate doesn't drift.  When inject_markers is set,
+    "mi" markers with the action label from BessyInput, and "simulate-action"
+    events on the store, desynchronise mu/beta for the marked duration.
+    """
 
     terminate = False
 
@@ -15,70 +127,84 @@ def simulate_eeg(store):
         nonlocal terminate
         terminate = True
 
+    def simulate_action(duration: float = 2.0):
+        simulator.desynchronise(local_clock(), duration)
+
     store.subscribe("stop-headset-simulator", stop_simulator)
+    store.subscribe("simulate-action", simulate_action)
 
-    # This is what comes from an Emotiv EPOC+ headset LSL streamed via EmotivPro
-    # Using a lower rate to be nice to network, the sim just sends dummy data so this shouldn't matter
-    fsample = 10
-    psample = 1.0 / fsample
-    channel_names = [
-        "Timestamp",
-        "Counter",
-        "Interpolate",
-        "AF3",
-        "F7",
-        "F3",
-        "FC5",
-        "T7",
-        "P7",
-        "O1",
-        "O2",
-        "P8",
-        "T8",
-        "FC6",
-        "F4",
-        "F8",
-        "AF4",
-        "HardwareMarker",
-        "Markers",
-    ]
-    n_channels = len(channel_names)
+    if n_channels == 14:
+        channel_names = EMOTIV_CHANNELS
+        eeg_channels = [c for c in EMOTIV_CHANNELS if c not in EMOTIV_NON_EEG_CHANNELS]
+    else:
+        channel_names = [f"EEG{i + 1}" for i in range(n_channels)]
+        eeg_channels = channel_names
 
     # Create the outlet StreamInfo with extended data
     # https://github.com/sccn/xdf/wiki/EEG-Meta-Data
     stream_info = StreamInfo(
-        "Headset Sim", "EEG", n_channels, fsample, "float32", "EmotivSimEEG"
+        "Headset Sim", "EEG", len(channel_names), fsample, "float32", "EmotivSimEEG"
     )
     channel_info = stream_info.desc().append_child("channels")
     for label in channel_names:
         ch = channel_info.append_child("channel")
         ch.append_child_value("label", label)
         ch.append_child_value("unit", "microvolts")
-        ch.append_child_value("type", "EEG")
+        ch.append_child_value("type", "EEG" if label in eeg_channels else "misc")
 
     outlet = StreamOutlet(stream_info)
+    simulator = SimulatedEeg(fsample, channel_names, eeg_channels)
 
-    published_to_store = False
+    marker_resolver = ContinuousResolver("name", MARKER_STREAM_NAME)
+    marker_inlet = None
+    next_marker_search = 0.0
 
-    console.log("[blue]Starting headset simulator...[/blue]")
+    console.log(
+        f"[blue]Starting headset simulator ({len(channel_names)} channels "
+        f"at {fsample} Hz)...[/blue]"
+    )
 
-    # Spew out random samples
-    while True:
-        sample = np.random.uniform(0.0, 1.0, n_channels)
-        outlet.push_sample(sample)
+    start_time = local_clock()
+    samples_sent = 0
+    published_to_store = False
 
-        time.sleep(psample)
-        if terminate:
-            console.log("[red]Stopping headset simulator...[/red]")
-            store.unsubscribe("stop-headset-simulator", stop_simulator)
-            break
+    while not terminate:
+        # Send every sample that is due by now, timestamped on the ideal grid
+        due = int((local_clock() - start_time) * fsample) - samples_sent
+        if due > 0:
+            timestamps = start_time + (samples_sent + np.arange(due)) / fsample
+            outlet.push_chunk(simulator.chunk(timestamps), float(timestamps[-1]))
+            samples_sent += due
+
+        if inject_markers:
+            if marker_inlet is None and local_clock() >= next_marker_search:
+                streams = marker_resolver.results()
+                marker_inlet = StreamInlet(streams[0]) if streams else None
+                next_marker_search = local_clock() + 2.0
+            if marker_inlet is not None:
+                markers, marker_times = marker_inlet.pull_chunk(timeout=0.0)
+                for (marker,), marker_time in zip(markers, marker_times):
+                    _inject_marker(simulator, marker, marker_time)
 
         if not published_to_store:
             store.publish("headset-simulator-started")
             published_to_store = True
 
+        time.sleep(chunk_seconds)
+
+    console.log("[red]Stopping headset simulator...[/red]")
+    store.unsubscribe("stop-headset-simulator", stop_simulator)
+    store.unsubscribe("simulate-action", simulate_action)
+
+
+def _inject_marker(simulator: SimulatedEeg, marker: str, marker_time: float):
+    # "mi,num_classes,label,duration", label 1 is the action class
+    marker = parse_marker(marker)
+    if marker is not None and marker.paradigm == Paradigm.MI and marker.label == 1:
+        simulator.desynchronise(marker_time, marker.duration)
+
 
-def generate_simulated_eeg(store):
-    thread = threading.Thread(target=simulate_eeg, args=(store,))
+def generate_simulated_eeg(store, **kwargs):
+    thread = threading.Thread(target=simulate_eeg, args=(store,), kwargs=kwargs)
     thread.daemon = True  # Die when parent dies
     thread.start()
@@ -1,5 +1,7 @@
+import asyncio
 import time
 import threading
+from collections import deque
 from rich.console import Console
 
 console = Console()  # Prints colored text to the terminal
@@ -62,3 +64,100 @@ class CustomTimer:
         if self.timer:
             self.timer.cancel()
         self.is_running = False
+
+
+class FixedRateWorker:
+    """Runs a function on a dedicated thread at a fixed rate.
+
+    Deadlines are scheduled from time.monotonic() so the period does not drift by
+    the run time of the function.  If a call overruns one or more deadlines, the
+    missed deadlines are counted and the schedule skips ahead rather than bursting
+    to catch up.  Results and missed deadline reports are handed back to the
+    asyncio loop with call_soon_threadsafe().
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        function: callable,
+        loop: asyncio.AbstractEventLoop | None = None,
+        on_result: callable = None,
+        on_missed_deadline: callable = None,
+        name: str = "FixedRateWorker",
+        history: int = 10000,
+    ):
+        self.interval = interval
+        self.function = function
+        self.loop = loop
+        self.on_result = on_result
+        self.on_missed_deadline = on_missed_deadline
+        self.name = name
+
+        self.step_count = 0
+        self.missed_deadlines = 0
+        self.last_step_seconds = 0.0
+        self.max_step_seconds = 0.0
+        self.max_jitter_seconds = 0.0
+        self.step_history = deque(maxlen=history)  # (jitter, step duration) pairs
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True  # Die when parent dies
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        next_deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            jitter = started - next_deadline
+            self.max_jitter_seconds = max(self.max_jitter_seconds, jitter)
+
+            try:
+                result = self.function()
+            except Exception as e:
+                console.log(f"[red]{self.name}: step failed due to {e}[/red]")
+                result = None
+
+            finished = time.monotonic()
+            self.step_count += 1
+            self.last_step_seconds = finished - started
+            self.max_step_seconds = max(self.max_step_seconds, self.last_step_seconds)
+            self.step_history.append((jitter, self.last_step_seconds))
+
+            if result is not None and self.on_result is not None:
+                self._call_in_loop(self.on_result, result)
+
+            # Skip over any deadlines that passed while the function was running
+            next_deadline += self.interval
+            if finished > next_deadline:
+                missed = int((finished - next_deadline) // self.interval) + 1
+                self.missed_deadlines += missed
+                next_deadline += missed * self.interval
+                if self.on_missed_deadline is not None:
+                    self._call_in_loop(
+                        self.on_missed_deadline, missed, self.last_step_seconds
+                    )
+
+            self._stop_event.wait(max(0.0, next_deadline - time.monotonic()))
+
+    def _call_in_loop(self, fn, *args):
+        if self.loop is None or self.loop.is_closed():
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
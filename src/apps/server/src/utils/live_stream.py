@@ -0,0 +1,200 @@
+import math
+import struct
+import asyncio
+import threading
+from collections import deque
+
+import numpy as np
+import socketio
+
+from .helpers import console
+
+# Every binary frame starts with this header, followed by n_rows * n_columns
+# little endian values in row major order:
+#   kind (u8), dtype (u8), n_columns (u16), n_rows (u32),
+#   first_timestamp (f64), last_timestamp (f64)
+# Rows are spaced evenly between the two timestamps (LSL local_clock seconds).
+FRAME_HEADER = struct.Struct("<BBHIdd")
+EEG_FRAME = 1
+PROBABILITY_FRAME = 2
+FLOAT16 = 1
+INT16 = 2  # probabilities, scaled by PROBABILITY_SCALE
+PROBABILITY_SCALE = 32767
+DECIMATIONS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def encode_frame(kind: int, values: np.ndarray, timestamps: np.ndarray) -> bytes:
+    if kind == EEG_FRAME:
+        dtype, data = FLOAT16, np.clip(values, -65504, 65504).astype("<f2")
+    else:
+        dtype, data = INT16, np.round(values * PROBABILITY_SCALE).astype("<i2")
+    n_rows, n_columns = data.shape
+    header = FRAME_HEADER.pack(
+        kind, dtype, n_columns, n_rows, timestamps[0], timestamps[-1]
+    )
+    return header + data.tobytes()
+
+
+class LiveStream(socketio.AsyncNamespace):
+    """Socket.IO namespace streaming live EEG and classifier probabilities as
+    binary frames (see FRAME_HEADER).
+
+    Clients emit "subscribe" with {"eeg": bool, "probabilities": bool,
+    "decimation": int} and receive "eeg" / "probabilities" frames at up to rate
+    Hz.  EEG is decimated by the subscriber's factor (rounded up to a power of
+    two, and so that no more than max_sample_rate samples per second go out),
+    for display only, there is no anti-aliasing.  Each frame is encoded once per
+    decimation factor and shared by all subscribers using it, and a subscriber
+    still receiving its last frame skips the next.  push_eeg() and
+    push_probabilities() return straight away while nobody is subscribed.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "/live",
+        rate: float = 20,
+        max_sample_rate: float = 256,
+        max_pending_chunks: int = 256,
+    ):
+        super().__init__(namespace)
+        self.rate = rate
+        self.max_sample_rate = max_sample_rate
+        self.subscribers: dict[str, dict] = {}
+
+        self.__eeg_chunks = deque(maxlen=max_pending_chunks)
+        self.__probability_chunks = deque(maxlen=max_pending_chunks)
+        self.__eeg_subscribed = False
+        self.__probabilities_subscribed = False
+        self.__sample_index = 0  # absolute index of the next EEG sample to send
+        self.__lock = threading.Lock()
+        self.__task = None
+
+    async def on_subscribe(self, sid, data={}):
+        decimation = max(1, int(data.get("decimation", 1)))
+        self.subscribers[sid] = {
+            "eeg": bool(data.get("eeg", True)),
+            "probabilities": bool(data.get("probabilities", True)),
+            "decimation": next((d for d in DECIMATIONS if d >= decimation), DECIMATIONS[-1]),
+            "sending": None,
+        }
+        self.__update_subscriptions()
+        console.log(
+            f"[cyan]LiveStream: {sid} subscribed, "
+            f"decimation {self.subscribers[sid]['decimation']}[/cyan]"
+        )
+
+    async def on_unsubscribe(self, sid, data={}):
+        self.__remove(sid)
+
+    async def on_disconnect(self, sid, reason=None):
+        self.__remove(sid)
+
+    def start(self):
+        """Start sending frames, must be called from the event loop"""
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    def push_eeg(self, samples: np.ndarray, timestamps: np.ndarray):
+        """Queue new EEG samples, safe to call from any thread"""
+        if not self.__eeg_subscribed:
+            return
+        with self.__lock:
+            self.__eeg_chunks.append((samples.copy(), timestamps.copy()))
+
+    def push_probabilities(self, timestamps: np.ndarray, probabilities):
+        """Queue classifier probabilities, one row per window"""
+        if not self.__probabilities_subscribed:
+            return
+        with self.__lock:
+            self.__probability_chunks.append(
+                (np.asarray(probabilities, dtype=float), np.asarray(timestamps, dtype=float))
+            )
+
+    def __remove(self, sid):
+        subscriber = self.subscribers.pop(sid, None)
+        if subscriber is not None and subscriber["sending"] is not None:
+            subscriber["sending"].cancel()
+        self.__update_subscriptions()
+
+    def __update_subscriptions(self):
+        self.__eeg_subscribed = any(s["eeg"] for s in self.subscribers.values())
+        self.__probabilities_subscribed = any(
+            s["probabilities"] for s in self.subscribers.values()
+        )
+        if not self.__eeg_subscribed:
+            with self.__lock:
+                self.__eeg_chunks.clear()
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            try:
+                self.__send_frames()
+            except Exception as e:
+                console.log(f"[red]LiveStream: sending frames failed due to {e}[/red]")
+
+    def __send_frames(self):
+        with self.__lock:
+            eeg_chunks = list(self.__eeg_chunks)
+            probability_chunks = list(self.__probability_chunks)
+            self.__eeg_chunks.clear()
+            self.__probability_chunks.clear()
+
+        eeg_frames = self.__encode_eeg(eeg_chunks) if eeg_chunks else {}
+        probability_frame = None
+        if probability_chunks:
+            probability_frame = encode_frame(
+                PROBABILITY_FRAME,
+                np.concatenate([p for p, _ in probability_chunks]),
+                np.concatenate([t for _, t in probability_chunks]),
+            )
+
+        for sid, subscriber in self.subscribers.items():
+            if subscriber["sending"] is not None and not subscriber["sending"].done():
+                continue  # Slow client, drop this frame for it
+            frames = []
+            if subscriber["eeg"] and eeg_frames.get(subscriber["decimation"]):
+                frames.append(("eeg", eeg_frames[subscriber["decimation"]]))
+            if subscriber["probabilities"] and probability_frame is not None:
+                frames.append(("probabilities", probability_frame))
+            if frames:
+                subscriber["sending"] = asyncio.create_task(self.__send(sid, frames))
+
+    def __encode_eeg(self, chunks: list) -> dict[int, bytes]:
+        samples = np.concatenate([s for s, _ in chunks])
+        timestamps = np.concatenate([t for _, t in chunks])
+        first_index = self.__sample_index
+        self.__sample_index += len(timestamps)
+
+        # Keep the outgoing sample rate bounded whatever the subscribers asked for
+        min_decimation = 1
+        if len(timestamps) > 1 and timestamps[-1] > timestamps[0]:
+            fsample = (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+            min_decimation = math.ceil(fsample / self.max_sample_rate)
+
+        frames = {}
+        for requested in {s["decimation"] for s in self.subscribers.values() if s["eeg"]}:
+            decimation = max(requested, min_decimation)
+            # Decimate on absolute sample indices so frames join up seamlessly
+            start = -first_index % decimation
+            if start < len(timestamps):
+                frames[requested] = encode_frame(
+                    EEG_FRAME, samples[start::decimation], timestamps[start::decimation]
+                )
+        return frames
+
+    async def __send(self, sid, frames: list[tuple[str, bytes]]):
+        try:
+            for event, frame in frames:
+                await self.emit(event, frame, to=sid)
+        except Exception as e:
+            console.log(f"[red]LiveStream: send to {sid} failed due to {e}[/red]")
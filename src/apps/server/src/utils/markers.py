@@ -0,0 +1,122 @@
+import threading
+from dataclasses import dataclass
+from enum import IntEnum
+from functools import lru_cache
+
+import numpy as np
+
+from .helpers import console
+
+
+class Paradigm(IntEnum):
+    Command = 0  # label is an index into COMMANDS
+    MI = 1  # motor imagery, label -1 asks for a prediction
+
+
+# Single string markers understood by bci_essentials.EegData
+COMMANDS = (
+    "Trial Started",
+    "Trial Ends",
+    "Training Complete",
+    "Update Classifier",
+)
+
+MARKER_DTYPE = np.dtype(
+    [
+        ("timestamp", np.float64),
+        ("paradigm", np.int8),
+        ("n_classes", np.int16),
+        ("label", np.int16),
+        ("duration", np.float32),
+    ]
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Marker:
+    """One marker, as used on the Python side of the bci_essentials / LSL boundary.
+    Frozen, parse_marker() hands the same instance to every caller."""
+
+    timestamp: float
+    paradigm: Paradigm
+    n_classes: int = 0
+    label: int = 0
+    duration: float = 0.0
+
+    @property
+    def command(self) -> str | None:
+        return COMMANDS[self.label] if self.paradigm == Paradigm.Command else None
+
+    def __repr__(self) -> str:
+        return f"Marker({marker_string(self.paradigm, self.n_classes, self.label, self.duration)!r})"
+
+
+@lru_cache(maxsize=256)
+def marker_string(paradigm: int, n_classes: int, label: int, duration: float) -> str:
+    """The string bci_essentials expects, e.g. "mi,2,1,2" or "Trial Ends" """
+    if paradigm == Paradigm.Command:
+        return COMMANDS[label]
+    return f"mi,{n_classes},{label},{float(duration):g}"
+
+
+@lru_cache(maxsize=256)
+def parse_marker(message: str) -> Marker | None:
+    """Marker for a string marker, None if it isn't one we know.  The timestamp
+    is left at 0, markers are cached by string (use dataclasses.replace() to
+    date one)."""
+    if message in COMMANDS:
+        return Marker(0.0, Paradigm.Command, label=COMMANDS.index(message))
+    info = message.split(",")
+    if len(info) == 4 and info[0] == "mi":
+        try:
+            return Marker(0.0, Paradigm.MI, int(info[1]), int(info[2]), float(info[3]))
+        except ValueError:
+            pass
+    return None
+
+
+class MarkerQueue:
+    """Fixed-capacity queue of marker records in a preallocated structured array.
+
+    Markers are put from any thread and drained in one go by the consumer, so a
+    step without markers doesn't allocate anything.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self.__records = np.zeros(capacity, dtype=MARKER_DTYPE)
+        self.__empty = self.__records[:0]
+        self.__count = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def put(
+        self,
+        timestamp: float,
+        paradigm: Paradigm,
+        n_classes: int = 0,
+        label: int = 0,
+        duration: float = 0.0,
+    ) -> bool:
+        """Queue a marker, returns False if the queue is full and it was dropped"""
+        with self.__lock:
+            if self.__count == self.capacity:
+                console.log("[red]MarkerQueue: queue is full, marker dropped[/red]")
+                return False
+            self.__records[self.__count] = (timestamp, paradigm, n_classes, label, duration)
+            self.__count += 1
+            return True
+
+    def put_command(self, timestamp: float, command: str) -> bool:
+        return self.put(timestamp, Paradigm.Command, label=COMMANDS.index(command))
+
+    def drain(self) -> np.ndarray:
+        """Remove and return every queued record, oldest first"""
+        with self.__lock:
+            if self.__count == 0:
+                return self.__empty
+            records = self.__records[: self.__count].copy()
+            self.__count = 0
+        return records
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed-capacity, preallocated buffer of multichannel samples and timestamps.
+
+    Every sample is written twice, at index i and i + capacity, so the most recent
+    n <= capacity samples are always contiguous in memory.  Windows are returned as
+    numpy views rather than copies, which keeps the cost of cutting a window
+    independent of how long the session has been running.
+
+    Note - views are only valid until the next write, copy them if they need to be
+    kept around.
+    """
+
+    def __init__(self, capacity: int, n_channels: int, dtype=np.float32):
+        self.capacity = int(capacity)
+        self.n_channels = int(n_channels)
+        self.__data = np.zeros((2 * self.capacity, self.n_channels), dtype=dtype)
+        self.__timestamps = np.zeros(2 * self.capacity, dtype=np.float64)
+        self.__head = 0  # next write position, 0 <= head < capacity
+        self.__total = 0  # total samples written since creation / clear
+
+    def __len__(self) -> int:
+        return min(self.__total, self.capacity)
+
+    @property
+    def total_samples(self) -> int:
+        """Number of samples written since the buffer was created or cleared"""
+        return self.__total
+
+    @property
+    def last_timestamp(self) -> float | None:
+        if self.__total == 0:
+            return None
+        return self.__timestamps[self.__head + self.capacity - 1]
+
+    def clear(self):
+        self.__head = 0
+        self.__total = 0
+
+    def write(self, samples: np.ndarray, timestamps: np.ndarray):
+        """Copy a (n_samples, n_channels) chunk and its timestamps into the buffer"""
+        n = len(timestamps)
+        if n == 0:
+            return
+        if n > self.capacity:
+            samples = samples[-self.capacity :]
+            timestamps = timestamps[-self.capacity :]
+            self.__total += n - self.capacity
+            n = self.capacity
+
+        # Split the chunk where it wraps around the end of the ring
+        first = min(n, self.capacity - self.__head)
+        rest = n - first
+        for offset in (0, self.capacity):
+            start = self.__head + offset
+            self.__data[start : start + first] = samples[:first]
+            self.__timestamps[start : start + first] = timestamps[:first]
+            if rest:
+                self.__data[offset : offset + rest] = samples[first:]
+                self.__timestamps[offset : offset + rest] = timestamps[first:]
+
+        self.__head = (self.__head + n) % self.capacity
+        self.__total += n
+
+    def latest(self, n_samples: int) -> tuple[np.ndarray, np.ndarray]:
+        """View of the newest n_samples as (samples, timestamps), oldest first"""
+        n = min(int(n_samples), len(self))
+        end = self.__head + self.capacity
+        return self.__data[end - n : end], self.__timestamps[end - n : end]
+
+    def window(self, start_time: float, n_samples: int) -> tuple[np.ndarray, np.ndarray]:
+        """View of n_samples starting at the first sample at or after start_time.
+        Returns empty arrays if the window is not fully in the buffer yet."""
+        samples, timestamps = self.latest(len(self))
+        start = int(np.searchsorted(timestamps, start_time))
+        if start == 0 and len(timestamps) and timestamps[0] > start_time:
+            # start_time has already been overwritten
+            return samples[:0], timestamps[:0]
+        if start + n_samples > len(timestamps):
+            return samples[:0], timestamps[:0]
+        return samples[start : start + n_samples], timestamps[start : start + n_samples]
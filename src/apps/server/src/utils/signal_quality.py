@@ -0,0 +1,232 @@
+from collections import deque
+
+import numpy as np
+
+# Per-channel quality flags
+FLAT = 1  # electrode off or disconnected
+NOISY = 2  # large amplitude, e.g. a jaw clench or movement
+LINE_NOISE = 4  # mains interference, usually a poorly seated electrode
+SATURATED = 8  # amplifier at its limits (or stuck)
+FLAG_NAMES = {
+    FLAT: "flat",
+    NOISY: "noisy",
+    LINE_NOISE: "line-noise",
+    SATURATED: "saturated",
+}
+
+# Artifacts that come and go, so repeating the trial gets rid of them
+TRANSIENT = NOISY | SATURATED
+
+
+def flag_names(flags: int) -> list[str]:
+    return [name for flag, name in FLAG_NAMES.items() if flags & flag]
+
+
+class SignalQualityMonitor:
+    """Per-channel signal quality of a live EEG stream, updated chunk by chunk as
+    it is ingested.
+
+    Samples are accumulated into blocks of block_seconds: sum and sum of squares
+    (for the variance), min / max (for flatlines), the projection onto the mains
+    frequency (for line noise) and the number of saturated samples.  Each chunk
+    costs O(chunk) vectorised work and each completed block O(channels), so the
+    monitor can run in the ingest path.  The window statistics are running
+    totals over the last window_seconds of blocks.
+
+    Every block is flagged on its own statistics and kept for history_seconds,
+    so artifacts(start, end) tells whether a trial overlapped an artifact.  With
+    limits (low, high) a sample is saturated when it's at or beyond them,
+    otherwise when it repeats the previous sample exactly (a stuck amplifier).
+
+    The monitor isn't thread-safe, update it and query it from the thread that
+    pulls the samples.
+    """
+
+    def __init__(
+        self,
+        fsample: float,
+        labels: list[str],
+        window_seconds: float = 2.0,
+        block_seconds: float = 0.25,
+        line_frequency: float = 60.0,
+        flat_uV: float = 0.5,
+        max_std_uV: float = 100.0,
+        max_line_noise_uV: float = 10.0,
+        limits: tuple[float, float] | None = None,
+        max_saturated_fraction: float = 0.2,
+        history_seconds: float = 60.0,
+    ):
+        self.fsample = fsample
+        self.labels = list(labels)
+        self.flat_uV = flat_uV
+        self.max_std_uV = max_std_uV
+        self.max_line_noise_uV = max_line_noise_uV
+        self.limits = limits
+        self.max_saturated_fraction = max_saturated_fraction
+
+        n = len(self.labels)
+        self.block = max(2, int(round(block_seconds * fsample)))
+        self.n_blocks = max(1, int(round(window_seconds / block_seconds)))
+        # Blocks start at a multiple of the block length, so the carrier's phase
+        # offset is constant over a block and drops out of the magnitude
+        phase = 2 * np.pi * line_frequency * np.arange(self.block) / fsample
+        self.__carrier = np.exp(-1j * phase)
+
+        # Current block, relative to the first sample to keep the sums well conditioned
+        self.__offset = None
+        self.__previous = None
+        self.__position = 0
+        self.__block_start = None
+        self.__sum = np.zeros(n)
+        self.__squares = np.zeros(n)
+        self.__line = np.zeros(n, dtype=complex)
+        self.__low = np.full(n, np.inf)
+        self.__high = np.full(n, -np.inf)
+        self.__saturated = np.zeros(n)
+
+        # Statistics of the last n_blocks blocks, with running totals of the means
+        self.__variances = np.zeros((self.n_blocks, n))
+        self.__line_powers = np.zeros((self.n_blocks, n))
+        self.__saturated_fractions = np.zeros((self.n_blocks, n))
+        self.__lows = np.zeros((self.n_blocks, n))
+        self.__highs = np.zeros((self.n_blocks, n))
+        self.__totals = np.zeros((3, n))
+        self.__next_block = 0
+        self.n_complete = 0
+
+        # (start, end, flags) of every block, newest last
+        self.history = deque(maxlen=max(1, int(history_seconds / block_seconds)))
+
+    @property
+    def n_channels(self) -> int:
+        return len(self.labels)
+
+    def update(self, samples: np.ndarray, timestamps: np.ndarray):
+        """Add a (n_samples, n_channels) chunk"""
+        n = len(samples)
+        if n == 0:
+            return
+        raw = np.asarray(samples)
+        if self.__offset is None:
+            self.__offset = raw[0].astype(np.float64)
+            self.__previous = raw[0].copy()
+        x = raw - self.__offset
+
+        start = 0
+        while start < n:
+            end = min(n, start + self.block - self.__position)
+            if self.__position == 0:
+                self.__block_start = timestamps[start]
+            self.__accumulate(raw[start:end], x[start:end])
+            self.__position += end - start
+            if self.__position == self.block:
+                self.__close_block(timestamps[end - 1])
+            start = end
+
+    def __accumulate(self, raw: np.ndarray, x: np.ndarray):
+        self.__sum += x.sum(axis=0)
+        self.__squares += np.einsum("ij,ij->j", x, x)
+        self.__line += self.__carrier[self.__position : self.__position + len(x)] @ x
+        np.minimum(self.__low, x.min(axis=0), out=self.__low)
+        np.maximum(self.__high, x.max(axis=0), out=self.__high)
+        if self.limits is not None:
+            low, high = self.limits
+            self.__saturated += np.count_nonzero((raw <= low) | (raw >= high), axis=0)
+        else:
+            self.__saturated += raw[0] == self.__previous
+            self.__saturated += np.count_nonzero(raw[1:] == raw[:-1], axis=0)
+        self.__previous = raw[-1].copy()
+
+    def __close_block(self, end_time: float):
+        n = self.block
+        mean = self.__sum / n
+        variance = np.maximum(self.__squares / n - mean**2, 0.0)
+        # Mean square of the mains sinusoid, (2 |X| / n)^2 / 2
+        line_power = 2 * np.abs(self.__line / n) ** 2
+        saturated = self.__saturated / n
+
+        i = self.__next_block
+        new = np.stack([variance, line_power, saturated])
+        old = np.stack(
+            [self.__variances[i], self.__line_powers[i], self.__saturated_fractions[i]]
+        )
+        self.__totals += new - old
+        self.__variances[i], self.__line_powers[i], self.__saturated_fractions[i] = new
+        self.__lows[i], self.__highs[i] = self.__low, self.__high
+        self.__next_block = (i + 1) % self.n_blocks
+        self.n_complete += 1
+
+        flags = self.__flags(self.__high - self.__low, variance, line_power, saturated)
+        self.history.append((self.__block_start, end_time, flags))
+
+        self.__position = 0
+        self.__sum[:] = 0
+        self.__squares[:] = 0
+        self.__line[:] = 0
+        self.__low[:] = np.inf
+        self.__high[:] = -np.inf
+        self.__saturated[:] = 0
+
+    def __flags(self, peak_to_peak, variance, line_power, saturated) -> np.ndarray:
+        flags = np.zeros(self.n_channels, dtype=np.uint8)
+        flags[peak_to_peak < self.flat_uV] |= FLAT
+        flags[variance > self.max_std_uV**2] |= NOISY
+        flags[line_power > self.max_line_noise_uV**2] |= LINE_NOISE
+        flags[saturated > self.max_saturated_fraction] |= SATURATED
+        return flags
+
+    def window(self) -> dict[str, np.ndarray] | None:
+        """Per-channel statistics over the last window_seconds, None until a block
+        is complete"""
+        filled = min(self.n_complete, self.n_blocks)
+        if filled == 0:
+            return None
+        variance, line_power, saturated = self.__totals / filled
+        peak_to_peak = self.__highs[:filled].max(axis=0) - self.__lows[:filled].min(axis=0)
+        return {
+            "std": np.sqrt(np.maximum(variance, 0.0)),
+            "line_noise": np.sqrt(np.maximum(line_power, 0.0)),
+            "peak_to_peak": peak_to_peak,
+            "saturated": np.maximum(saturated, 0.0),
+            "flags": self.__flags(peak_to_peak, variance, line_power, saturated),
+        }
+
+    def artifacts(self, start: float, end: float) -> np.ndarray:
+        """Per-channel flags of every block that overlaps [start, end]"""
+        flags = np.zeros(self.n_channels, dtype=np.uint8)
+        for block_start, block_end, block_flags in reversed(self.history):
+            if block_end < start:
+                break
+            if block_start <= end:
+                flags |= block_flags
+        return flags
+
+    def summary(self) -> dict | None:
+        """Window statistics as plain values, e.g. to send to the client"""
+        window = self.window()
+        if window is None:
+            return None
+        channels = [
+            {
+                "label": label,
+                "std": round(float(std), 2),
+                "lineNoise": round(float(line_noise), 2),
+                "peakToPeak": round(float(peak_to_peak), 2),
+                "saturated": round(float(saturated), 3),
+                "flags": flag_names(int(flags)),
+            }
+            for label, std, line_noise, peak_to_peak, saturated, flags in zip(
+                self.labels,
+                window["std"],
+                window["line_noise"],
+                window["peak_to_peak"],
+                window["saturated"],
+                window["flags"],
+            )
+        ]
+        good = sum(1 for channel in channels if not channel["flags"])
+        return {
+            "score": round(good / max(1, len(channels)), 3),
+            "bad": [channel["label"] for channel in channels if channel["flags"]],
+            "channels": channels,
+        }
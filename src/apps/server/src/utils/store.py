@@ -1,11 +1,79 @@
 import asyncio
+import threading
+from collections import deque
+
+from .helpers import console
+
+
+class Subscription:
+    """A listener plus its bounded queue of pending notifications.
+
+    Only used once the store has an event loop.  When coalescing, a new
+    notification replaces the pending one instead of queueing behind it, so a
+    listener that falls behind only sees the latest value.  Otherwise the queue
+    holds up to maxsize notifications and drops the oldest when full.
+    """
+
+    def __init__(self, listener: callable, maxsize: int = 100, coalesce: bool = None):
+        self.listener = listener
+        self.coalesce = coalesce
+        self.is_coroutine = asyncio.iscoroutinefunction(listener)
+        self.dropped = 0
+        self.scheduled = False
+        self.__pending = deque(maxlen=maxsize)
+        self.__lock = threading.Lock()
+
+    def put(self, args: tuple, kwargs: dict, is_state: bool) -> bool:
+        """Queue a notification, returns True if a drain needs to be scheduled"""
+        with self.__lock:
+            coalesce = is_state if self.coalesce is None else self.coalesce
+            if coalesce and self.__pending:
+                args = self.__merge(self.__pending.pop()[0], args)
+                self.dropped += 1
+            elif len(self.__pending) == self.__pending.maxlen:
+                self.dropped += 1
+            self.__pending.append((args, kwargs))
+
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def take(self) -> tuple | None:
+        with self.__lock:
+            if self.__pending:
+                return self.__pending.popleft()
+            self.scheduled = False
+            return None
+
+    @staticmethod
+    def __merge(older: tuple, newer: tuple) -> tuple:
+        # Coalesced set() payloads report the value before the first update
+        if len(older) == 1 == len(newer) and isinstance(newer[0], dict):
+            if older[0].get("action") == newer[0].get("action") == "set":
+                payload = dict(newer[0], prev_value=older[0]["prev_value"])
+                payload["changed"] = payload["value"] != payload["prev_value"]
+                return (payload,)
+        return newer
 
 
 class Store:
+    """In-memory pub/sub store.
+
+    Until set_event_loop() is called, listeners are called synchronously in the
+    publisher's thread.  Once the store has a loop, every notification is
+    delivered on the loop, whichever thread published it: plain listeners are
+    called and coroutine listeners are awaited, one notification at a time per
+    listener.  Each listener has a bounded queue, by default updates from set()
+    coalesce to the latest value and published events queue up.
+    """
 
     @property
     def listeners(self) -> dict:
-        return self._listeners
+        return {
+            key: [subscription.listener for subscription in subscriptions]
+            for key, subscriptions in self._listeners.items()
+        }
 
     @property
     def data(self) -> dict:
@@ -17,47 +85,123 @@ class Store:
             self._data.update(arg)
         self._data.update(kwargs)
         self._listeners = {"*": []}
+        self._loop = None
+
+    def set_event_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Deliver notifications on loop from now on"""
+        self._loop = loop
 
     def set(self, key: str, value: any) -> None:
         prev_value = self._data.get(key)
         self._data[key] = value
-        self.publish(
+        self.__publish(
             key,
-            {
-                "value": value,
-                "prev_value": prev_value,
-                "action": "set",
-                "changed": value != prev_value,
-            },
+            (
+                {
+                    "value": value,
+                    "prev_value": prev_value,
+                    "action": "set",
+                    "changed": value != prev_value,
+                },
+            ),
+            {},
+            is_state=True,
         )
 
     def get(self, key: str) -> any:
         return self._data.get(key)
 
-    def on_change(self, key: str, listener: callable) -> None:
-        def on_change_listener(payload: dict) -> None:
-            if key == "*" or key == key and payload.get("changed", False):
-                listener(payload)
+    def on_change(
+        self, key: str, listener: callable, maxsize: int = 100, coalesce: bool = None
+    ) -> None:
+        if asyncio.iscoroutinefunction(listener):
+
+            async def on_change_listener(payload: dict) -> None:
+                if key == "*" or key == key and payload.get("changed", False):
+                    await listener(payload)
 
-        self.subscribe(key, on_change_listener)
+        else:
+
+            def on_change_listener(payload: dict) -> None:
+                if key == "*" or key == key and payload.get("changed", False):
+                    listener(payload)
+
+        self.subscribe(key, on_change_listener, maxsize, coalesce)
         return lambda: self.unsubscribe(key, on_change_listener)
 
-    def subscribe(self, key: str, listener: callable) -> None:
-        self._listeners.setdefault(key, []).append(listener)
+    def subscribe(
+        self, key: str, listener: callable, maxsize: int = 100, coalesce: bool = None
+    ) -> None:
+        """maxsize bounds the listener's queue of pending notifications, coalesce
+        keeps only the latest one (None coalesces set() updates only)"""
+        subscription = Subscription(listener, maxsize, coalesce)
+        self._listeners.setdefault(key, []).append(subscription)
 
     def unsubscribe(self, key: str, listener: callable) -> None:
-        if key in self._listeners and listener in self._listeners[key]:
-            self._listeners[key].remove(listener)
+        subscriptions = self._listeners.get(key, [])
+        for subscription in subscriptions:
+            if subscription.listener == listener:
+                subscriptions.remove(subscription)
+                return
 
     def publish(self, key: str, *args, **kwargs) -> None:
-        if key not in self._listeners:
+        self.__publish(key, args, kwargs, is_state=False)
+
+    def __publish(self, key: str, args: tuple, kwargs: dict, is_state: bool) -> None:
+        subscriptions = self._listeners.get(key, []) + self._listeners.get("*", [])
+        if self._loop is None:
+            for subscription in subscriptions:
+                self.__call_now(subscription, args, kwargs)
+            return
+
+        for subscription in subscriptions:
+            if subscription.put(args, kwargs, is_state):
+                self.__schedule(subscription)
+
+    def __schedule(self, subscription: Subscription) -> None:
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            self._loop.call_soon(self.__drain, subscription)
+        else:
+            self._loop.call_soon_threadsafe(self.__drain, subscription)
+
+    def __drain(self, subscription: Subscription) -> None:
+        if subscription.is_coroutine:
+            self._loop.create_task(self.__drain_async(subscription))
+            return
+        while (notification := subscription.take()) is not None:
+            args, kwargs = notification
+            try:
+                subscription.listener(*args, **kwargs)
+            except Exception as e:
+                console.log(f"[red]Store: listener failed due to {e}[/red]")
+
+    async def __drain_async(self, subscription: Subscription) -> None:
+        while (notification := subscription.take()) is not None:
+            args, kwargs = notification
+            try:
+                await subscription.listener(*args, **kwargs)
+            except Exception as e:
+                console.log(f"[red]Store: listener failed due to {e}[/red]")
+
+    @staticmethod
+    def __call_now(subscription: Subscription, args: tuple, kwargs: dict) -> None:
+        if not subscription.is_coroutine:
+            subscription.listener(*args, **kwargs)
             return
-        for listener in self._listeners.get(key, []) + self._listeners.get("*", []):
-            listener(*args, **kwargs)
-            # if asyncio.iscoroutinefunction(listener):
-            #     asyncio.create_task(listener(*args, **kwargs))
-            # else:
-            #     listener(*args, **kwargs)
+        try:
+            asyncio.get_running_loop().create_task(
+                subscription.listener(*args, **kwargs)
+            )
+        except RuntimeError:
+            console.log(
+                "[yellow]Store: coroutine listener skipped, "
+                "call set_event_loop() first[/yellow]"
+            )
 
     def clear_listeners(self) -> None:
         self._listeners = {"*": []}
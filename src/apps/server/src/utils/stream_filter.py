@@ -0,0 +1,96 @@
+import numpy as np
+from scipy.signal import butter, iirnotch, tf2sos, sosfilt, sosfilt_zi
+
+
+class StreamingFilter:
+    """Causal preprocessing applied to EEG chunk by chunk as it is ingested.
+
+    Each chunk goes through channel selection, common average reference (over
+    reference_channels, by default every selected channel) and one IIR cascade
+    per band: a Butterworth band-pass followed by an optional notch.  Every band
+    filters all channels in one sosfilt call.  The filter state (zi) carries
+    over from chunk to chunk, so every sample is filtered exactly once and chunk
+    boundaries leave no transients.  The state starts at the steady state of the
+    first sample, so there's no onset transient either.
+
+    With one band the output has one column per selected channel, with several
+    the columns are band by band, see output_labels().
+    """
+
+    def __init__(
+        self,
+        fsample: float,
+        n_channels: int,
+        bands: list = ((8, 30),),
+        notch: float | None = 60.0,
+        order: int = 4,
+        channels: list[int] | None = None,
+        reference_channels: list[int] | None = None,
+        common_average: bool = True,
+    ):
+        """channels and reference_channels are column indices of the input"""
+        self.fsample = fsample
+        self.bands = [tuple(band) for band in bands]
+        self.channels = list(range(n_channels)) if channels is None else list(channels)
+
+        # Reference indices are into the selected channels
+        self.__reference = None
+        if common_average:
+            reference = self.channels if reference_channels is None else reference_channels
+            self.__reference = [self.channels.index(c) for c in reference if c in self.channels]
+        self.__select = None if channels is None else np.asarray(self.channels)
+
+        nyquist = fsample / 2
+        cascades = []
+        for low, high in self.bands:
+            sos = butter(
+                order, (low, min(high, 0.95 * nyquist)), btype="bandpass", fs=fsample, output="sos"
+            )
+            if notch is not None and notch < nyquist:
+                sos = np.vstack([sos, tf2sos(*iirnotch(notch, 30, fs=fsample))])
+            cascades.append(sos)
+        self.__sos = np.stack(cascades)  # (n_bands, n_sections, 6)
+        self.__zi = None  # (n_bands, n_sections, 2, n_selected)
+
+    @property
+    def n_outputs(self) -> int:
+        return len(self.bands) * len(self.channels)
+
+    def output_labels(self, labels: list[str]) -> list[str]:
+        """Labels of the output columns, given the labels of the input columns"""
+        selected = [labels[c] for c in self.channels]
+        if len(self.bands) == 1:
+            return selected
+        return [f"{label}_{low}-{high}Hz" for low, high in self.bands for label in selected]
+
+    def output_properties(self, values: list) -> list:
+        """Per-channel property (type, unit, ...) of the output columns"""
+        return [values[c] for c in self.channels] * len(self.bands)
+
+    def reset(self):
+        """Forget the filter state, e.g. after a gap in the stream"""
+        self.__zi = None
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """Filter a (n_samples, n_channels) chunk, returns (n_samples, n_outputs)
+        float32"""
+        x = np.asarray(samples, dtype=np.float64)
+        output = np.empty((len(x), self.n_outputs), dtype=np.float32)
+        if len(x) == 0:
+            return output
+        if self.__select is not None:
+            x = x[:, self.__select]
+        if self.__reference:
+            # Every channel is re-referenced to the average of the reference channels
+            x = x - x[:, self.__reference].mean(axis=1, keepdims=True)
+
+        if self.__zi is None:
+            self.__zi = np.stack(
+                [sosfilt_zi(sos)[..., np.newaxis] * x[0] for sos in self.__sos]
+            )
+        n = x.shape[1]
+        for band, sos in enumerate(self.__sos):
+            output[:, band * n : (band + 1) * n], self.__zi[band] = sosfilt(
+                sos, x, axis=0, zi=self.__zi[band]
+            )
+        return output
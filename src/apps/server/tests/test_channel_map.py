@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from src.utils.channel_map import EMOTIV_NON_EEG_CHANNELS, ChannelMap
+
+
+def test_keeps_eeg_typed_channels():
+    channel_map = ChannelMap(
+        ["AF3", "Counter", "F7", "Battery"],
+        types=["EEG", "misc", "eeg", "misc"],
+        units=["microvolts", "", "microvolts", "%"],
+    )
+    assert channel_map.indices.tolist() == [0, 2]
+    assert channel_map.labels == ["AF3", "F7"]
+    assert channel_map.units == ["microvolts", "microvolts"]
+    assert not channel_map.is_identity
+
+
+def test_falls_back_to_labels_without_types():
+    labels = EMOTIV_NON_EEG_CHANNELS[:3] + ["AF3", "F7"] + EMOTIV_NON_EEG_CHANNELS[3:]
+    channel_map = ChannelMap(labels)
+    assert channel_map.labels == ["AF3", "F7"]
+    assert channel_map.types == ["EEG", "EEG"]
+    assert ChannelMap(["AF3", "F7"]).is_identity
+
+
+def test_include_selects_and_orders():
+    channel_map = ChannelMap(["AF3", "F7", "F3", "Counter"], include=["F3", "AF3"])
+    assert channel_map.indices.tolist() == [2, 0]
+    assert channel_map.labels == ["F3", "AF3"]
+    with pytest.raises(ValueError):
+        ChannelMap(["AF3", "Counter"], include=["AF3", "Counter"])
+
+
+def test_apply():
+    channel_map = ChannelMap(["Counter", "AF3", "F7"])
+    samples = np.arange(12, dtype=np.float64).reshape(4, 3)
+
+    kept = channel_map.apply(samples)
+    assert kept.dtype == np.float32
+    assert kept.flags["C_CONTIGUOUS"]
+    assert kept.tolist() == samples[:, 1:].tolist()
+
+    # Into a preallocated array, with and without a dtype conversion
+    for dtype in (np.float32, np.float64):
+        out = np.zeros((4, 2), dtype=np.float32)
+        assert channel_map.apply(samples.astype(dtype), out) is out
+        assert out.tolist() == samples[:, 1:].tolist()
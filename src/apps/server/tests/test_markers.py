@@ -0,0 +1,68 @@
+import dataclasses
+
+import pytest
+
+from src.BessyInput import BessyInput
+from src.utils.markers import (
+    COMMANDS,
+    Marker,
+    MarkerQueue,
+    Paradigm,
+    marker_string,
+    parse_marker,
+)
+
+
+@pytest.mark.parametrize(
+    "message", ["mi,2,1,2", "mi,2,-1,2", "mi,3,0,1.5", *COMMANDS]
+)
+def test_round_trip(message):
+    marker = parse_marker(message)
+    assert marker is not None
+    assert marker_string(marker.paradigm, marker.n_classes, marker.label, marker.duration) == message
+
+
+def test_parse_fields():
+    assert parse_marker("mi,2,-1,2") == Marker(0.0, Paradigm.MI, 2, -1, 2.0)
+    assert parse_marker("Trial Ends").command == "Trial Ends"
+    assert parse_marker("mi,2,1,2").command is None
+
+
+@pytest.mark.parametrize("message", ["", "bogus", "mi,2,1", "mi,two,1,2", "ssvep,2,1,2"])
+def test_unknown_markers(message):
+    assert parse_marker(message) is None
+
+
+def test_cached_markers_are_immutable():
+    marker = parse_marker("mi,2,1,2")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        marker.timestamp = 5.0
+    dated = dataclasses.replace(marker, timestamp=5.0)
+    assert dated.timestamp == 5.0
+    assert parse_marker("mi,2,1,2").timestamp == 0.0
+
+
+def test_queue_drains_in_order():
+    queue = MarkerQueue(capacity=2)
+    assert len(queue.drain()) == 0
+    assert queue.put(1.0, Paradigm.MI, 2, 0, 2.0)
+    assert queue.put_command(2.0, "Trial Ends")
+    assert not queue.put(3.0, Paradigm.MI, 2, 1, 2.0)  # full, dropped
+
+    records = queue.drain()
+    assert records["timestamp"].tolist() == [1.0, 2.0]
+    assert records["label"].tolist() == [0, COMMANDS.index("Trial Ends")]
+    assert len(queue) == 0
+    assert len(queue.drain()) == 0
+
+
+def test_input_drops_unknown_markers():
+    bessy_input = BessyInput()
+    bessy_input.queue_marker("bogus")
+    bessy_input.queue_marker("mi,2,1,2")
+    bessy_input.queue_marker("Trial Ends")
+
+    messages, timestamps = bessy_input.get_markers()
+    assert messages == [["mi,2,1,2"], ["Trial Ends"]]
+    assert len(timestamps) == 2
+    assert bessy_input.get_markers() == ([], [])
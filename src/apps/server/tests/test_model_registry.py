@@ -0,0 +1,49 @@
+import os
+
+from src.ModelRegistry import ModelRegistry
+
+LABELS = ["AF3", "F7"]
+
+
+def test_versions_and_reload(tmp_path):
+    registry = ModelRegistry(str(tmp_path))
+    first = registry.save("ann", "epoc", {"weights": [1, 2]}, LABELS, 128, {"notch": 60})
+    second = registry.save("ann", "epoc", {"weights": [3, 4]}, LABELS, 128, accuracy=0.8)
+    registry.save("bob", "epoc", {"weights": [5]}, LABELS, 128)
+
+    assert (first.version, second.version) == (1, 2)
+    assert registry.latest("ann", "epoc") == second
+    assert second.metadata == {"accuracy": 0.8}
+
+    # A new registry only has the index to go on
+    reopened = ModelRegistry(str(tmp_path))
+    assert [record.version for record in reopened.records("ann")] == [1, 2]
+    assert reopened.latest("ann", "epoc").settings == {}
+    assert reopened.load(reopened.latest("ann", "epoc")) == {"weights": [3, 4]}
+    assert reopened.load(reopened.records("ann")[0]) == {"weights": [1, 2]}
+
+
+def test_keeps_only_recent_versions(tmp_path):
+    registry = ModelRegistry(str(tmp_path), keep_versions=2)
+    records = [registry.save("ann", "epoc", i, LABELS, 128) for i in range(4)]
+
+    assert [record.version for record in registry.records()] == [3, 4]
+    assert not os.path.exists(tmp_path / records[0].file)
+    assert os.path.exists(tmp_path / records[3].file)
+
+
+def test_refuses_other_channels_and_corrupt_files(tmp_path):
+    ModelRegistry(str(tmp_path)).save("ann", "epoc", "model", LABELS, 128)
+    registry = ModelRegistry(str(tmp_path))
+    record = registry.latest("ann", "epoc")
+
+    assert registry.load(record, ["AF3", "F8"]) is None
+    with open(tmp_path / record.file, "r+b") as file:
+        file.seek(-1, os.SEEK_END)
+        file.write(b"\0")
+    assert registry.load(record, LABELS) is None
+
+
+def test_ignores_unreadable_index(tmp_path):
+    (tmp_path / "index.json").write_text("{not json")
+    assert ModelRegistry(str(tmp_path)).records() == []
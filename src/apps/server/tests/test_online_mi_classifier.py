@@ -0,0 +1,100 @@
+import numpy as np
+from pyriemann.estimation import Covariances
+from pyriemann.tangentspace import TangentSpace
+from pyriemann.utils.tangentspace import tangent_space
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.pipeline import make_pipeline
+
+from src.OnlineMiClassifier import OnlineMiClassifier
+
+N_CHANNELS = 6
+N_SAMPLES = 256
+
+
+def make_trials(n_trials: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    """Balanced two class trials, class 1 has slightly more power on the first two
+    sources, so neither classifier gets every trial right"""
+    rng = np.random.default_rng(seed)
+    mixing = np.random.default_rng(0).standard_normal((N_CHANNELS, N_CHANNELS))
+    y = np.arange(n_trials) % 2
+    X = np.empty((n_trials, N_CHANNELS, N_SAMPLES))
+    for i, label in enumerate(y):
+        scale = np.ones(N_CHANNELS)
+        scale[:2] = 1.04 if label else 0.96
+        sources = rng.standard_normal((N_CHANNELS, N_SAMPLES)) * scale[:, np.newaxis]
+        X[i] = mixing @ sources
+    return X, y
+
+
+def make_classifier() -> OnlineMiClassifier:
+    classifier = OnlineMiClassifier()
+    classifier.set_mi_classifier_settings(n_classes=2, shrinkage=0.1)
+    return classifier
+
+
+def test_matches_shrinkage_lda_on_the_same_tangent_vectors():
+    X, y = make_trials(40, seed=1)
+    X_test, _ = make_trials(40, seed=2)
+    covariances = Covariances(estimator="oas").transform(X)
+
+    classifier = make_classifier()
+    features = np.array(
+        [classifier.partial_fit(cov, int(label)) for cov, label in zip(covariances, y)]
+    )
+
+    # Same shrinkage target (trace / n * I), the pooled covariance only differs by a
+    # scale factor, which doesn't change the decision with balanced classes
+    lda = LinearDiscriminantAnalysis(solver="lsqr", shrinkage=0.1).fit(features, y)
+    test_features = tangent_space(
+        Covariances(estimator="oas").transform(X_test), classifier.reference
+    )
+    assert np.array_equal(classifier.predict(X_test).labels, lda.predict(test_features))
+
+
+def test_agrees_with_batch_tangent_space_lda():
+    X, y = make_trials(60, seed=3)
+    X_test, y_test = make_trials(60, seed=4)
+
+    classifier = make_classifier()
+    classifier.add_to_train(X, y)
+    online = classifier.predict(X_test).labels
+
+    batch = make_pipeline(
+        Covariances(estimator="oas"),
+        TangentSpace(metric="riemann"),
+        LinearDiscriminantAnalysis(solver="lsqr", shrinkage=0.1),
+    ).fit(X, y)
+    expected = batch.predict(X_test)
+
+    assert np.mean(online == y_test) >= np.mean(expected == y_test) - 0.1
+    assert np.mean(online == expected) >= 0.9
+
+
+def test_is_ready_once_every_class_is_seen():
+    X, y = make_trials(4, seed=5)
+    classifier = make_classifier()
+    classifier.add_to_train(X[y == 0], y[y == 0])
+    assert not classifier.is_ready
+    classifier.add_to_train(X[y == 1], y[y == 1])
+    assert classifier.is_ready
+
+
+def test_skips_labels_outside_the_classes():
+    X, y = make_trials(6, seed=6)
+    labels = np.array([0, 1, -1, 2, 0, 1])
+    classifier = make_classifier()
+    classifier.add_to_train(X, labels)
+    assert classifier.n_updates == 4
+
+
+def test_keeps_only_single_predictions():
+    X, y = make_trials(10, seed=7)
+    classifier = make_classifier()
+    classifier.add_to_train(X, y)
+
+    classifier.predict(X[:5])
+    assert len(classifier.predictions) == 0
+    prediction = classifier.predict(X[0])
+    assert len(classifier.predictions) == 1
+    assert prediction.probabilities.shape == (1, 2)
+    assert np.allclose(prediction.probabilities.sum(axis=1), 1.0)
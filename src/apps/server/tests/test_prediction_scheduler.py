@@ -0,0 +1,136 @@
+import asyncio
+
+import numpy as np
+import pytest
+from pylsl import local_clock
+
+from src.PredictionScheduler import ActionDetector, PredictionScheduler
+
+
+def test_detects_after_dwell():
+    detector = ActionDetector(on_threshold=0.6, off_threshold=0.5, dwell_seconds=0.3)
+    times = np.arange(10) * 0.1
+    probabilities = [0.2, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7]
+
+    # The run starts at 0.1 and has lasted 0.3 s at 0.4
+    assert detector.update(times, probabilities) == pytest.approx(0.4)
+    assert not detector.armed
+
+
+def test_hysteresis_keeps_the_run_going():
+    detector = ActionDetector(on_threshold=0.6, off_threshold=0.5, dwell_seconds=0.3)
+    # Dips below on_threshold but not below off_threshold don't restart the run
+    assert detector.update([0.0, 0.1, 0.2], [0.7, 0.55, 0.52]) is None
+    assert detector.update([0.3], [0.51]) == pytest.approx(0.3)
+
+
+def test_drop_below_off_threshold_restarts_the_run():
+    detector = ActionDetector(on_threshold=0.6, off_threshold=0.5, dwell_seconds=0.3)
+    assert detector.update([0.0, 0.1, 0.2], [0.7, 0.7, 0.4]) is None
+    # Back above off_threshold isn't enough, a new run needs on_threshold
+    assert detector.update([0.3, 0.4], [0.55, 0.55]) is None
+    assert detector.update([0.5, 0.6, 0.7, 0.8], [0.65, 0.7, 0.7, 0.7]) == pytest.approx(0.8)
+
+
+def test_triggers_once_until_reset():
+    detector = ActionDetector(on_threshold=0.6, off_threshold=0.5, dwell_seconds=0.0)
+    assert detector.update([0.0], [0.9]) == 0.0
+    assert detector.update([0.1], [0.9]) is None
+    detector.reset()
+    assert detector.update([0.2], [0.9]) == 0.2
+
+
+def test_window_seconds_counts_towards_dwell():
+    detector = ActionDetector(on_threshold=0.6, off_threshold=0.5, dwell_seconds=1.0)
+    # A whole 2 s window above threshold is enough on its own
+    assert detector.update([5.0], [0.8], window_seconds=2.0) == 5.0
+
+
+def test_thresholds_must_be_ordered():
+    with pytest.raises(ValueError):
+        ActionDetector(on_threshold=0.5, off_threshold=0.6)
+
+
+class RequestBessy:
+    """Just enough of Bessy for request mode predictions, each requested window
+    starts offset seconds from now"""
+
+    prediction_latency = None
+    step_seconds = 0.1
+
+    def __init__(self, offset: float):
+        self.offset = offset
+        self.requests = []
+
+    def make_prediction(self, duration: float) -> float:
+        self.requests.append(local_clock() + self.offset)
+        return self.requests[-1]
+
+    def stop_sliding_prediction(self):
+        pass
+
+
+def run_requests(bessy, results, window_seconds=2.0, timeout_seconds=2.0, wait=0.0):
+    """Hand each result to a request mode scheduler once it has sent the request
+    for it, returns the scheduler and the detections"""
+
+    async def run():
+        detections = []
+
+        async def on_state(state):
+            pass
+
+        async def on_detection(eeg_time):
+            detections.append(eeg_time)
+
+        scheduler = PredictionScheduler(
+            bessy,
+            action_label=1,
+            on_state=on_state,
+            on_detection=on_detection,
+            detector=ActionDetector(dwell_seconds=0.0),
+            rest_seconds=0,
+            window_seconds=window_seconds,
+            use_sliding_windows=False,
+            timeout_seconds=timeout_seconds,
+        )
+        scheduler.start()
+        for i, probabilities in enumerate(results):
+            while len(bessy.requests) <= i:
+                await asyncio.sleep(0.01)
+            scheduler.on_prediction(probabilities)
+        await asyncio.sleep(wait)
+        await scheduler.stop()
+        return scheduler, detections
+
+    return asyncio.run(run())
+
+
+def test_results_are_dated_by_window_end():
+    bessy = RequestBessy(offset=-5.0)  # the window has already ended
+    scheduler, detections = run_requests(bessy, [[0.9, 0.1], [0.1, 0.9]], wait=0.05)
+
+    assert scheduler.n_predictions == 2
+    assert scheduler.n_stale == 0
+    assert detections == [pytest.approx(bessy.requests[1] + 2.0)]
+    assert scheduler.request_latency >= 3.0
+
+
+def test_drops_results_that_arrive_before_the_window_ends():
+    # e.g. the late result of a request that timed out
+    bessy = RequestBessy(offset=60.0)
+    scheduler, detections = run_requests(bessy, [[0.1, 0.9]])
+
+    assert scheduler.n_stale == 1
+    assert scheduler.n_predictions == 0
+    assert detections == []
+
+
+def test_requests_again_after_a_timeout():
+    bessy = RequestBessy(offset=60.0)  # never answered
+    scheduler, _ = run_requests(
+        bessy, [], window_seconds=0.05, timeout_seconds=0.05, wait=0.5
+    )
+
+    assert scheduler.n_timeouts >= 1
+    assert len(bessy.requests) == scheduler.n_timeouts + 1
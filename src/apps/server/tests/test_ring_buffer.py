@@ -0,0 +1,70 @@
+import numpy as np
+
+from src.utils.ring_buffer import RingBuffer
+
+
+def chunk(start: int, n: int, n_channels: int = 2):
+    """n samples whose values and timestamps are their sample numbers"""
+    index = np.arange(start, start + n)
+    samples = np.repeat(index[:, np.newaxis], n_channels, axis=1).astype(np.float32)
+    return samples, index.astype(np.float64)
+
+
+def test_latest_before_full():
+    buffer = RingBuffer(8, 2)
+    buffer.write(*chunk(0, 5))
+
+    samples, timestamps = buffer.latest(3)
+    assert len(buffer) == 5
+    assert timestamps.tolist() == [2, 3, 4]
+    assert samples[:, 1].tolist() == [2, 3, 4]
+    # Asking for more than is buffered returns what there is
+    assert buffer.latest(100)[1].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_wraparound_keeps_latest_contiguous():
+    buffer = RingBuffer(8, 2)
+    for start in range(0, 30, 3):
+        buffer.write(*chunk(start, 3))
+
+    samples, timestamps = buffer.latest(8)
+    assert len(buffer) == 8
+    assert buffer.total_samples == 30
+    assert buffer.last_timestamp == 29
+    assert timestamps.tolist() == list(range(22, 30))
+    assert np.array_equal(samples[:, 0], timestamps)
+    assert samples.base is not None  # a view, not a copy
+
+
+def test_chunk_larger_than_capacity():
+    buffer = RingBuffer(8, 2)
+    buffer.write(*chunk(0, 3))
+    buffer.write(*chunk(3, 20))
+
+    samples, timestamps = buffer.latest(8)
+    assert buffer.total_samples == 23
+    assert timestamps.tolist() == list(range(15, 23))
+    assert np.array_equal(samples[:, 0], timestamps)
+
+
+def test_window():
+    buffer = RingBuffer(8, 2)
+    buffer.write(*chunk(0, 12))
+
+    samples, timestamps = buffer.window(5.5, 3)
+    assert timestamps.tolist() == [6, 7, 8]
+    assert samples[:, 0].tolist() == [6, 7, 8]
+    # Not all of the window has arrived yet
+    assert len(buffer.window(10, 3)[1]) == 0
+    # The start of the window has already been overwritten
+    assert len(buffer.window(1, 3)[1]) == 0
+
+
+def test_clear():
+    buffer = RingBuffer(8, 2)
+    buffer.write(*chunk(0, 5))
+    buffer.clear()
+
+    assert len(buffer) == 0
+    assert buffer.last_timestamp is None
+    assert len(buffer.latest(3)[1]) == 0
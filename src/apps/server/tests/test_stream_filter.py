@@ -0,0 +1,75 @@
+import numpy as np
+from scipy.signal import butter, sosfilt
+
+from src.utils.stream_filter import StreamingFilter
+
+FSAMPLE = 256
+
+
+def sine(frequency: float, seconds: float = 4.0) -> np.ndarray:
+    t = np.arange(int(seconds * FSAMPLE)) / FSAMPLE
+    return np.sin(2 * np.pi * frequency * t)
+
+
+def rms(x: np.ndarray) -> float:
+    return float(np.sqrt(np.mean(x**2)))
+
+
+def test_chunks_match_one_pass():
+    rng = np.random.default_rng(0)
+    samples = rng.standard_normal((1000, 4))
+
+    whole = StreamingFilter(FSAMPLE, 4, bands=[(8, 30), (12, 20)]).process(samples)
+    streaming = StreamingFilter(FSAMPLE, 4, bands=[(8, 30), (12, 20)])
+    chunks = [streaming.process(chunk) for chunk in np.array_split(samples, [1, 33, 34, 500])]
+
+    assert whole.shape == (1000, 8)
+    assert np.allclose(np.vstack(chunks), whole, atol=1e-5)
+
+
+def test_matches_butterworth_band_pass():
+    x = np.random.default_rng(1).standard_normal(512)
+    stream = StreamingFilter(FSAMPLE, 1, notch=None, common_average=False)
+    sos = butter(4, (8, 30), btype="bandpass", fs=FSAMPLE, output="sos")
+
+    # Only the initial state differs, compare once it has died out
+    expected = sosfilt(sos, x)
+    assert np.allclose(stream.process(x[:, np.newaxis])[256:, 0], expected[256:], atol=1e-3)
+
+
+def test_passes_band_and_rejects_the_rest():
+    samples = np.stack([sine(15), sine(2), sine(60), sine(80)], axis=1)
+    output = StreamingFilter(FSAMPLE, 4, common_average=False).process(samples)
+    settled = output[FSAMPLE:]
+
+    assert 0.6 < rms(settled[:, 0]) / rms(samples[:, 0]) < 1.1
+    for column in (1, 2, 3):
+        assert rms(settled[:, column]) < 0.05
+
+
+def test_common_average_removes_shared_signal():
+    rng = np.random.default_rng(2)
+    shared = 10 * sine(15)[:, np.newaxis]
+    local = 0.1 * rng.standard_normal((len(shared), 3))
+
+    with_car = StreamingFilter(FSAMPLE, 3).process(shared + local)[FSAMPLE:]
+    without = StreamingFilter(FSAMPLE, 3, common_average=False).process(shared + local)[FSAMPLE:]
+    assert rms(with_car) < 0.1 * rms(without)
+
+    # Channels outside the reference are re-referenced too
+    referenced = StreamingFilter(FSAMPLE, 3, reference_channels=[0, 1]).process(shared + local)
+    assert rms(referenced[FSAMPLE:, 2]) < 0.1 * rms(without[:, 2])
+
+
+def test_channel_selection_and_labels():
+    stream = StreamingFilter(FSAMPLE, 4, bands=[(8, 12), (12, 30)], channels=[3, 1])
+    assert stream.n_outputs == 4
+    assert stream.output_labels(["A", "B", "C", "D"]) == [
+        "D_8-12Hz",
+        "B_8-12Hz",
+        "D_12-30Hz",
+        "B_12-30Hz",
+    ]
+    assert stream.output_properties(["a", "b", "c", "d"]) == ["d", "b", "d", "b"]
+    assert stream.process(np.zeros((10, 4))).shape == (10, 4)
+    assert stream.process(np.zeros((0, 4))).shape == (0, 4)